@@ -6,6 +6,7 @@ load_dotenv()
 
 # API Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")      # None uses the official endpoint; set to point at a compatible server
 TWITTER_BEARER_TOKEN = os.getenv("TWITTER_BEARER_TOKEN")
 
 # Database Configuration
@@ -14,9 +15,120 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 DB_NAME = os.getenv("DB_NAME", "violation_db")
-DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+DATABASE_URL = os.getenv("DATABASE_URL", f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() == "true"                          # Log every SQL statement (debugging only, it's synchronous)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))                                  # Connections kept open per process
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))                            # Extra connections opened under load, closed when returned
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))          # Wait for a free connection before failing
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))          # Reconnect connections older than this (-1 never)
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"          # Check connections on checkout, dropping ones the server closed
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))           # Prepared statements cached per asyncpg connection, 0 behind pgbouncer
 
 # Application settings
 UPLOAD_DIR = "data/compliance_policies/"
-USE_SAMPLE_DATA = True
-DELETE_USERNAMES = False
\ No newline at end of file
+USE_SAMPLE_DATA = os.getenv("USE_SAMPLE_DATA", "true").lower() == "true"
+SAMPLE_DATA_PATH = os.getenv("SAMPLE_DATA_PATH", "./data/pre_generated_tweets.json")   # JSON document or NDJSON corpus replayed instead of the API
+DELETE_USERNAMES = False
+
+# Batched classification settings
+USE_BATCH_CLASSIFICATION = os.getenv("USE_BATCH_CLASSIFICATION", "true").lower() == "true"
+BATCH_MAX_TWEETS = int(os.getenv("BATCH_MAX_TWEETS", "20"))          # Max tweets packed into one LLM request
+BATCH_MAX_TOKENS = int(os.getenv("BATCH_MAX_TOKENS", "3000"))        # Approximate token budget for the tweets of one request
+
+# LLM response handling
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "true").lower() == "true"   # Strict JSON schema output; false falls back to plain JSON mode
+LLM_PARSE_RETRIES = int(os.getenv("LLM_PARSE_RETRIES", "1"))                            # Repair attempts for a malformed single-tweet verdict
+
+# LLM backends: tried in order, later ones take over on 429/5xx/timeouts (and for hedged requests)
+LLM_BACKENDS = os.getenv("LLM_BACKENDS", "")                  # JSON list of {"name", "base_url", "model", "api_key_env", ...}; empty uses OPENAI_* only
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")              # Default model of backends that don't name one
+LLM_REQUEST_TIMEOUT_SECONDS = float(os.getenv("LLM_REQUEST_TIMEOUT_SECONDS", "60"))
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"            # Re-send slow requests to the next backend
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "2"))      # Hedge after max(this, the backend's p95 latency)
+LLM_BACKEND_FAILURE_THRESHOLD = int(os.getenv("LLM_BACKEND_FAILURE_THRESHOLD", "3"))    # Consecutive errors before a backend is skipped
+LLM_BACKEND_COOLDOWN_SECONDS = float(os.getenv("LLM_BACKEND_COOLDOWN_SECONDS", "30"))   # How long an unhealthy backend is skipped
+
+# Scan scheduling and upstream rate limits
+MAX_CONCURRENT_USERS = int(os.getenv("MAX_CONCURRENT_USERS", "10"))                  # Users scanned at the same time
+MAX_INFLIGHT_TWEETS = int(os.getenv("MAX_INFLIGHT_TWEETS", "500"))                   # Tweets being classified at once, process-wide
+MAX_INFLIGHT_TWEETS_PER_USER = int(os.getenv("MAX_INFLIGHT_TWEETS_PER_USER", "100"))  # Tweets being classified at once, per user
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "200000"))
+TWITTER_REQUESTS_PER_MINUTE = int(os.getenv("TWITTER_REQUESTS_PER_MINUTE", "30"))    # Recent search app limit: 450 / 15 min
+SCAN_PROCESSES = max(1, int(os.getenv("SCAN_PROCESSES", "1")))                      # Processes running scans (worker replicas), each limits itself to an even share of the budgets above
+
+
+# Verdict cache settings
+USE_VERDICT_CACHE = os.getenv("USE_VERDICT_CACHE", "true").lower() == "true"
+VERDICT_CACHE_MAX_SIZE = int(os.getenv("VERDICT_CACHE_MAX_SIZE", "100000"))                # In-memory LRU entries
+VERDICT_CACHE_TTL_SECONDS = int(os.getenv("VERDICT_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))  # Applies to memory and Postgres
+VERDICT_CACHE_PURGE_INTERVAL_SECONDS = float(os.getenv("VERDICT_CACHE_PURGE_INTERVAL_SECONDS", "3600"))  # How often expired rows are deleted
+
+# Twitter API client settings
+TWITTER_API_BASE_URL = os.getenv("TWITTER_API_BASE_URL", "https://api.twitter.com/2")
+TWITTER_MAX_CONNECTIONS = int(os.getenv("TWITTER_MAX_CONNECTIONS", "20"))        # Pooled HTTP connections to the Twitter API
+TWITTER_PAGE_PREFETCH = int(os.getenv("TWITTER_PAGE_PREFETCH", "2"))             # Pages fetched ahead while earlier pages are classified
+
+# Scan job queue settings
+USE_JOB_QUEUE = os.getenv("USE_JOB_QUEUE", "true").lower() == "true"        # False runs scans in-process with BackgroundTasks
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))              # Renewed by a heartbeat and on every committed page
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", str(JOB_LEASE_SECONDS / 3)))  # How often a running job renews its lease
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "2"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", str(MAX_CONCURRENT_USERS)))  # Jobs run at once by one worker process
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))           # Each worker serves its /system/metrics here, 0 disables
+
+# Violations export settings
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))     # Rows fetched per server-side cursor round trip / Parquet row group
+
+# Violation writes
+VIOLATION_FLUSH_SIZE = int(os.getenv("VIOLATION_FLUSH_SIZE", "500"))              # Buffered violations written and committed together
+VIOLATION_SINK_USE_COPY = os.getenv("VIOLATION_SINK_USE_COPY", "true").lower() == "true"  # Use asyncpg COPY on Postgres
+
+# Local pre-filter settings (runs before the LLM, short-circuits clearly safe tweets)
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "false").lower() == "true"
+PREFILTER_KEYWORD_THRESHOLD = int(os.getenv("PREFILTER_KEYWORD_THRESHOLD", "1"))                # Keyword hits that escalate a tweet to the LLM
+PREFILTER_MODEL_SAFE_PROBABILITY = float(os.getenv("PREFILTER_MODEL_SAFE_PROBABILITY", "0.05"))  # Below this violation probability a tweet is safe
+PREFILTER_MODEL_DIR = os.getenv("PREFILTER_MODEL_DIR", "data/prefilter_models/")
+PREFILTER_TRAIN_MAX_SAMPLES = int(os.getenv("PREFILTER_TRAIN_MAX_SAMPLES", "50000"))            # Newest stored verdicts a model is trained on
+
+# Tweet deduplication before classification
+DEDUP_NEAR_DUPLICATES = os.getenv("DEDUP_NEAR_DUPLICATES", "false").lower() == "true"   # Also collapse near-identical texts (SimHash)
+DEDUP_MAX_HAMMING_DISTANCE = int(os.getenv("DEDUP_MAX_HAMMING_DISTANCE", "3"))          # Of 64 SimHash bits
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "50000"))                        # Recent texts remembered across concurrent scans
+DEDUP_RESULT_TTL_SECONDS = float(os.getenv("DEDUP_RESULT_TTL_SECONDS", "3600"))        # How long a finished verdict is reused by later scans (only with USE_VERDICT_CACHE)
+
+# Continuous monitoring of watched accounts (runs in the worker processes)
+MONITOR_ENABLED = os.getenv("MONITOR_ENABLED", "true").lower() == "true"
+MONITOR_TICK_SECONDS = float(os.getenv("MONITOR_TICK_SECONDS", "60"))                   # How often due accounts are turned into scan jobs
+MONITOR_DEFAULT_INTERVAL_MINUTES = int(os.getenv("MONITOR_DEFAULT_INTERVAL_MINUTES", "360"))
+MONITOR_JITTER = float(os.getenv("MONITOR_JITTER", "0.1"))                              # +/- share of the interval added to each rescan time
+MONITOR_BUDGET_SHARE = float(os.getenv("MONITOR_BUDGET_SHARE", "0.8"))                  # Share of the upstream budgets scheduled scans may use
+MONITOR_MAX_CANDIDATES = int(os.getenv("MONITOR_MAX_CANDIDATES", "1000"))               # Due accounts considered per tick
+
+# Violation search
+SEMANTIC_SEARCH_ENABLED = os.getenv("SEMANTIC_SEARCH_ENABLED", "false").lower() == "true"     # Embedding index over stored violations (needs numpy)
+SEMANTIC_INDEX_DIR = os.getenv("SEMANTIC_INDEX_DIR", "data/semantic_index/")
+SEMANTIC_EMBEDDING_MODEL = os.getenv("SEMANTIC_EMBEDDING_MODEL", "text-embedding-3-small")
+SEMANTIC_EMBEDDING_DIMENSIONS = int(os.getenv("SEMANTIC_EMBEDDING_DIMENSIONS", "256"))        # 1M violations take 1 GB at 256 dimensions
+SEMANTIC_EMBEDDING_BASE_URL = os.getenv("SEMANTIC_EMBEDDING_BASE_URL", OPENAI_BASE_URL)        # Any OpenAI-compatible embeddings server
+SEMANTIC_INDEX_CHUNK_SIZE = int(os.getenv("SEMANTIC_INDEX_CHUNK_SIZE", "500"))                 # Violations embedded per request
+SEMANTIC_INDEX_INTERVAL_SECONDS = float(os.getenv("SEMANTIC_INDEX_INTERVAL_SECONDS", "60"))    # How often new violations are indexed
+
+# Process pool for the CPU-heavy scan stages (normalization, hashing, pre-filter, large response parsing)
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", "0"))                     # Worker processes per server/worker process, 0 runs the stages in the event loop
+CPU_POOL_CHUNK_SIZE = int(os.getenv("CPU_POOL_CHUNK_SIZE", "256"))             # Most texts sent to a worker in one task
+CPU_POOL_MIN_ITEMS = int(os.getenv("CPU_POOL_MIN_ITEMS", "32"))                # Fewer texts run inline, shipping them would cost more than the work
+CPU_POOL_PARSE_MIN_BYTES = int(os.getenv("CPU_POOL_PARSE_MIN_BYTES", "65536"))  # LLM responses at least this large are parsed in a worker
+
+# Archive replay ingestion
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "data/archives/")                                      # The ingest endpoint only reads archives under this directory
+ARCHIVE_WORK_DIR = os.getenv("ARCHIVE_WORK_DIR", "data/archive_spool/")                       # Parsed tweets partitioned by author, removed after each ingest
+ARCHIVE_PARSE_WORKERS = int(os.getenv("ARCHIVE_PARSE_WORKERS", str(os.cpu_count() or 1)))     # Processes decompressing and parsing archive files
+ARCHIVE_PARTITIONS = int(os.getenv("ARCHIVE_PARTITIONS", "64"))                               # Author partitions, one indexed in memory at a time
+ARCHIVE_INGEST_RETENTION_SECONDS = float(os.getenv("ARCHIVE_INGEST_RETENTION_SECONDS", "86400"))  # How long a finished ingest's progress stays reportable
+ARCHIVE_INGEST_PROGRESS_SECONDS = float(os.getenv("ARCHIVE_INGEST_PROGRESS_SECONDS", "10"))    # How often a worker saves a running ingest's progress
+
+# Logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")        # "json" for structured logs, "text" for human-readable lines
@@ -1,15 +1,83 @@
+import logging
+import time
+from contextlib import asynccontextmanager
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
-from app.core.config import DATABASE_URL, DELETE_USERNAMES
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from sqlalchemy import event, inspect, exc, make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from app.core.metrics import DB_COMMIT_SECONDS, DB_POOL_CHECKOUT_SECONDS, DB_POOL_TIMEOUTS
+from app.core.config import (
+    DATABASE_URL, DELETE_USERNAMES, DB_ECHO, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT_SECONDS,
+    DB_POOL_RECYCLE_SECONDS, DB_POOL_PRE_PING, DB_STATEMENT_CACHE_SIZE
+)
 from sqlalchemy import text
+from sqlalchemy.dialects import postgresql, sqlite
 
 
 
 
-engine = create_async_engine(DATABASE_URL, echo=True)       # Connect to the database, with a connection pooling
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Connection pool recording how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            DB_POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+
+
+
+
+def engine_options(url: str) -> dict:
+    """create_async_engine arguments from the DB_* settings."""
+    url = make_url(url)
+    options = {"echo": DB_ECHO, "pool_pre_ping": DB_POOL_PRE_PING}
+    # SQLite (tests, benchmarks) keeps the pool SQLAlchemy picks for it
+    if url.get_backend_name() == "sqlite":
+        return options
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+        pool_recycle=DB_POOL_RECYCLE_SECONDS
+    )
+    if url.get_driver_name() == "asyncpg":
+        options["connect_args"] = {"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+        if not DB_STATEMENT_CACHE_SIZE:
+            # pgbouncer in transaction mode can't keep asyncpg's own prepared statements either
+            options["connect_args"]["statement_cache_size"] = 0
+    return options
+
+
+
+
+engine = create_async_engine(DATABASE_URL, **engine_options(DATABASE_URL))       # Connect to the database, with a connection pooling
 AsyncSessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)  # A session factory for creating AsyncSession instances
 Base = declarative_base()
 
+logger = logging.getLogger(__name__)
+
+
+
+
+@event.listens_for(Session, "before_commit")
+def start_commit_timer(session):
+    session.info["commit_started"] = time.perf_counter()
+
+
+
+
+@event.listens_for(Session, "after_commit")
+def record_commit_latency(session):
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
 
 
 
@@ -20,23 +88,123 @@ async def get_db():
 
 
 
+def pool_stats() -> dict:
+    """Connections of this process's pool: open, in use and idle, the configured size and the share checked out."""
+    pool = engine.pool
+    if not isinstance(pool, AsyncAdaptedQueuePool):
+        return {}
+    return {
+        "size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "open": pool.size() + pool.overflow(),
+        "in_use": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "utilization": pool.checkedout() / max(1, pool.size() + DB_MAX_OVERFLOW)
+    }
+
+
+
+
+async def release_connection(session: AsyncSession):
+    """
+    End the session's transaction so its connection goes back to the pool, e.g. before waiting on the LLM.
+
+    Loaded objects stay usable (expire_on_commit=False); the session checks out a connection again on its next query.
+    """
+    if session.in_transaction():
+        await session.commit()
+
+
+
+
+
+@asynccontextmanager
+async def session_scope(session: AsyncSession = None):
+    """
+    Borrow a session for one short unit of database work.
+
+    Without `session` a fresh one is opened and closed on exit, returning its connection to the
+    pool; a given session is shared instead, and its connection released on exit. Objects loaded
+    in a scope can be re-added to a later one with `session.add()`, their changes are kept.
+    """
+    if session is not None:
+        yield session
+        await release_connection(session)
+        return
+    async with AsyncSessionLocal() as scoped:
+        yield scoped
+
+
+
+
+def dialect_insert(session: AsyncSession, model):
+    """Return an INSERT construct supporting ON CONFLICT for the session's database dialect."""
+    if session.get_bind().dialect.name == "sqlite":
+        return sqlite.insert(model)
+    return postgresql.insert(model)
+
+
+
+
+def create_missing_indexes(sync_conn):
+    """Create indexes declared on the models that an existing database doesn't have yet."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
+
+
+def add_missing_columns(sync_conn):
+    """Add nullable columns declared on the models that an existing table doesn't have yet."""
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                column_type = column.type.compile(dialect=sync_conn.dialect)
+                sync_conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+
+
+
+def drop_replaced_constraints(sync_conn):
+    """Drop unique constraints of existing databases that the models replaced with wider ones."""
+    # Only Postgres databases outlive a release, SQLite ones are created fresh by the benchmark
+    if sync_conn.dialect.name != "postgresql":
+        return
+    # Scan state used to be unique per username, it is now unique per (username, policy)
+    sync_conn.execute(text("ALTER TABLE scanned_users DROP CONSTRAINT IF EXISTS scanned_users_username_key"))
+
+
+
+
 async def create_tables():
     """Create all database tables defined in models if they don't exist"""
     try:
         # Import the models here to avoid circular imports
         # These imports ensure the models are registered with Base
-        from app.core.models import Violation, ScannedUser
+        from app.core.models import Violation, ScannedUser, CachedVerdict, ScanJob, WatchedAccount, UnclassifiedTweet, ViolationRollup, ArchiveIngestRun
+        from app.services.violation_rollups import backfill_rollups
         
         async with engine.begin() as conn:
             # Create tables if they don't exist
             await conn.run_sync(Base.metadata.create_all)
+
+            # create_all skips tables that already exist, add any new columns and indexes
+            await conn.run_sync(add_missing_columns)
+            await conn.run_sync(drop_replaced_constraints)
+            await conn.run_sync(create_missing_indexes)
+            await conn.run_sync(backfill_rollups)
             
             if DELETE_USERNAMES:
                 # Delete specific usernames from scanned_users table
                 await conn.execute(text("DELETE FROM scanned_users WHERE username IN ('elonmusk')"))
-                print("Deleted username column from violations table")
+                logger.info("Deleted usernames from scanned_users table")
             
-        print("✅ Database tables created successfully")
+        logger.info("Database tables created successfully")
     except Exception as e:
-        print(f"❌ Error creating database tables: {str(e)}")
+        logger.error("Error creating database tables", extra={"error": str(e)})
         raise
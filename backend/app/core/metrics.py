@@ -0,0 +1,181 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+
+# Default latency buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+DURATION_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+
+
+
+def format_labels(labelnames: tuple, values: tuple, extra: dict = None) -> str:
+    pairs = list(zip(labelnames, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+
+
+class Metric:
+    """Base class for labelled metrics rendered in the Prometheus text format."""
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self.render_samples()
+
+    def render_samples(self) -> list:
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in self.values.items()]
+
+
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+
+
+
+class Gauge(Metric):
+    """Gauge whose value is read from a callback at scrape time, or set explicitly."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def render_samples(self) -> list:
+        if self.callback:
+            # The callback returns {label tuple: value}, or a bare value for unlabelled gauges
+            values = self.callback()
+            self.values = values if isinstance(values, dict) else {(): values}
+        return super().render_samples()
+
+
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+        state["counts"][bisect.bisect_left(self.buckets, value)] += 1
+        state["sum"] += value
+        state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        state = self.values.get(self._key(labels))
+        return state["count"] if state else 0
+
+    def render_samples(self) -> list:
+        lines = []
+        for key, state in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), state["counts"]):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, {'le': le})} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {state['sum']}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {state['count']}")
+        return lines
+
+
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = (), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+
+
+# Process-wide registry and the metrics recorded by the scan pipeline
+registry = MetricsRegistry()
+
+TWITTER_PAGE_FETCH_SECONDS = registry.histogram("twitter_page_fetch_seconds", "Latency of one Twitter recent search page request")
+LLM_REQUEST_SECONDS = registry.histogram("llm_request_seconds", "Latency of one LLM chat completion", ("kind",))
+LLM_TOKENS = registry.histogram("llm_tokens_per_request", "Tokens used by one LLM chat completion", ("type",), TOKEN_BUCKETS)
+DB_COMMIT_SECONDS = registry.histogram("db_commit_seconds", "Latency of database commits")
+DB_POOL_CHECKOUT_SECONDS = registry.histogram("db_pool_checkout_seconds", "Wait for a connection from the database pool")
+LLM_BACKEND_SECONDS = registry.histogram("llm_backend_request_seconds", "Latency of one request to an LLM backend", ("backend",))
+SCAN_USER_SECONDS = registry.histogram("scan_user_seconds", "Duration of a full scan of one user", buckets=DURATION_BUCKETS)
+
+RETRIES = registry.counter("upstream_retries_total", "Retried upstream calls", ("upstream",))
+RATE_LIMIT_HITS = registry.counter("upstream_rate_limit_hits_total", "Upstream 429 responses", ("upstream",))
+JSON_PARSE_FAILURES = registry.counter("llm_json_parse_failures_total", "LLM responses that could not be parsed", ("kind",))
+LLM_BACKEND_ERRORS = registry.counter("llm_backend_errors_total", "Failed LLM backend requests", ("backend", "reason"))
+LLM_COST_DOLLARS = registry.counter("llm_cost_dollars_total", "Estimated LLM spend from reported token usage", ("backend",))
+LLM_FAILOVERS = registry.counter("llm_failovers_total", "Requests moved to the next backend after a failure", ("backend",))
+LLM_HEDGES = registry.counter("llm_hedged_requests_total", "Hedged LLM requests, by outcome", ("outcome",))
+DB_POOL_TIMEOUTS = registry.counter("db_pool_timeouts_total", "Connection checkouts that gave up waiting for the pool")
+CPU_POOL_TASKS = registry.counter("cpu_pool_tasks_total", "Chunks of scan work run in the CPU pool's worker processes", ("stage",))
+VIOLATIONS_FOUND = registry.counter("violations_found_total", "Violations found by scans")
+UNKNOWN_VERDICTS = registry.counter("llm_unknown_verdicts_total", "Tweets left unclassified after the repair attempts")
+TWEETS_CLASSIFIED = registry.counter("tweets_classified_total", "Tweets classified, by where the verdict came from", ("source",))
+SCAN_JOBS = registry.counter("scan_jobs_total", "Scan job runs finished by this worker process, by outcome", ("outcome",))
+
+
+
+
+def count_retry(upstream: str):
+    """tenacity `before_sleep` hook counting retries of an upstream call."""
+    def before_sleep(retry_state):
+        RETRIES.inc(upstream=upstream)
+    return before_sleep
@@ -1,9 +1,20 @@
-from sqlalchemy import Column, DateTime, Integer, String, Text, func
+from sqlalchemy import Column, Date, DateTime, Float, Index, Integer, String, Text, UniqueConstraint, func, literal_column, text
 from app.core.database import Base
 
 
 class Violation(Base):
     __tablename__ = "violations"
+    # One index per filter of GET /tweets/violations, each ending in the (posted_at, id) sort/keyset order
+    __table_args__ = (
+        Index("ix_violations_posted_at_id", "posted_at", "id"),
+        Index("ix_violations_username_posted_at_id", "username", "posted_at", "id"),
+        Index("ix_violations_policy_posted_at_id", "policy", "posted_at", "id"),
+        Index("ix_violations_policy_rule_posted_at_id", "policy", "rule_id", "posted_at", "id"),
+        Index("ix_violations_rule_posted_at_id", "rule_id", "posted_at", "id"),
+        # Full-text search; must match VIOLATION_SEARCH_DOCUMENT for the planner to use it
+        Index("ix_violations_search_document", text("to_tsvector('english', tweet || ' ' || reason)"),
+              postgresql_using="gin").ddl_if(dialect="postgresql"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, default="")
@@ -15,10 +26,126 @@ class Violation(Base):
     posted_at = Column(DateTime, nullable=False)
 
 
+# Searchable text of a violation, as indexed by ix_violations_search_document (Postgres only)
+VIOLATION_SEARCH_DOCUMENT = func.to_tsvector(
+    literal_column("'english'"), Violation.tweet + literal_column("' '") + Violation.reason
+)
+
+
+
+class ViolationRollup(Base):
+    __tablename__ = "violation_rollups"
+    # Violation counts per (day, user, policy, rule), kept up to date by the violation sink
+    __table_args__ = (
+        UniqueConstraint("day", "username", "policy", "rule_id", name="uq_violation_rollups_key"),
+        Index("ix_violation_rollups_username_day", "username", "day"),
+        Index("ix_violation_rollups_policy_rule_day", "policy", "rule_id", "day"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    day = Column(Date, nullable=False)                      # Day the tweets were posted (UTC)
+    username = Column(String, nullable=False)
+    policy = Column(Text, nullable=False)
+    rule_id = Column(String, nullable=False)
+    violations = Column(Integer, nullable=False, default=0)
+
+
 
 class ScannedUser(Base):
     __tablename__ = "scanned_users"
+    # Scan state is per (username, policy), a scan under one policy says nothing about another.
+    # A unique index rather than a constraint, so create_tables adds it to existing databases
+    __table_args__ = (Index("uq_scanned_users_username_policy", "username", "policy", unique=True),)
 
     id = Column(Integer, primary_key=True, index=True)
-    username = Column(String, unique=True, nullable=False)
+    username = Column(String, nullable=False)
+    policy = Column(String, nullable=True)                  # Policy name(s) scanned for, as in ScanJob.policy_name; NULL on rows from before per-policy state
     last_scanned_at = Column(DateTime, nullable=True)
+    since_id = Column(String, nullable=True)                # Newest tweet ID covered by a completed scan
+    pending_since_id = Column(String, nullable=True)        # Newest tweet ID seen by the scan in progress, becomes since_id when it completes
+    next_token = Column(String, nullable=True)              # Pagination checkpoint of the scan in progress, after its last committed page
+    tweets_seen = Column(Integer, nullable=True)            # Tweets classified across all scans
+    violations_seen = Column(Integer, nullable=True)        # Violations found across all scans
+    tweets_per_day = Column(Float, nullable=True)           # Smoothed posting rate, measured between completed scans
+
+
+
+
+class CachedVerdict(Base):
+    __tablename__ = "verdict_cache"
+    __table_args__ = (UniqueConstraint("tweet_hash", "policy_hash", name="uq_verdict_cache_key"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    tweet_hash = Column(String(64), nullable=False)                     # sha256 of the normalized tweet text
+    policy_hash = Column(String(64), nullable=False, index=True)        # sha256 of the policy rules content
+    verdict = Column(Text, nullable=False)                              # JSON verdict, YES and NO outcomes alike
+    tweet_text = Column(Text, nullable=True)                            # Kept as training data for the local pre-filter model
+    created_at = Column(DateTime, nullable=False)                       # Naive UTC, used for TTL expiry
+
+
+
+class ScanJob(Base):
+    __tablename__ = "scan_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    username = Column(String, nullable=False)
+    policy_name = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="queued", index=True)   # queued | running | completed | failed
+    attempts = Column(Integer, nullable=False, default=0)
+    pages_done = Column(Integer, nullable=False, default=0)
+    tweets_processed = Column(Integer, nullable=False, default=0)
+    violations_found = Column(Integer, nullable=False, default=0)
+    next_token = Column(String, nullable=True)                              # Pagination token after the last committed page (resuming uses ScannedUser)
+    error = Column(Text, nullable=True)
+    worker_id = Column(String, nullable=True)
+    leased_until = Column(DateTime, nullable=True)                          # A running job whose lease expired is picked up again
+    not_before = Column(DateTime, nullable=True)                            # A rate-limited job isn't leased again before the upstream window resets
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+
+
+class ArchiveIngestRun(Base):
+    __tablename__ = "archive_ingests"
+
+    id = Column(String(32), primary_key=True)                               # Also names the ingest's spool directory
+    paths = Column(Text, nullable=False)                                    # JSON list of archive paths, readable by every worker
+    policy_name = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="queued", index=True)   # queued | running | completed | failed
+    progress = Column(Text, nullable=True)                                  # JSON counters of the running ingest, saved by its worker
+    error = Column(Text, nullable=True)
+    worker_id = Column(String, nullable=True)
+    leased_until = Column(DateTime, nullable=True)                          # Renewed with every progress save, past it the worker is gone
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+
+
+class UnclassifiedTweet(Base):
+    __tablename__ = "unclassified_tweets"
+
+    id = Column(Integer, primary_key=True, index=True)
+    username = Column(String, nullable=False, index=True)
+    policy = Column(Text, nullable=False)                               # Name of the policy (or policies) the tweet was checked against
+    tweet_id = Column(String, nullable=True)
+    tweet = Column(Text, nullable=False)
+    error = Column(Text, nullable=True)                                 # Why no verdict could be obtained
+    posted_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+
+
+
+
+class WatchedAccount(Base):
+    __tablename__ = "watched_accounts"
+    __table_args__ = (UniqueConstraint("username", "policy_name", name="uq_watched_accounts_username_policy"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    username = Column(String, nullable=False)
+    policy_name = Column(String, nullable=False)
+    interval_seconds = Column(Integer, nullable=False)                  # Target time between two scans of this account
+    next_scan_at = Column(DateTime, nullable=False, index=True)         # Naive UTC, jittered so rescans spread across the interval
+    last_enqueued_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, nullable=False)
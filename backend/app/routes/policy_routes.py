@@ -1,9 +1,13 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException
+from fastapi import APIRouter, File, UploadFile, HTTPException, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 import os
-import json
 from pathlib import Path
 from ..core.config import UPLOAD_DIR
+from ..core.database import get_db
+from ..services.verdict_cache import verdict_cache
+from ..services.policy_registry import policy_registry, combine_policies, CompiledPolicy, PolicyNotFound, InvalidPolicy
+from ..services.prefilter import prefilter_registry
 
 
 
@@ -14,78 +18,72 @@ policy_router = APIRouter(prefix="/policies", tags=["Policies"])
 
 
 
-# Helper function to read policy file
-async def load_policy_rules(policy_name: str) -> List[str]:
-    """Load policy rules from a JSON file."""
-    file_path = os.path.join(UPLOAD_DIR, f"{policy_name}.json")
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail=f"Policy file '{policy_name}' not found")
-    
+# Helper function to get a compiled policy
+def get_compiled_policy(policy_name: str) -> CompiledPolicy:
+    """Get a policy from the registry, mapping registry errors to HTTP errors."""
     try:
-        with open(file_path, "r") as f:
-            data = json.load(f)
-            
-            # Assuming the JSON has a "rules" list
-            if isinstance(data, dict) and "rules" in data:
-                return data["rules"]
-            # Or if it's a list of rules
-            elif isinstance(data, list):
-                return data
-            else:
-                raise HTTPException(status_code=400, detail="Invalid policy file format")
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON in policy file")
+        return policy_registry.get(policy_name)
+    except PolicyNotFound:
+        raise HTTPException(status_code=404, detail=f"Policy file '{policy_name}' not found")
+    except InvalidPolicy as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading policy file: {str(e)}")
 
 
 
 
+def get_compiled_policies(policy_names: List[str]) -> CompiledPolicy:
+    """Get the policies combined into one, evaluated together in a single pass per tweet."""
+    return combine_policies([get_compiled_policy(name) for name in dict.fromkeys(policy_names)])
+
+
+
+
+async def load_policy_rules(policy_name: str) -> List[str]:
+    """Load policy rules from a JSON file."""
+    return get_compiled_policy(policy_name).rules
+
+
+
+
 
 
 @policy_router.post("/upload")
-async def upload_policy_file(file: UploadFile = File(...)):
+async def upload_policy_file(file: UploadFile = File(...), db: AsyncSession = Depends(get_db)):
     """Upload a compliance policy file (JSON only)."""
     try:
         # Ensure the file is a JSON file
         if not file.filename.lower().endswith('.json'):
             raise HTTPException(status_code=400, detail="Only JSON files are supported")
         
-        # Create upload directory if it doesn't exist
-        os.makedirs(UPLOAD_DIR, exist_ok=True)
-        
-        # Save uploaded file
+        # Remember what the upload replaces so cached verdicts can be invalidated
         file_path = os.path.join(UPLOAD_DIR, file.filename)
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-        
-        # Validate JSON format
+        policy_name = Path(file.filename).stem
+        previous_policy = policy_registry.peek(policy_name)
+        if previous_policy is None and os.path.exists(file_path):
+            try:
+                previous_policy = policy_registry.reload(policy_name)
+            except InvalidPolicy:
+                previous_policy = None
+
+        # Validate and compile the new version before it replaces the file (hot reload);
+        # an invalid upload leaves the current policy untouched
+        content = await file.read()
         try:
-            with open(file_path, "r") as f:
-                policy_data = json.load(f)
-                
-                # Check if it has rules
-                if isinstance(policy_data, dict) and "rules" in policy_data:
-                    rules_count = len(policy_data["rules"])
-                elif isinstance(policy_data, list):
-                    rules_count = len(policy_data)
-                else:
-                    raise ValueError("Policy file must contain rules as a list or a 'rules' key with a list")
-                
-        except json.JSONDecodeError:
-            # Remove invalid file
-            os.remove(file_path)
-            raise HTTPException(status_code=400, detail="Invalid JSON format")
-        except Exception as e:
-            # Remove invalid file
-            os.remove(file_path)
-            raise HTTPException(status_code=400, detail=str(e))
+            policy = policy_registry.install(policy_name, content)
+        except InvalidPolicy as e:
+            detail = "Invalid JSON format" if "JSON" in str(e) else str(e)
+            raise HTTPException(status_code=400, detail=detail)
+
+        # Verdicts computed against the replaced rules are stale now
+        if previous_policy and previous_policy.content_hash != policy.content_hash:
+            await verdict_cache.invalidate_policy(db, previous_policy.content_hash)
         
         return {
             "message": f"Policy file uploaded successfully",
             "filename": file.filename,
-            "rules_count": rules_count
+            "rules_count": len(policy.rules)
         }
     
     except HTTPException:
@@ -119,4 +117,20 @@ async def get_policy_rules(policy_name: str):
     """Get the rules for a specific policy."""
     
     rules = await load_policy_rules(policy_name)
-    return {"policy_name": policy_name, "rules": rules}
\ No newline at end of file
+    return {"policy_name": policy_name, "rules": rules}
+
+
+
+
+
+@policy_router.post("/{policy_name}/prefilter/train")
+async def train_policy_prefilter(policy_name: str, db: AsyncSession = Depends(get_db)):
+    """Train the local pre-filter model of a policy on the LLM verdicts stored for it."""
+    policy = get_compiled_policy(policy_name)
+    try:
+        summary = await prefilter_registry.train_model(db, policy)
+    except RuntimeError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"policy_name": policy_name, **summary}
\ No newline at end of file
@@ -1,9 +1,78 @@
 from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from ..core.metrics import registry
+from ..services.scan_scheduler import scheduler
+from ..services.verdict_cache import verdict_cache
+from ..services.prefilter import prefilter_registry
+from ..services.dedup import dedup_scope
+from ..services.llm_backends import llm_router
+from ..services.cpu_pool import cpu_pool
+from ..core.database import pool_stats
 
 # Create system router for health checks and system-level endpoints
 system_router = APIRouter(prefix="/system", tags=["System"])
 
+# Point-in-time gauges, read from the process-wide components when scraped
+registry.gauge("scheduler_queue_depth", "Callers waiting for a user slot, tweet slots or an upstream rate limit",
+               callback=lambda: scheduler.stats()["queue_depth"])
+registry.gauge("scheduler_slots_in_use", "Held scheduler slots", ("pool",),
+               callback=lambda: {("users",): scheduler.users.in_use, ("tweets",): scheduler.tweets.in_use})
+registry.gauge("verdict_cache_entries", "Verdicts held in the in-memory cache", callback=lambda: verdict_cache.stats()["size"])
+registry.gauge("verdict_cache_lookups", "Verdict cache lookups by outcome", ("outcome",),
+               callback=lambda: {(outcome,): verdict_cache.stats()[outcome] for outcome in ("memory_hits", "db_hits", "misses")})
+registry.gauge("prefilter_escalation_rate", "Share of pre-filtered tweets escalated to the LLM",
+               callback=lambda: prefilter_registry.stats()["escalation_rate"])
+registry.gauge("llm_backend_healthy", "1 while an LLM backend receives traffic, 0 while it's skipped", ("backend",),
+               callback=lambda: {(backend.name,): int(backend.healthy) for backend in llm_router.backends})
+registry.gauge("db_pool_connections", "Database pool connections by state", ("state",),
+               callback=lambda: {(state,): value for state, value in pool_stats().items() if state in ("open", "in_use", "idle")})
+registry.gauge("db_pool_utilization", "Share of the pool (size plus overflow) checked out",
+               callback=lambda: pool_stats().get("utilization", 0.0))
+registry.gauge("dedup_collapsed", "Tweets answered by an identical or near-identical tweet", callback=lambda: dedup_scope.stats()["collapsed"])
+
 @system_router.get("/health")
 async def health_check():
     """Simple health check endpoint."""
-    return {"status": "healthy", "service": "Twitter Compliance Violation Service"}
\ No newline at end of file
+    return {"status": "healthy", "service": "Twitter Compliance Violation Service"}
+
+
+
+@system_router.get("/scheduler")
+async def scheduler_status():
+    """Current scan scheduler load: in-flight work, queue depth and upstream rate limits, plus the CPU pool settings."""
+    return {**scheduler.stats(), "cpu_pool": cpu_pool.stats()}
+
+
+
+@system_router.get("/cache")
+async def cache_status():
+    """Verdict cache size and hit/miss counters, plus duplicates collapsed before classification."""
+    return {**verdict_cache.stats(), "dedup": dedup_scope.stats()}
+
+
+
+@system_router.get("/prefilter")
+async def prefilter_status():
+    """Local pre-filter counters, including the share of tweets escalated to the LLM."""
+    return prefilter_registry.stats()
+
+
+
+@system_router.get("/llm")
+async def llm_status():
+    """LLM backends in order of preference, with their health, latency percentiles and estimated cost."""
+    return llm_router.stats()
+
+
+
+@system_router.get("/database")
+async def database_status():
+    """Connection pool of this process: configured size and open, in-use and idle connections."""
+    return pool_stats()
+
+
+
+@system_router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Latency histograms, counters and gauges in the Prometheus text exposition format."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -1,53 +1,97 @@
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Query, Body
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List, Optional
-from app.core.database import get_db, AsyncSessionLocal
+from typing import List, Literal, Optional
+from app.core.database import get_db
+import base64
+import os
 import datetime
 import asyncio
+import logging
 from app.core.models import Violation, ScannedUser
-from sqlalchemy import select, and_
-from pydantic import BaseModel
+from sqlalchemy import select, and_, tuple_
+from pydantic import BaseModel, Field, model_validator
 from ..services.tweets_processor import process_user_tweets
-from .policy_routes import load_policy_rules
+from ..services.scan_scheduler import scheduler
+from ..services.job_queue import enqueue_scan_jobs, job_to_dict
+from ..services import violations_export
+from ..services.violation_rollups import build_rollup_conditions, violation_stats, top_offenders
+from ..services.violation_search import keyword_search, semantic_search
+from ..services.semantic_index import semantic_index
+from app.core.models import ScanJob, ArchiveIngestRun
+from app.core.config import USE_JOB_QUEUE, MONITOR_DEFAULT_INTERVAL_MINUTES, ARCHIVE_DIR
+from ..services.monitor import watch_accounts, unwatch_account, watch_to_dict
+from app.core.models import WatchedAccount
+from .policy_routes import get_compiled_policies
+from ..services.policy_registry import CompiledPolicy
+from ..services.archive_ingest import enqueue_ingest, ingest_to_dict, run_next_ingest, ingest_worker_id
 
 
 
 # Create tweet router
 tweet_router = APIRouter(prefix="/tweets", tags=["Tweets"])
 
+logger = logging.getLogger(__name__)
 
 
-class ProcessTweetsInput(BaseModel):
+
+class PolicySelection(BaseModel):
+    """One policy (`policy_name`) or several (`policy_names`), evaluated together in one pass."""
+    policy_name: Optional[str] = None
+    policy_names: List[str] = []
+
+    @model_validator(mode="after")
+    def require_a_policy(self):
+        if not self.policy_name and not self.policy_names:
+            raise ValueError("Either policy_name or policy_names is required")
+        return self
+
+    def requested_policies(self) -> List[str]:
+        return list(dict.fromkeys(([self.policy_name] if self.policy_name else []) + self.policy_names))
+
+
+
+class ProcessTweetsInput(PolicySelection):
+    usernames: List[str]
+
+
+
+class IngestArchivesInput(PolicySelection):
+    paths: List[str] = Field(..., min_length=1)
+
+
+
+class WatchAccountsInput(PolicySelection):
     usernames: List[str]
-    policy_name: str
+    interval_minutes: int = Field(MONITOR_DEFAULT_INTERVAL_MINUTES, ge=1)
 
 
 
 
-# Helper function to create a fresh DB session per username for background tasks
-async def process_tweets_background(username: str, policy_rules: List[str]):
-    """Process tweets using a dedicated database session per task."""
-    print(f"🚀 STARTING BACKGROUND TASK for {username}")
-    async with AsyncSessionLocal() as session:
+# Helper function scanning one username in a background task
+async def process_tweets_background(username: str, policy: CompiledPolicy):
+    """Process tweets of one username; the scan borrows short-lived database sessions as it goes."""
+    # Wait for a user slot so a large request can't scan every username at once
+    async with scheduler.user_slot():
         try:
-            print(f"⏳ Processing tweets for {username}")
-            await process_user_tweets(username, policy_rules, session)
-            print(f"✅ Completed processing tweets for {username}")
-        except Exception as e:
-            print(f"❌ Error processing tweets for user: {username}. Error: {e}")
+            logger.info("Processing tweets", extra={"username": username, "policy": policy.name})
+            await process_user_tweets(username, policy)
+            logger.info("Completed processing tweets", extra={"username": username})
+        except Exception:
+            logger.exception("Error processing tweets", extra={"username": username})
 
 
 
 
 
 
-async def process_tweets_concurrently(usernames: List[str], policy_rules: List[str]):
+async def process_tweets_concurrently(usernames: List[str], policy: CompiledPolicy):
     """Process multiple usernames concurrently."""
     
     # Create tasks for all usernames to process concurrently
     tasks = []
     for username in usernames:
-        tasks.append(process_tweets_background(username, policy_rules))
+        tasks.append(process_tweets_background(username, policy))
     
     # Run all tasks concurrently
     await asyncio.gather(*tasks)
@@ -57,33 +101,38 @@ async def process_tweets_concurrently(usernames: List[str], policy_rules: List[s
 
 
 @tweet_router.post("/process", status_code=202)
-async def process_tweets(input_data: ProcessTweetsInput, background_tasks: BackgroundTasks):
+async def process_tweets(input_data: ProcessTweetsInput, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
     """Process tweets from one or more Twitter usernames."""
     try:
-        # Load policy rules
-        policy_rules = await load_policy_rules(input_data.policy_name)
-        print(f'✅ Loaded policy rules for {input_data.policy_name}')
+        # Load the compiled policies (validates they exist before anything is queued); several
+        # policies are combined so each tweet is fetched and classified once for all of them
+        policy = get_compiled_policies(input_data.requested_policies())
 
-        # Add a single background task that processes all usernames concurrently
-        background_tasks.add_task(
-            process_tweets_concurrently, 
-            input_data.usernames, 
-            policy_rules
-        )
-        
         # Prepare appropriate message based on number of usernames
         count = len(input_data.usernames)
         if count == 1:
             message = f"Processing tweets for username: {input_data.usernames[0]}"
         else:
             message = f"Processing tweets for {count} usernames"
-        
-        return {
+
+        response = {
             "message": message, 
             "usernames": input_data.usernames,
-            "policy": input_data.policy_name,
-            "status": "started"
+            "policy": policy.name
         }
+
+        if USE_JOB_QUEUE:
+            # Persist one job per username, picked up by the worker processes (worker.py)
+            jobs = await enqueue_scan_jobs(db, input_data.usernames, policy.name)
+            return {**response, "status": "queued", "job_ids": [job.id for job in jobs]}
+
+        # Add a single background task that processes all usernames concurrently
+        background_tasks.add_task(
+            process_tweets_concurrently, 
+            input_data.usernames, 
+            policy
+        )
+        return {**response, "status": "started"}
     except HTTPException:
         # Re-raise HTTP exceptions
         raise
@@ -93,6 +142,62 @@ async def process_tweets(input_data: ProcessTweetsInput, background_tasks: Backg
 
 
 
+# Columns returned by the violations endpoints, selected directly instead of hydrating ORM objects
+VIOLATION_COLUMNS = (
+    Violation.id,
+    Violation.username,
+    Violation.tweet,
+    Violation.policy,
+    Violation.rule_id,
+    Violation.rule_violated,
+    Violation.reason,
+    Violation.posted_at
+)
+
+
+
+
+def build_violation_conditions(start_date, end_date, username, policy, rule_id) -> list:
+    """Build the WHERE conditions shared by the violations endpoints."""
+    conditions = []
+    
+    if start_date:
+        conditions.append(Violation.posted_at >= start_date)
+    
+    if end_date:
+        conditions.append(Violation.posted_at <= end_date)
+    
+    if policy:
+        conditions.append(Violation.policy == policy)
+    
+    if rule_id:
+        conditions.append(Violation.rule_id == rule_id)
+    
+    if username:
+        conditions.append(Violation.username == username)
+
+    return conditions
+
+
+
+
+def encode_cursor(posted_at: datetime.datetime, violation_id: int) -> str:
+    """Opaque keyset cursor pointing at the last returned (posted_at, id)."""
+    return base64.urlsafe_b64encode(f"{posted_at.isoformat()}|{violation_id}".encode()).decode()
+
+
+
+
+def decode_cursor(cursor: str):
+    try:
+        posted_at, violation_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.datetime.fromisoformat(posted_at), int(violation_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+
+
 @tweet_router.get("/violations")
 async def get_violations(
     start_date: Optional[datetime.datetime] = Query(None),
@@ -102,62 +207,163 @@ async def get_violations(
     rule_id: Optional[str] = Query(None),
     limit: int = Query(100, ge=1, le=1000),
     offset: int = Query(0, ge=0),
+    pagination: Literal["offset", "cursor"] = Query("offset"),
+    cursor: Optional[str] = Query(None),
     db: AsyncSession = Depends(get_db)
 ):
     """
-    Get stored violations with optional filtering.
+    Get stored violations with optional filtering, newest first.
     
     - start_date: Filter violations posted on or after this date
     - end_date: Filter violations posted on or before this date
     - policy: Filter by policy name
     - rule_id: Filter by specific rule ID
     - limit: Maximum number of violations to return (1-1000)
-    - offset: Number of violations to skip
+    - offset: Number of violations to skip (offset pagination)
+    - pagination: "cursor" returns {"violations", "next_cursor"} and pages by (posted_at, id), which stays fast at any depth
+    - cursor: The next_cursor of the previous page (implies cursor pagination)
     """
     # Build query with filters
-    conditions = []
-    
-    if start_date:
-        conditions.append(Violation.posted_at >= start_date)
-        print(start_date)
-    
-    if end_date:
-        conditions.append(Violation.posted_at <= end_date)
-    
-    if policy:
-        conditions.append(Violation.policy == policy)
-    
-    if rule_id:
-        conditions.append(Violation.rule_id == rule_id)
-    
-    if username:
-        conditions.append(Violation.username == username)
+    conditions = build_violation_conditions(start_date, end_date, username, policy, rule_id)
+    query = select(*VIOLATION_COLUMNS).order_by(Violation.posted_at.desc(), Violation.id.desc()).limit(limit)
+
+    use_cursor = pagination == "cursor" or cursor is not None
+    if use_cursor and cursor:
+        # Keyset condition: strictly after the last row of the previous page
+        conditions.append(tuple_(Violation.posted_at, Violation.id) < decode_cursor(cursor))
+    elif not use_cursor:
+        query = query.offset(offset)
     
     # Apply filters if any
     if conditions:
-        query = select(Violation).where(and_(*conditions)).limit(limit).offset(offset)
-    else:
-        query = select(Violation).limit(limit).offset(offset)
+        query = query.where(and_(*conditions))
     
     result = await db.execute(query)
-    violations = result.scalars().all()
-    
-    # Convert to list of dicts for JSON response
-    violation_list = [
-        {
-            "id": v.id,
-            "username": v.username,
-            "tweet": v.tweet,
-            "policy": v.policy,
-            "rule_id": v.rule_id,
-            "rule_violated": v.rule_violated,
-            "reason": v.reason,
-            "posted_at": v.posted_at
-        }
-        for v in violations
-    ]
-    
-    return violation_list
+    violation_list = [dict(row) for row in result.mappings().all()]
+
+    if not use_cursor:
+        return violation_list
+
+    next_cursor = None
+    if len(violation_list) == limit:
+        last = violation_list[-1]
+        next_cursor = encode_cursor(last["posted_at"], last["id"])
+    return {"violations": violation_list, "next_cursor": next_cursor}
+
+
+
+
+
+@tweet_router.get("/violations/export")
+async def export_violations(
+    format: Literal["ndjson", "csv", "parquet"] = Query("ndjson"),
+    start_date: Optional[datetime.datetime] = Query(None),
+    end_date: Optional[datetime.datetime] = Query(None),
+    username: Optional[str] = Query(None),
+    policy: Optional[str] = Query(None),
+    rule_id: Optional[str] = Query(None)
+):
+    """
+    Stream every violation matching the filters as NDJSON, CSV or Parquet.
+
+    Rows are read through a server-side cursor and written out chunk by chunk,
+    so memory stays flat regardless of the number of exported rows.
+    """
+    conditions = build_violation_conditions(start_date, end_date, username, policy, rule_id)
+    query = select(*VIOLATION_COLUMNS).order_by(Violation.posted_at.desc(), Violation.id.desc())
+    if conditions:
+        query = query.where(and_(*conditions))
+
+    chunks = violations_export.stream_violation_chunks(query)
+    if format == "ndjson":
+        body = violations_export.export_ndjson(chunks)
+    elif format == "csv":
+        body = violations_export.export_csv(chunks, [column.key for column in VIOLATION_COLUMNS])
+    else:
+        if violations_export.pyarrow is None:
+            raise HTTPException(status_code=400, detail="Parquet export requires the pyarrow package")
+        body = violations_export.export_parquet(chunks, violations_export.violations_parquet_schema())
+
+    return StreamingResponse(
+        body,
+        media_type=violations_export.EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="violations.{format}"'}
+    )
+
+
+
+
+
+@tweet_router.get("/violations/search")
+async def search_violations(
+    q: str = Query(..., min_length=1, max_length=500),
+    mode: Literal["keyword", "semantic"] = Query("keyword"),
+    start_date: Optional[datetime.datetime] = Query(None),
+    end_date: Optional[datetime.datetime] = Query(None),
+    username: Optional[str] = Query(None),
+    policy: Optional[str] = Query(None),
+    rule_id: Optional[str] = Query(None),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Search violations by their tweet and reason, best matches first.
+
+    - q: Search text; keyword mode accepts web search syntax ("exact phrase", OR, -excluded)
+    - mode: "keyword" (full-text index) or "semantic" (similar meaning, needs SEMANTIC_SEARCH_ENABLED)
+    - The other filters narrow the results like on GET /violations
+    """
+    conditions = build_violation_conditions(start_date, end_date, username, policy, rule_id)
+    if mode == "keyword":
+        results = await keyword_search(db, q, VIOLATION_COLUMNS, conditions, limit, offset)
+    else:
+        if not semantic_index.available:
+            raise HTTPException(status_code=400, detail="Semantic search requires SEMANTIC_SEARCH_ENABLED=true and the numpy package")
+        results = await semantic_search(db, q, VIOLATION_COLUMNS, conditions, limit, offset)
+
+    return {"query": q, "mode": mode, "results": results, "next_offset": offset + limit if len(results) == limit else None}
+
+
+
+
+
+@tweet_router.get("/violations/stats")
+async def get_violation_stats(
+    group_by: Literal["user", "policy", "rule", "day"] = Query("policy"),
+    start_date: Optional[datetime.date] = Query(None),
+    end_date: Optional[datetime.date] = Query(None),
+    username: Optional[str] = Query(None),
+    policy: Optional[str] = Query(None),
+    rule_id: Optional[str] = Query(None),
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Count violations grouped by user, policy, rule or day, plus the total over the filters.
+
+    Served from the violation_rollups table (one row per day, user, policy and rule), so the
+    cost doesn't grow with the number of stored violations. Dates filter on the posting day.
+    """
+    conditions = build_rollup_conditions(start_date, end_date, username, policy, rule_id)
+    return await violation_stats(db, group_by, conditions, limit)
+
+
+
+
+
+@tweet_router.get("/violations/stats/top-offenders")
+async def get_top_offenders(
+    start_date: Optional[datetime.date] = Query(None),
+    end_date: Optional[datetime.date] = Query(None),
+    policy: Optional[str] = Query(None),
+    rule_id: Optional[str] = Query(None),
+    limit: int = Query(10, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    """Users with the most violations over the filters, from the violation rollups."""
+    conditions = build_rollup_conditions(start_date, end_date, None, policy, rule_id)
+    return await top_offenders(db, conditions, limit)
 
 
 
@@ -165,11 +371,126 @@ async def get_violations(
 
 @tweet_router.get("/scanned-users")
 async def get_scanned_users(db: AsyncSession = Depends(get_db)):
-    """Get list of scanned users and their last scan time."""
+    """Get list of scanned users and their last scan time, per policy."""
     
     query = select(ScannedUser)
     result = await db.execute(query)
     users = result.scalars().all()
     
     # Note: Using last_scan field based on the model definition
-    return [{"username": user.username, "last_scanned_at": user.last_scanned_at} for user in users]
\ No newline at end of file
+    return [{"username": user.username, "policy": user.policy, "last_scanned_at": user.last_scanned_at} for user in users]
+
+
+
+
+
+@tweet_router.get("/jobs")
+async def get_jobs(
+    status: Optional[str] = Query(None),
+    username: Optional[str] = Query(None),
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    """List the most recent scan jobs, optionally filtered by status or username."""
+    query = select(ScanJob).order_by(ScanJob.id.desc()).limit(limit)
+    if status:
+        query = query.where(ScanJob.status == status)
+    if username:
+        query = query.where(ScanJob.username == username)
+
+    result = await db.execute(query)
+    return [job_to_dict(job) for job in result.scalars().all()]
+
+
+
+
+
+@tweet_router.get("/jobs/{job_id}")
+async def get_job(job_id: int, db: AsyncSession = Depends(get_db)):
+    """Get the status and progress of a scan job."""
+    job = await db.get(ScanJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Scan job {job_id} not found")
+    return job_to_dict(job)
+
+
+
+
+
+@tweet_router.post("/watch", status_code=201)
+async def watch_users(input_data: WatchAccountsInput, db: AsyncSession = Depends(get_db)):
+    """Rescan the usernames under a policy every `interval_minutes` (jittered), via the scan job workers."""
+    # Validates the policy exists before anything is watched
+    policy = get_compiled_policies(input_data.requested_policies())
+    watches = await watch_accounts(db, input_data.usernames, policy.name, input_data.interval_minutes * 60)
+    return {"watched": [watch_to_dict(watch) for watch in watches]}
+
+
+
+
+
+@tweet_router.get("/watch")
+async def get_watched_users(policy_name: Optional[str] = Query(None), db: AsyncSession = Depends(get_db)):
+    """List watched accounts with their next scan time and scheduling priority."""
+    query = (
+        select(WatchedAccount, ScannedUser)
+        .outerjoin(ScannedUser, (ScannedUser.username == WatchedAccount.username) & (ScannedUser.policy == WatchedAccount.policy_name))
+        .order_by(WatchedAccount.next_scan_at)
+    )
+    if policy_name:
+        query = query.where(WatchedAccount.policy_name == policy_name)
+
+    result = await db.execute(query)
+    return [watch_to_dict(watch, user) for watch, user in result.all()]
+
+
+
+
+
+@tweet_router.delete("/watch/{username}")
+async def unwatch_user(username: str, policy_name: Optional[str] = Query(None), db: AsyncSession = Depends(get_db)):
+    """Stop monitoring a username, under one policy or all of them."""
+    removed = await unwatch_account(db, username, policy_name)
+    if not removed:
+        raise HTTPException(status_code=404, detail=f"{username} is not being watched")
+    return {"username": username, "removed": removed}
+
+
+
+
+
+def resolve_archive_path(path: str) -> str:
+    """Absolute path of an archive under ARCHIVE_DIR; anything outside it is rejected."""
+    root = os.path.realpath(ARCHIVE_DIR)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise HTTPException(status_code=400, detail=f"Archive '{path}' is outside the archive directory")
+    if not os.path.isfile(resolved):
+        raise HTTPException(status_code=404, detail=f"Archive '{path}' not found")
+    return resolved
+
+
+
+
+
+@tweet_router.post("/ingest", status_code=202)
+async def ingest_archives(input_data: IngestArchivesInput, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+    """Scan archived tweet dumps (NDJSON, optionally gzip, relative to ARCHIVE_DIR) instead of the live API."""
+    policy = get_compiled_policies(input_data.requested_policies())
+    # Persisted for the worker processes (worker.py), which save its progress as it runs
+    run = await enqueue_ingest(db, [resolve_archive_path(path) for path in input_data.paths], policy.name)
+    if not USE_JOB_QUEUE:
+        background_tasks.add_task(run_next_ingest, ingest_worker_id())
+    return ingest_to_dict(run)
+
+
+
+
+
+@tweet_router.get("/ingest/{ingest_id}")
+async def get_ingest(ingest_id: str, db: AsyncSession = Depends(get_db)):
+    """Get the status and progress of an archive ingest."""
+    run = await db.get(ArchiveIngestRun, ingest_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"Archive ingest {ingest_id} not found")
+    return ingest_to_dict(run)
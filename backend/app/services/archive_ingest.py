@@ -0,0 +1,436 @@
+import array
+import asyncio
+import datetime
+import glob
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import time
+import uuid
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.database import AsyncSessionLocal
+from app.core.models import ArchiveIngestRun
+from app.core.config import (
+    ARCHIVE_WORK_DIR, ARCHIVE_PARSE_WORKERS, ARCHIVE_PARTITIONS, ARCHIVE_INGEST_RETENTION_SECONDS, ARCHIVE_INGEST_PROGRESS_SECONDS,
+    JOB_LEASE_SECONDS, JOB_POLL_INTERVAL_SECONDS
+)
+from app.services.policy_registry import CompiledPolicy, policy_registry
+from app.services.scan_scheduler import scheduler
+from app.services.tweets_fetcher import PAGE_SIZE
+from app.services.tweets_processor import process_user_tweets
+from app.services.job_queue import utc_now
+
+
+logger = logging.getLogger(__name__)
+
+# Spool offsets are packed with their file number in the top bits
+OFFSET_BITS = 48
+
+INGEST_QUEUED = "queued"
+INGEST_RUNNING = "running"
+INGEST_COMPLETED = "completed"
+INGEST_FAILED = "failed"
+
+MONTHS = {name: number for number, name in enumerate(("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), 1)}
+
+
+
+
+def parse_archive_time(value: str):
+    """Naive UTC datetime from an ISO timestamp (API v2) or "Wed Oct 10 20:19:24 +0000 2018" (API v1.1 / archives)."""
+    if value[:1].isdigit():
+        parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    else:
+        # Split by hand, strptime costs more than parsing the whole tweet
+        _, month, day, clock, offset, year = value.split()
+        hour, minute, second = clock.split(":")
+        sign = -1 if offset[0] == "-" else 1
+        tz = datetime.timezone(sign * datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5])))
+        parsed = datetime.datetime(int(year), MONTHS[month], int(day), int(hour), int(minute), int(second), tzinfo=tz)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+
+
+def normalize_archive_tweet(raw: dict):
+    """(username, id, created_at ISO, text) of an archived tweet, or None if any of them is missing."""
+    # Twitter's own archive export wraps every tweet in {"tweet": {...}}
+    tweet = raw.get("tweet", raw)
+    username = (
+        tweet.get("username")
+        or tweet.get("author_username")
+        or (tweet.get("user") or {}).get("screen_name")
+        or (tweet.get("author") or {}).get("username")
+    )
+    tweet_id = tweet.get("id_str") or tweet.get("id")
+    text = tweet.get("full_text") or tweet.get("text")
+    created_at = tweet.get("created_at")
+    if not (username and tweet_id and text and created_at):
+        return None
+    return username, str(tweet_id), parse_archive_time(created_at).isoformat(), text
+
+
+
+
+def open_archive(path: str):
+    return gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, "r", encoding="utf-8")
+
+
+
+
+def partition_archive_file(path: str, spool_dir: str, tag: str, partitions: int) -> dict:
+    """
+    Parse one NDJSON (optionally gzip) archive into `partitions` spool files by author.
+
+    Runs in a worker process; each call writes its own spool files, so workers never share one.
+    Spool lines are "username<TAB>[id, created_at, text]". Lines that aren't a usable tweet are
+    counted as skipped, one bad line never fails the file.
+    """
+    spools = {}
+    tweets = skipped = 0
+    try:
+        with open_archive(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    tweet = normalize_archive_tweet(json.loads(line))
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    # Bad JSON, or JSON that isn't a tweet object (wrong types, unparseable date)
+                    tweet = None
+                if tweet is None:
+                    skipped += 1
+                    continue
+                username, tweet_id, created_at, text = tweet
+                partition = zlib.crc32(username.encode()) % partitions
+                spool = spools.get(partition)
+                if spool is None:
+                    spool = spools[partition] = open(os.path.join(spool_dir, f"part-{partition:05d}-{tag}.ndjson"), "w", encoding="utf-8")
+                spool.write(f"{username}\t{json.dumps([tweet_id, created_at, text])}\n")
+                tweets += 1
+    finally:
+        for spool in spools.values():
+            spool.close()
+    return {"path": path, "tweets": tweets, "skipped": skipped}
+
+
+
+
+def index_partition(spool_paths: list) -> dict:
+    """Map each author of a partition to the packed (file number, offset) of their spool lines."""
+    authors = {}
+    for file_number, spool_path in enumerate(spool_paths):
+        offset = 0
+        with open(spool_path, "rb") as f:
+            for line in f:
+                username = line[:line.index(b"\t")].decode("utf-8")
+                positions = authors.get(username)
+                if positions is None:
+                    positions = authors[username] = array.array("Q")
+                positions.append((file_number << OFFSET_BITS) | offset)
+                offset += len(line)
+    return authors
+
+
+
+
+def read_spooled_tweets(spool_paths: list, files: dict, positions) -> list:
+    """Read the tweets at the packed spool positions, opening spool files into `files` as needed."""
+    tweets = []
+    for packed in positions:
+        file_number, offset = packed >> OFFSET_BITS, packed & ((1 << OFFSET_BITS) - 1)
+        f = files.get(file_number)
+        if f is None:
+            f = files[file_number] = open(spool_paths[file_number], "rb")
+        f.seek(offset)
+        tweet_id, created_at, text = json.loads(f.readline().split(b"\t", 1)[1])
+        tweets.append({"id": tweet_id, "text": text, "created_at": datetime.datetime.fromisoformat(created_at)})
+    return tweets
+
+
+
+
+async def spooled_pages(spool_paths: list, positions, page_size: int = PAGE_SIZE):
+    """Yield (tweets, None) pages of one author, read back from the spool files."""
+    files = {}
+    try:
+        for start in range(0, len(positions), page_size):
+            # A page of seeks and reads is one blocking batch, kept off the event loop
+            page = await asyncio.to_thread(read_spooled_tweets, spool_paths, files, positions[start:start + page_size])
+            # Archive pages have no resumable token, replayed scans don't checkpoint
+            yield page, None
+    finally:
+        for f in files.values():
+            f.close()
+
+
+
+
+def new_ingest_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+
+
+class ArchiveIngest:
+    """
+    Backfill scan of archived tweet dumps through the regular classification pipeline.
+
+    Archives are decompressed and parsed by a process pool into partitions by author (bounded
+    memory regardless of the archive size), then each partition's authors are scanned
+    concurrently, within the scheduler's user slots, from their spooled tweets.
+    """
+
+    def __init__(self, paths: list, policy: CompiledPolicy, workers: int = ARCHIVE_PARSE_WORKERS,
+                 partitions: int = ARCHIVE_PARTITIONS, work_dir: str = ARCHIVE_WORK_DIR, ingest_id: str = None):
+        self.id = ingest_id or new_ingest_id()
+        self.paths = paths
+        self.policy = policy
+        self.workers = max(1, workers)
+        self.partitions = max(1, partitions)
+        self.spool_dir = os.path.join(work_dir, self.id)
+        self.status = INGEST_RUNNING
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self.files_parsed = 0
+        self.tweets_parsed = 0
+        self.tweets_skipped = 0
+        self.partitions_done = 0
+        self.users_done = 0
+        self.users_failed = 0
+        self.tweets_classified = 0
+        self.violations_found = 0
+
+    async def parse(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        # Forking the running server (event loop, driver threads) isn't safe, workers start from a clean forkserver
+        context = multiprocessing.get_context("forkserver")
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(self.paths)), mp_context=context) as pool:
+            futures = [
+                loop.run_in_executor(pool, partition_archive_file, path, self.spool_dir, f"{number:05d}", self.partitions)
+                for number, path in enumerate(self.paths)
+            ]
+            for future in asyncio.as_completed(futures):
+                result = await future
+                self.files_parsed += 1
+                self.tweets_parsed += result["tweets"]
+                self.tweets_skipped += result["skipped"]
+                logger.info("Parsed archive file", extra={"ingest_id": self.id, **result})
+
+    async def scan_user(self, username: str, spool_paths: list, positions):
+        async def record_progress(next_token, pages, tweets_count, violations_count, session):
+            self.tweets_classified += tweets_count
+            self.violations_found += violations_count
+
+        async with scheduler.user_slot():
+            try:
+                await process_user_tweets(
+                    username, self.policy,
+                    on_checkpoint=record_progress,
+                    pages=spooled_pages(spool_paths, positions)
+                )
+                self.users_done += 1
+            except Exception:
+                self.users_failed += 1
+                logger.exception("Archive scan of a user failed", extra={"ingest_id": self.id, "username": username})
+
+    async def classify(self):
+        for partition in range(self.partitions):
+            spool_paths = sorted(glob.glob(os.path.join(self.spool_dir, f"part-{partition:05d}-*.ndjson")))
+            if spool_paths:
+                authors = await asyncio.to_thread(index_partition, spool_paths)
+                await asyncio.gather(*(self.scan_user(username, spool_paths, positions) for username, positions in authors.items()))
+            self.partitions_done += 1
+
+    async def run(self):
+        """Parse then classify every archive, recording progress on the instance; the spool is removed at the end."""
+        logger.info("Archive ingest started", extra={"ingest_id": self.id, "files": len(self.paths), "policy": self.policy.name})
+        try:
+            await self.parse()
+            await self.classify()
+            self.status = INGEST_COMPLETED
+        except Exception as e:
+            self.status = INGEST_FAILED
+            self.error = str(e)
+            logger.exception("Archive ingest failed", extra={"ingest_id": self.id})
+        finally:
+            self.finished_at = time.time()
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+        logger.info("Archive ingest finished", extra=self.stats())
+
+    def stats(self) -> dict:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "ingest_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "policy": self.policy.name,
+            "files": len(self.paths),
+            "files_parsed": self.files_parsed,
+            "tweets_parsed": self.tweets_parsed,
+            "tweets_skipped": self.tweets_skipped,
+            "partitions_done": self.partitions_done,
+            "partitions": self.partitions,
+            "users_done": self.users_done,
+            "users_failed": self.users_failed,
+            "tweets_classified": self.tweets_classified,
+            "violations_found": self.violations_found,
+            "elapsed_seconds": round(elapsed, 1),
+            "tweets_per_second": round(self.tweets_classified / elapsed, 1) if elapsed else 0.0
+        }
+
+
+
+
+def ingest_to_dict(run: ArchiveIngestRun) -> dict:
+    """An ingest's status and the progress its worker saved last."""
+    progress = json.loads(run.progress) if run.progress else {}
+    return {
+        **progress,
+        "ingest_id": run.id,
+        "status": run.status,
+        "error": run.error,
+        "policy": run.policy_name,
+        "files": len(json.loads(run.paths)),
+        "created_at": run.created_at,
+        "updated_at": run.updated_at
+    }
+
+
+
+
+async def enqueue_ingest(session: AsyncSession, paths: list, policy_name: str) -> ArchiveIngestRun:
+    """Persist a queued ingest for the workers, dropping finished ones older than ARCHIVE_INGEST_RETENTION_SECONDS."""
+    now = utc_now()
+    await session.execute(
+        delete(ArchiveIngestRun).where(
+            ArchiveIngestRun.status.in_((INGEST_COMPLETED, INGEST_FAILED)),
+            ArchiveIngestRun.updated_at < now - datetime.timedelta(seconds=ARCHIVE_INGEST_RETENTION_SECONDS)
+        )
+    )
+    run = ArchiveIngestRun(
+        id=new_ingest_id(),
+        paths=json.dumps(paths),
+        policy_name=policy_name,
+        status=INGEST_QUEUED,
+        created_at=now,
+        updated_at=now
+    )
+    session.add(run)
+    await session.commit()
+    return run
+
+
+
+
+async def lease_next_ingest(session: AsyncSession, worker_id: str):
+    """
+    Claim the oldest queued ingest for this worker, or return None.
+
+    An ingest whose worker stopped renewing its lease is failed rather than run again: the
+    violations it already stored would be stored twice.
+    """
+    now = utc_now()
+    result = await session.execute(
+        select(ArchiveIngestRun)
+        .where(ArchiveIngestRun.status == INGEST_RUNNING, ArchiveIngestRun.leased_until < now)
+        .with_for_update(skip_locked=True)
+    )
+    for stale in result.scalars().all():
+        stale.status, stale.error, stale.leased_until, stale.updated_at = INGEST_FAILED, f"Worker {stale.worker_id} stopped while ingesting", None, now
+        shutil.rmtree(os.path.join(ARCHIVE_WORK_DIR, stale.id), ignore_errors=True)
+
+    result = await session.execute(
+        select(ArchiveIngestRun)
+        .where(ArchiveIngestRun.status == INGEST_QUEUED)
+        .order_by(ArchiveIngestRun.created_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    run = result.scalars().first()
+    if run is not None:
+        run.status = INGEST_RUNNING
+        run.worker_id = worker_id
+        run.leased_until = now + datetime.timedelta(seconds=JOB_LEASE_SECONDS)
+        run.updated_at = now
+    await session.commit()
+    return run
+
+
+
+
+async def save_ingest_progress(ingest_id: str, worker_id: str, status: str, error: str = None, progress: dict = None):
+    """Store an ingest's status and counters, renewing the lease while it runs."""
+    now = utc_now()
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(ArchiveIngestRun)
+            .where(ArchiveIngestRun.id == ingest_id, ArchiveIngestRun.worker_id == worker_id)
+            .values(
+                status=status,
+                error=error,
+                progress=json.dumps(progress) if progress else None,
+                leased_until=now + datetime.timedelta(seconds=JOB_LEASE_SECONDS) if status == INGEST_RUNNING else None,
+                updated_at=now
+            )
+        )
+        await session.commit()
+
+
+
+
+async def run_ingest(run: ArchiveIngestRun, worker_id: str, work_dir: str = ARCHIVE_WORK_DIR):
+    """Run an ingest leased by `worker_id`, saving its progress every ARCHIVE_INGEST_PROGRESS_SECONDS."""
+    try:
+        policy = policy_registry.get_many(run.policy_name)
+    except Exception as e:
+        await save_ingest_progress(run.id, worker_id, INGEST_FAILED, str(e))
+        return
+
+    ingest = ArchiveIngest(json.loads(run.paths), policy, work_dir=work_dir, ingest_id=run.id)
+    task = asyncio.create_task(ingest.run())
+    while not task.done():
+        await asyncio.wait([task], timeout=ARCHIVE_INGEST_PROGRESS_SECONDS)
+        await save_ingest_progress(ingest.id, worker_id, ingest.status, ingest.error, ingest.stats())
+
+
+
+
+def ingest_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:ingest"
+
+
+
+
+async def run_next_ingest(worker_id: str) -> bool:
+    """Lease and run the oldest queued ingest; False if there was none."""
+    async with AsyncSessionLocal() as session:
+        run = await lease_next_ingest(session, worker_id)
+    if run is None:
+        return False
+    await run_ingest(run, worker_id)
+    return True
+
+
+
+
+async def run_ingest_worker(stop_event: asyncio.Event):
+    """Run queued archive ingests, one at a time, until `stop_event` is set."""
+    worker_id = ingest_worker_id()
+    while not stop_event.is_set():
+        if not await run_next_ingest(worker_id):
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=JOB_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,101 @@
+import asyncio
+import importlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from app.core.config import CPU_POOL_WORKERS, CPU_POOL_CHUNK_SIZE, CPU_POOL_MIN_ITEMS
+from app.core.metrics import CPU_POOL_TASKS
+
+
+logger = logging.getLogger(__name__)
+
+# Modules defining the stage functions, imported by every worker when it starts
+STAGE_MODULES = ("app.services.tweets_processor", "app.services.prefilter", "app.services.openai_predictor")
+
+
+
+
+def import_stage_modules():
+    for module in STAGE_MODULES:
+        importlib.import_module(module)
+
+
+
+
+def noop():
+    return None
+
+
+
+
+class CpuPool:
+    """
+    Optional process pool for the CPU-heavy stages of a scan (normalization, hashing, pre-filter
+    models, large response parsing), leaving only network I/O to the event loop.
+
+    Work is split into chunks queued to the worker processes, so a large page spreads over every
+    core. Without workers (the default), or for batches too small to be worth shipping, the same
+    functions run inline. Stage functions must be module-level so they can be sent to a worker.
+    """
+
+    def __init__(self, workers: int, chunk_size: int, min_items: int):
+        self.workers = workers
+        self.chunk_size = max(1, chunk_size)
+        self.min_items = min_items
+        self.executor = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # Forking the running server (event loop, driver threads) isn't safe, workers start from a clean forkserver
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=import_stage_modules
+            )
+            logger.info("CPU pool started", extra={"workers": self.workers})
+        return self.executor
+
+    async def start(self):
+        """Start every worker now, so the first scans don't pay for process startup and imports."""
+        if self.enabled:
+            executor = self._executor()
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(executor, noop) for _ in range(self.workers)))
+
+    async def run(self, func, *args):
+        """Return func(*args), computed in a worker process when the pool is enabled."""
+        if not self.enabled:
+            return func(*args)
+        CPU_POOL_TASKS.inc(stage=func.__name__)
+        return await asyncio.get_running_loop().run_in_executor(self._executor(), func, *args)
+
+    async def map_chunks(self, func, items: list, *args) -> list:
+        """
+        Return func(items, *args), where `func` maps a list to one result per item, computed over
+        chunks of `items` spread across the workers.
+        """
+        if not self.enabled or len(items) < self.min_items:
+            return func(items, *args)
+        # Even chunks over the workers, within [min_items, chunk_size]
+        size = min(self.chunk_size, max(self.min_items, -(-len(items) // self.workers)))
+        chunks = [items[start:start + size] for start in range(0, len(items), size)]
+        results = await asyncio.gather(*(self.run(func, chunk, *args) for chunk in chunks))
+        return [result for chunk_results in results for result in chunk_results]
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "workers": self.workers, "chunk_size": self.chunk_size, "min_items": self.min_items}
+
+
+
+
+# Process-wide pool, started on first use
+cpu_pool = CpuPool(CPU_POOL_WORKERS, CPU_POOL_CHUNK_SIZE, CPU_POOL_MIN_ITEMS)
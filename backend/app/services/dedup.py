@@ -0,0 +1,214 @@
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from app.core.config import DEDUP_NEAR_DUPLICATES, DEDUP_MAX_HAMMING_DISTANCE, DEDUP_MAX_ENTRIES, DEDUP_RESULT_TTL_SECONDS, USE_VERDICT_CACHE
+
+
+URL_PATTERN = re.compile(r"https?://\S+|www\.\S+", re.IGNORECASE)
+MENTION_PATTERN = re.compile(r"(^|\s)@\w+")
+RETWEET_PREFIX = re.compile(r"^rt\s+:?\s*")
+NON_ALPHANUMERIC = re.compile(r"[^a-z0-9 ]")
+
+# SimHash is unreliable on very short texts, where one word flips many bits
+NEAR_DUPLICATE_MIN_TOKENS = 6
+SHINGLE_SIZE = 4            # Character shingles: word-level features are too coarse for tweet-length texts
+SIMHASH_BANDS = 4           # 4 bands of 16 bits: within 3 bits, at least one band matches exactly
+
+
+
+
+def normalize_for_dedup(text: str) -> str:
+    """Normalize a tweet for duplicate detection: drop URLs and mentions, fold case and whitespace."""
+    text = URL_PATTERN.sub(" ", text.lower())
+    text = MENTION_PATTERN.sub(" ", text)
+    text = " ".join(text.split())
+    return RETWEET_PREFIX.sub("", text)
+
+
+
+
+def dedup_key(normalized: str) -> str:
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+
+
+def simhash(normalized: str) -> int:
+    """64-bit SimHash over character shingles, ignoring punctuation."""
+    text = NON_ALPHANUMERIC.sub("", normalized)
+    weights = [0] * 64
+    for start in range(max(1, len(text) - SHINGLE_SIZE + 1)):
+        token = text[start:start + SHINGLE_SIZE]
+        token_hash = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if token_hash >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+
+
+def text_features(text: str, near_duplicates: bool) -> tuple:
+    """(dedup key, SimHash or None) of a text, the CPU-heavy part of DedupScope.canonical_key."""
+    normalized = normalize_for_dedup(text)
+    if not near_duplicates or len(normalized.split()) < NEAR_DUPLICATE_MIN_TOKENS:
+        return dedup_key(normalized), None
+    return dedup_key(normalized), simhash(normalized)
+
+
+
+
+class DedupScope:
+    """
+    Collapses duplicate texts across every scan running in this process.
+
+    Texts that normalize to the same key (or, optionally, whose SimHash is within
+    DEDUP_MAX_HAMMING_DISTANCE of a recent text) share a single classification: the first
+    scan to see a text classifies it, concurrent scans await that result, and with
+    `keep_results` finished results are reused by later scans for `result_ttl` seconds.
+    """
+
+    def __init__(self, near_duplicates: bool, max_distance: int, max_entries: int,
+                 result_ttl: float = DEDUP_RESULT_TTL_SECONDS, keep_results: bool = True):
+        self.near_duplicates = near_duplicates
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.result_ttl = result_ttl
+        self.keep_results = keep_results
+        self.results = OrderedDict()            # (policy_hash, key) -> asyncio.Future, done or in flight
+        self.finished_at = {}                   # (policy_hash, key) -> monotonic time its future got a result
+        self.fingerprints = OrderedDict()       # key -> simhash of its representative text
+        self.bands = [{} for _ in range(SIMHASH_BANDS)]
+        self.collapsed = 0
+
+    def _band_values(self, fingerprint: int) -> list:
+        return [fingerprint >> (16 * band) & 0xFFFF for band in range(SIMHASH_BANDS)]
+
+    def _remember_fingerprint(self, key: str, fingerprint: int):
+        self.fingerprints[key] = fingerprint
+        for band, value in enumerate(self._band_values(fingerprint)):
+            self.bands[band].setdefault(value, set()).add(key)
+
+        while len(self.fingerprints) > self.max_entries:
+            old_key, old_fingerprint = self.fingerprints.popitem(last=False)
+            for band, value in enumerate(self._band_values(old_fingerprint)):
+                keys = self.bands[band].get(value)
+                if keys:
+                    keys.discard(old_key)
+                    if not keys:
+                        del self.bands[band][value]
+
+    def canonical_key(self, text: str, features: tuple = None) -> str:
+        """Key shared by all duplicates of `text`, from its text_features if already computed."""
+        if features is not None:
+            key, fingerprint = features
+            if fingerprint is None or key in self.fingerprints:
+                return key
+        else:
+            normalized = normalize_for_dedup(text)
+            key = dedup_key(normalized)
+            if not self.near_duplicates or key in self.fingerprints or len(normalized.split()) < NEAR_DUPLICATE_MIN_TOKENS:
+                return key
+            fingerprint = simhash(normalized)
+
+        for band, value in enumerate(self._band_values(fingerprint)):
+            for candidate in self.bands[band].get(value, ()):
+                if bin(self.fingerprints[candidate] ^ fingerprint).count("1") <= self.max_distance:
+                    return candidate
+
+        self._remember_fingerprint(key, fingerprint)
+        return key
+
+    def _forget(self, result_key: tuple):
+        self.finished_at.pop(result_key, None)
+        return self.results.pop(result_key, None)
+
+    def _is_expired(self, result_key: tuple, now: float) -> bool:
+        finished_at = self.finished_at.get(result_key)
+        return finished_at is not None and now - finished_at > self.result_ttl
+
+    def _trim_results(self):
+        # Only completed entries are evicted, in-flight ones still have waiters
+        while len(self.results) > self.max_entries:
+            result_key, future = next(iter(self.results.items()))
+            if not future.done():
+                break
+            self._forget(result_key)
+
+
+    async def classify(self, texts: dict, policy_hash: str, classify_texts, features: dict = None) -> dict:
+        """
+        Classify texts (id -> text) with one call per distinct key, returning id -> verdict.
+
+        `classify_texts(list_of_texts)` is only called for keys no other scan has classified or
+        is classifying right now; those keys' verdicts are shared back to every requester, and an
+        exception it raises is raised to every requester as well.
+        `features` (id -> text_features) skips recomputing them.
+        """
+        groups = OrderedDict()
+        for text_id, text in texts.items():
+            groups.setdefault(self.canonical_key(text, features.get(text_id) if features else None), []).append(text_id)
+
+        loop = asyncio.get_running_loop()
+        owned = {}
+        waiting = {}
+        now = time.monotonic()
+        for key, text_ids in groups.items():
+            result_key = (policy_hash, key)
+            if self._is_expired(result_key, now):
+                self._forget(result_key)
+            if result_key in self.results:
+                self.results.move_to_end(result_key)
+                # Held on to, a failed owner drops its entry from `results` before we await it
+                waiting[key] = self.results[result_key]
+                self.collapsed += len(text_ids)
+            else:
+                self.results[result_key] = loop.create_future()
+                owned[key] = texts[text_ids[0]]
+                self.collapsed += len(text_ids) - 1
+
+        owned_verdicts = {}
+        if owned:
+            try:
+                verdicts = await classify_texts(list(owned.values()))
+            except Exception as e:
+                for key in owned:
+                    self._forget((policy_hash, key)).set_exception(e)
+                raise
+
+            owned_verdicts = dict(zip(owned, verdicts))
+            finished_at = time.monotonic()
+            for key, verdict in owned_verdicts.items():
+                result_key = (policy_hash, key)
+                self.results[result_key].set_result(verdict)
+                if not self.keep_results or verdict is None or verdict.get("violation") not in ("YES", "NO"):
+                    # Failed and unknown verdicts aren't shared with later scans, they should retry;
+                    # waiting scans hold the future and still get the result
+                    self._forget(result_key)
+                else:
+                    self.finished_at[result_key] = finished_at
+            self._trim_results()
+
+        shared = {}
+        for key, text_ids in groups.items():
+            if key in owned_verdicts:
+                verdict = owned_verdicts[key]
+            else:
+                # The owner's failure (e.g. a rate limit) is raised here too, so this scan stops and
+                # resumes like the owner's instead of recording the text as unclassified
+                verdict = await asyncio.shield(waiting[key])
+            for text_id in text_ids:
+                shared[text_id] = verdict
+        return shared
+
+
+    def stats(self) -> dict:
+        return {"entries": len(self.results), "collapsed": self.collapsed, "near_duplicates": self.near_duplicates}
+
+
+
+
+# Process-wide scope, shared by every user scanned in this process; without the verdict cache,
+# verdicts are only shared between concurrent scans, never reused by later ones
+dedup_scope = DedupScope(DEDUP_NEAR_DUPLICATES, DEDUP_MAX_HAMMING_DISTANCE, DEDUP_MAX_ENTRIES, keep_results=USE_VERDICT_CACHE)
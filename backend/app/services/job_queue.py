@@ -0,0 +1,286 @@
+import asyncio
+import datetime
+import logging
+import os
+import socket
+from openai import RateLimitError
+from sqlalchemy import select, update, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.database import AsyncSessionLocal
+from app.core.models import ScanJob
+from app.core.config import JOB_LEASE_SECONDS, JOB_HEARTBEAT_SECONDS, JOB_MAX_ATTEMPTS, JOB_POLL_INTERVAL_SECONDS, WORKER_CONCURRENCY
+from app.core.metrics import SCAN_JOBS
+from app.services.tweets_processor import process_user_tweets
+from app.services.tweets_fetcher import TooManyRequests
+from app.services.llm_backends import retry_after_seconds
+from app.services.policy_registry import policy_registry
+
+
+logger = logging.getLogger(__name__)
+
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+
+
+
+
+class LeaseLost(Exception):
+    """The job's lease expired and it was leased again, by this worker or another one."""
+
+
+
+
+def utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+
+
+
+
+def job_to_dict(job: ScanJob) -> dict:
+    return {
+        "id": job.id,
+        "username": job.username,
+        "policy": job.policy_name,
+        "status": job.status,
+        "attempts": job.attempts,
+        "progress": {
+            "pages_done": job.pages_done,
+            "tweets_processed": job.tweets_processed,
+            "violations_found": job.violations_found
+        },
+        "error": job.error,
+        "not_before": job.not_before,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at
+    }
+
+
+
+
+def new_scan_job(username: str, policy_name: str, now: datetime.datetime) -> ScanJob:
+    return ScanJob(
+        username=username,
+        policy_name=policy_name,
+        status=JOB_QUEUED,
+        attempts=0,
+        pages_done=0,
+        tweets_processed=0,
+        violations_found=0,
+        created_at=now,
+        updated_at=now
+    )
+
+
+
+
+async def enqueue_scan_jobs(session: AsyncSession, usernames: list, policy_name: str) -> list:
+    """Persist one queued scan job per username."""
+    now = utc_now()
+    jobs = [new_scan_job(username, policy_name, now) for username in usernames]
+    session.add_all(jobs)
+    await session.commit()
+    return jobs
+
+
+
+
+async def lease_next_job(session: AsyncSession, worker_id: str):
+    """
+    Claim the oldest runnable job for this worker, or return None.
+
+    Runnable means queued (and past its not_before), or running with an expired lease (its worker died). Rows locked by
+    other workers are skipped, so any number of workers can poll the same table.
+    """
+    while True:
+        now = utc_now()
+        result = await session.execute(
+            select(ScanJob)
+            .where(or_(
+                and_(ScanJob.status == JOB_QUEUED, or_(ScanJob.not_before.is_(None), ScanJob.not_before <= now)),
+                and_(ScanJob.status == JOB_RUNNING, ScanJob.leased_until < now)
+            ))
+            .order_by(ScanJob.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        job = result.scalars().first()
+        if job is None:
+            return None
+
+        job.updated_at = now
+        if job.attempts >= JOB_MAX_ATTEMPTS:
+            # Crashed too many times, stop handing it out
+            job.status = JOB_FAILED
+            job.error = job.error or f"Gave up after {job.attempts} attempts"
+            await session.commit()
+            continue
+
+        job.status = JOB_RUNNING
+        job.attempts += 1
+        job.worker_id = worker_id
+        job.leased_until = now + datetime.timedelta(seconds=JOB_LEASE_SECONDS)
+        job.not_before = None
+        await session.commit()
+        return job
+
+
+
+
+def rate_limit_delay(error: Exception):
+    """Seconds until the upstream that rate limited a scan accepts requests again, None for other errors."""
+    if isinstance(error, TooManyRequests):
+        return error.retry_after
+    if isinstance(error, RateLimitError):
+        return retry_after_seconds(error)
+    return None
+
+
+
+
+async def update_owned_job(session: AsyncSession, job_id: int, worker_id: str, **values) -> bool:
+    """
+    Update the job and renew its lease, in the session's transaction, if `worker_id` still holds it.
+
+    Returns False, updating nothing, once the job was leased again.
+    """
+    now = utc_now()
+    values.setdefault("leased_until", now + datetime.timedelta(seconds=JOB_LEASE_SECONDS))
+    result = await session.execute(
+        update(ScanJob)
+        .where(ScanJob.id == job_id, ScanJob.worker_id == worker_id, ScanJob.status == JOB_RUNNING)
+        .values(updated_at=now, **values)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+
+
+async def keep_lease(job_id: int, worker_id: str):
+    """Renew the job's lease every JOB_HEARTBEAT_SECONDS, returning only once it was lost."""
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        try:
+            async with AsyncSessionLocal() as session:
+                owned = await update_owned_job(session, job_id, worker_id)
+                await session.commit()
+        except Exception:
+            # The lease outlives a missed heartbeat, try again on the next one
+            logger.exception("Job lease renewal failed", extra={"job_id": job_id, "worker": worker_id})
+            continue
+        if not owned:
+            return
+
+
+
+
+async def run_job(job_id: int, worker_id: str):
+    """
+    Run a job leased by `worker_id`, checkpointing after every committed page so a crash resumes from there.
+
+    A heartbeat renews the lease while the scan runs, and every commit first checks the lease is
+    still held. Once it is lost (the worker stalled past it and the job was leased again) the scan
+    is stopped without committing anything more.
+    """
+    async with AsyncSessionLocal() as session:
+        job = await session.get(ScanJob, job_id)
+    logger.info("Running scan job", extra={"job_id": job.id, "username": job.username, "attempt": job.attempts})
+
+    async def record_checkpoint(next_token, pages, tweets_count, violations_count, session):
+        # Progress, committed together with the violations of those pages
+        owned = await update_owned_job(
+            session, job_id, worker_id,
+            next_token=next_token,
+            pages_done=ScanJob.pages_done + pages,
+            tweets_processed=ScanJob.tweets_processed + tweets_count,
+            violations_found=ScanJob.violations_found + violations_count
+        )
+        if not owned:
+            raise LeaseLost(f"Job {job_id} is no longer leased by {worker_id}")
+
+    tasks = []
+    try:
+        # Several policies are stored comma-separated and evaluated in one pass
+        policy = policy_registry.get_many(job.policy_name)
+        # A retried job resumes from the user's scan checkpoint, committed with each page's violations.
+        # The scan borrows short-lived sessions, no connection is held while it waits on the APIs
+        scan = asyncio.create_task(process_user_tweets(job.username, policy, on_checkpoint=record_checkpoint))
+        heartbeat = asyncio.create_task(keep_lease(job_id, worker_id))
+        tasks = [scan, heartbeat]
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        if not scan.done():
+            raise LeaseLost(f"Job {job_id} is no longer leased by {worker_id}")
+        scan.result()
+        failure = retry_after = None
+    except LeaseLost:
+        logger.warning("Lost the lease of a running job, leaving it to its new worker", extra={"job_id": job_id, "worker": worker_id})
+        SCAN_JOBS.inc(outcome="lease_lost")
+        return
+    except Exception as e:
+        retry_after = rate_limit_delay(e)
+        if retry_after is None:
+            logger.exception("Scan job failed", extra={"job_id": job.id, "username": job.username})
+        else:
+            logger.warning("Scan job rate limited, requeued", extra={"job_id": job.id, "username": job.username, "retry_after": retry_after})
+        failure = e
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if failure is None:
+        outcome = JOB_COMPLETED
+        values = {"status": JOB_COMPLETED, "next_token": None, "error": None}
+    elif retry_after is not None:
+        # Not the job's fault: queued again once the upstream window resets, without using up an attempt
+        outcome = "rate_limited"
+        values = {
+            "status": JOB_QUEUED,
+            "attempts": ScanJob.attempts - 1,
+            "not_before": utc_now() + datetime.timedelta(seconds=retry_after),
+            "error": str(failure)
+        }
+    else:
+        # Progress recorded for a commit that never happened was rolled back with it
+        outcome = "retried" if job.attempts < JOB_MAX_ATTEMPTS else JOB_FAILED
+        values = {"status": JOB_QUEUED if job.attempts < JOB_MAX_ATTEMPTS else JOB_FAILED, "error": str(failure)}
+    async with AsyncSessionLocal() as session:
+        owned = await update_owned_job(session, job_id, worker_id, leased_until=None, **values)
+        await session.commit()
+
+    SCAN_JOBS.inc(outcome=outcome if owned else "lease_lost")
+    if not owned:
+        logger.warning("Lost the lease of a finished job, leaving it to its new worker", extra={"job_id": job_id, "worker": worker_id})
+    elif failure is None:
+        logger.info("Completed scan job", extra={"job_id": job.id, "username": job.username})
+
+
+
+
+async def worker_loop(worker_id: str, stop_event: asyncio.Event):
+    """Lease and run jobs one at a time until `stop_event` is set."""
+    while not stop_event.is_set():
+        async with AsyncSessionLocal() as session:
+            job = await lease_next_job(session, worker_id)
+
+        if job is None:
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=JOB_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        await run_job(job.id, worker_id)
+
+
+
+
+async def run_worker(concurrency: int = WORKER_CONCURRENCY, stop_event: asyncio.Event = None):
+    """Run `concurrency` job loops in this process; scale out by starting more processes."""
+    stop_event = stop_event or asyncio.Event()
+    worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+    logger.info("Worker started", extra={"worker": worker_prefix, "concurrency": concurrency})
+    await asyncio.gather(*(worker_loop(f"{worker_prefix}:{n}", stop_event) for n in range(concurrency)))
@@ -0,0 +1,278 @@
+import asyncio
+import datetime
+import email.utils
+import json
+import logging
+import os
+import time
+from collections import deque
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, RateLimitError
+from app.core.config import (
+    OPENAI_API_KEY, OPENAI_BASE_URL, LLM_BACKENDS, LLM_MODEL, LLM_REQUEST_TIMEOUT_SECONDS,
+    LLM_HEDGE_ENABLED, LLM_HEDGE_MIN_DELAY_SECONDS, LLM_BACKEND_FAILURE_THRESHOLD, LLM_BACKEND_COOLDOWN_SECONDS
+)
+from app.core.metrics import LLM_BACKEND_SECONDS, LLM_BACKEND_ERRORS, LLM_COST_DOLLARS, LLM_FAILOVERS, LLM_HEDGES, RATE_LIMIT_HITS
+from app.services.scan_scheduler import RateGovernor, openai_governor, process_share
+
+
+logger = logging.getLogger(__name__)
+
+# Recent request latencies kept per backend, for its p95
+LATENCY_WINDOW = 200
+
+# Below this many samples the p95 is too noisy to time a hedge on
+HEDGE_MIN_SAMPLES = 20
+
+# gpt-4o-mini list prices, in dollars per million tokens
+DEFAULT_INPUT_COST_PER_1M = 0.15
+DEFAULT_OUTPUT_COST_PER_1M = 0.60
+
+
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+
+
+def is_transient(error: Exception) -> bool:
+    """Errors another backend (or a later retry) may not hit: rate limits, 5xx, timeouts and connection failures."""
+    if isinstance(error, (RateLimitError, APIConnectionError, ConnectionError, TimeoutError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+
+
+def retry_after_seconds(error: RateLimitError, default: float = 5.0) -> float:
+    """Seconds a 429 asked to wait: Retry-After in seconds or as an HTTP-date, `default` if missing or unparseable."""
+    value = error.response.headers.get("retry-after") if error.response is not None else None
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.UTC)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.UTC)).total_seconds())
+
+
+
+
+class LLMBackend:
+    """One OpenAI-compatible chat completions endpoint (OpenAI, or a local vLLM / llama.cpp server) and its health."""
+
+    def __init__(self, name: str, client, model: str, governor: RateGovernor = None,
+                 input_cost_per_1m: float = 0.0, output_cost_per_1m: float = 0.0):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.governor = governor
+        self.input_cost_per_1m = input_cost_per_1m
+        self.output_cost_per_1m = output_cost_per_1m
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.cost = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def latency_percentile(self, q: float):
+        """Nearest-rank percentile of the recent latencies, or None without enough samples."""
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+    def record_failure(self, reason: str, cooldown: float = None):
+        self.errors += 1
+        self.consecutive_failures += 1
+        LLM_BACKEND_ERRORS.inc(backend=self.name, reason=reason)
+        # Rate limits take the backend out right away, other errors once they repeat
+        if cooldown is not None or self.consecutive_failures >= LLM_BACKEND_FAILURE_THRESHOLD:
+            self.unhealthy_until = time.monotonic() + (cooldown if cooldown is not None else LLM_BACKEND_COOLDOWN_SECONDS)
+            logger.warning("LLM backend marked unhealthy", extra={"backend": self.name, "reason": reason})
+
+    def record_success(self, seconds: float, response):
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.latencies.append(seconds)
+        usage = getattr(response, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        if isinstance(prompt_tokens, int) and isinstance(completion_tokens, int):
+            cost = (prompt_tokens * self.input_cost_per_1m + completion_tokens * self.output_cost_per_1m) / 1_000_000
+            self.cost += cost
+            LLM_COST_DOLLARS.inc(cost, backend=self.name)
+
+    async def complete(self, messages: list, expected_output_tokens: int, **options):
+        """Send one chat completion to this backend, within its own rate limits."""
+        if self.governor:
+            prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+            await self.governor.acquire(prompt_tokens + expected_output_tokens)
+
+        self.requests += 1
+        start = time.perf_counter()
+        try:
+            response = await self.client.chat.completions.create(model=self.model, messages=messages, **options)
+        except RateLimitError as e:
+            # Hold back every caller of this backend until the provider window resets
+            pause = retry_after_seconds(e)
+            if self.governor:
+                self.governor.pause(pause)
+            RATE_LIMIT_HITS.inc(upstream=self.name)
+            self.record_failure("rate_limit", cooldown=pause)
+            raise
+        except Exception as e:
+            if is_transient(e):
+                self.record_failure(type(e).__name__)
+            raise
+        finally:
+            LLM_BACKEND_SECONDS.observe(time.perf_counter() - start, backend=self.name)
+
+        self.record_success(time.perf_counter() - start, response)
+        return response
+
+    def stats(self) -> dict:
+        p50, p95 = self.latency_percentile(50), self.latency_percentile(95)
+        return {
+            "name": self.name,
+            "model": self.model,
+            "healthy": self.healthy,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_p50_seconds": round(p50, 4) if p50 is not None else None,
+            "latency_p95_seconds": round(p95, 4) if p95 is not None else None,
+            "cost_dollars": round(self.cost, 6)
+        }
+
+
+
+
+class LLMRouter:
+    """
+    Sends each completion to the healthiest backend, failing over to the next on 429/5xx/timeouts.
+
+    With hedging on, a request still running after the backend's p95 latency is also sent to
+    the next backend and the first answer wins, so one degraded backend doesn't stall a scan.
+    """
+
+    def __init__(self, backends: list, hedge: bool = LLM_HEDGE_ENABLED, hedge_min_delay: float = LLM_HEDGE_MIN_DELAY_SECONDS):
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+
+    def candidates(self) -> list:
+        """Healthy backends in configured order, then unhealthy ones by the time they recover."""
+        healthy = [backend for backend in self.backends if backend.healthy]
+        unhealthy = sorted((backend for backend in self.backends if not backend.healthy), key=lambda backend: backend.unhealthy_until)
+        return healthy + unhealthy
+
+    def hedge_delay(self, backend: LLMBackend) -> float:
+        p95 = backend.latency_percentile(95)
+        return max(self.hedge_min_delay, p95 or 0.0)
+
+    async def complete(self, messages: list, expected_output_tokens: int, **options):
+        """Return the first successful completion; raise the last transient error if every backend failed."""
+        candidates = self.candidates()
+        running = {}
+        hedged = False
+        last_error = None
+
+        def launch(backend):
+            task = asyncio.create_task(backend.complete(messages, expected_output_tokens, **options))
+            running[task] = backend
+
+        primary = candidates.pop(0)
+        launch(primary)
+        try:
+            while running:
+                # At most one hedge per request, timed on the first backend's latency
+                can_hedge = self.hedge and not hedged and candidates and len(running) == 1
+                timeout = self.hedge_delay(next(iter(running.values()))) if can_hedge else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    hedged = True
+                    LLM_HEDGES.inc(outcome="sent")
+                    launch(candidates.pop(0))
+                    continue
+
+                for task in done:
+                    backend = running.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        if hedged:
+                            LLM_HEDGES.inc(outcome="primary_won" if backend is primary else "hedge_won")
+                        return task.result()
+                    if not is_transient(error):
+                        raise error
+                    last_error = error
+                    if candidates and not running:
+                        LLM_FAILOVERS.inc(backend=backend.name)
+                        logger.warning("LLM backend failed, failing over", extra={"backend": backend.name, "error": str(error)})
+                        launch(candidates.pop(0))
+            raise last_error
+        finally:
+            # The losing hedge (or anything left after an error) is abandoned
+            for task in running:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {"hedging": self.hedge, "backends": [backend.stats() for backend in self.backends]}
+
+
+
+
+def build_backend(spec: dict, max_retries: int) -> LLMBackend:
+    """Create a backend from its config entry, e.g. {"name": "local", "base_url": "http://localhost:8000/v1", "model": "llama-3.1-8b"}."""
+    name = spec["name"]
+    api_key = spec.get("api_key") or os.getenv(spec.get("api_key_env", ""), "") or (OPENAI_API_KEY if name == "openai" else "none")
+    client = AsyncOpenAI(
+        api_key=api_key,
+        base_url=spec.get("base_url"),
+        timeout=float(spec.get("timeout_seconds", LLM_REQUEST_TIMEOUT_SECONDS)),
+        max_retries=max_retries
+    )
+    # The "openai" backend shares the process-wide OpenAI quota, others only get one when configured
+    if name == "openai":
+        governor = openai_governor
+    elif spec.get("requests_per_minute"):
+        governor = RateGovernor(name, process_share(int(spec["requests_per_minute"])), process_share(spec.get("tokens_per_minute")))
+    else:
+        governor = None
+    return LLMBackend(
+        name,
+        client,
+        spec.get("model", LLM_MODEL),
+        governor,
+        float(spec.get("input_cost_per_1m", DEFAULT_INPUT_COST_PER_1M if name == "openai" else 0.0)),
+        float(spec.get("output_cost_per_1m", DEFAULT_OUTPUT_COST_PER_1M if name == "openai" else 0.0))
+    )
+
+
+
+
+def build_router() -> LLMRouter:
+    """Backends from LLM_BACKENDS (a JSON list, in order of preference), or the single OpenAI backend."""
+    specs = json.loads(LLM_BACKENDS) if LLM_BACKENDS else [{"name": "openai", "base_url": OPENAI_BASE_URL}]
+    # With somewhere to fail over to, the SDK's own backoff would only delay the failover
+    max_retries = 0 if len(specs) > 1 else 2
+    return LLMRouter([build_backend(spec, max_retries) for spec in specs])
+
+
+
+
+# Process-wide router shared by every scan
+llm_router = build_router()
@@ -0,0 +1,233 @@
+import asyncio
+import datetime
+import logging
+import math
+import random
+from sqlalchemy import select, delete, func, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.database import AsyncSessionLocal
+from app.core.models import WatchedAccount, ScannedUser, ScanJob
+from app.core.config import (
+    MONITOR_TICK_SECONDS, MONITOR_JITTER, MONITOR_BUDGET_SHARE, MONITOR_MAX_CANDIDATES,
+    TWITTER_REQUESTS_PER_MINUTE, OPENAI_REQUESTS_PER_MINUTE, BATCH_MAX_TWEETS
+)
+from app.services.job_queue import new_scan_job, utc_now, JOB_QUEUED, JOB_RUNNING
+from app.services.tweets_fetcher import PAGE_SIZE
+from app.services.periodic import run_periodically
+
+
+logger = logging.getLogger(__name__)
+
+# Accounts with little history are ranked as if they had this violation rate over this many tweets
+PRIOR_VIOLATION_RATE = 0.05
+PRIOR_TWEETS = 20
+
+# Postgres advisory lock held by the monitor tick in progress, whichever worker process runs it
+MONITOR_LOCK_KEY = 7305521948
+
+
+
+
+def jittered_delay(interval_seconds: float, jitter: float = MONITOR_JITTER, rng=random) -> datetime.timedelta:
+    """Interval with +/- `jitter` of random spread, so accounts watched together drift apart."""
+    return datetime.timedelta(seconds=interval_seconds * (1 + rng.uniform(-jitter, jitter)))
+
+
+
+
+def expected_new_tweets(user: ScannedUser, now: datetime.datetime) -> float:
+    """Tweets a scan is expected to find, from the posting rate since the last completed scan."""
+    if user is None or user.last_scanned_at is None or user.tweets_per_day is None:
+        return PAGE_SIZE
+    return user.tweets_per_day * max(0.0, (now - user.last_scanned_at).total_seconds()) / 86400
+
+
+
+
+def scan_cost(user: ScannedUser, now: datetime.datetime) -> tuple:
+    """Estimated (Twitter requests, LLM requests) of scanning the account now."""
+    tweets = expected_new_tweets(user, now)
+    return max(1, math.ceil(tweets / PAGE_SIZE)), math.ceil(tweets / BATCH_MAX_TWEETS)
+
+
+
+
+def scan_priority(watch: WatchedAccount, user: ScannedUser, now: datetime.datetime) -> float:
+    """
+    Rank a due account: expected violations per day, boosted the longer it's been overdue.
+
+    Never-scanned accounts come first; overdue time keeps low-risk accounts from starving
+    when the budgets can't cover every due account.
+    """
+    if user is None or user.last_scanned_at is None:
+        return math.inf
+    violation_rate = ((user.violations_seen or 0) + PRIOR_VIOLATION_RATE * PRIOR_TWEETS) / ((user.tweets_seen or 0) + PRIOR_TWEETS)
+    overdue = max(0.0, (now - watch.next_scan_at).total_seconds()) / watch.interval_seconds
+    return violation_rate * (1 + (user.tweets_per_day or 0)) * (1 + overdue)
+
+
+
+
+def plan_due_scans(due: list, users: dict, now: datetime.datetime, twitter_budget: float, openai_budget: float) -> list:
+    """
+    Pick the due accounts to scan this tick, highest priority first, within the request budgets.
+
+    `users` maps (username, policy name) to the ScannedUser state of that watch's scans.
+    """
+    ranked = sorted(due, key=lambda watch: scan_priority(watch, users.get((watch.username, watch.policy_name)), now), reverse=True)
+    picked = []
+    for watch in ranked:
+        twitter_cost, openai_cost = scan_cost(users.get((watch.username, watch.policy_name)), now)
+        fits = twitter_cost <= twitter_budget and openai_cost <= openai_budget
+        # A single account bigger than a whole tick still gets scanned, alone
+        if fits or (not picked and twitter_budget >= 1):
+            picked.append(watch)
+            twitter_budget -= twitter_cost
+            openai_budget -= openai_cost
+    return picked
+
+
+
+
+def tick_budgets() -> tuple:
+    """(Twitter requests, LLM requests) scheduled scans may use per monitor tick."""
+    share = MONITOR_BUDGET_SHARE * MONITOR_TICK_SECONDS / 60
+    return TWITTER_REQUESTS_PER_MINUTE * share, OPENAI_REQUESTS_PER_MINUTE * share
+
+
+
+
+def watch_to_dict(watch: WatchedAccount, user: ScannedUser = None, now: datetime.datetime = None) -> dict:
+    priority = scan_priority(watch, user, now or utc_now())
+    return {
+        "username": watch.username,
+        "policy": watch.policy_name,
+        "interval_minutes": watch.interval_seconds / 60,
+        "next_scan_at": watch.next_scan_at,
+        "last_enqueued_at": watch.last_enqueued_at,
+        "last_scanned_at": user.last_scanned_at if user else None,
+        "priority": None if math.isinf(priority) else round(priority, 6)
+    }
+
+
+
+
+async def watch_accounts(session: AsyncSession, usernames: list, policy_name: str, interval_seconds: int, rng=random) -> list:
+    """Start (or update the interval of) monitoring the usernames under a policy."""
+    now = utc_now()
+    result = await session.execute(
+        select(WatchedAccount).where(WatchedAccount.policy_name == policy_name, WatchedAccount.username.in_(usernames))
+    )
+    existing = {watch.username: watch for watch in result.scalars().all()}
+
+    watches = []
+    for username in dict.fromkeys(usernames):
+        watch = existing.get(username)
+        if watch:
+            watch.interval_seconds = interval_seconds
+            watch.next_scan_at = min(watch.next_scan_at, now + jittered_delay(interval_seconds, rng=rng))
+        else:
+            # First scans are spread over a whole interval instead of all starting now
+            watch = WatchedAccount(
+                username=username,
+                policy_name=policy_name,
+                interval_seconds=interval_seconds,
+                next_scan_at=now + datetime.timedelta(seconds=rng.uniform(0, interval_seconds)),
+                created_at=now
+            )
+            session.add(watch)
+        watches.append(watch)
+    await session.commit()
+    return watches
+
+
+
+
+async def unwatch_account(session: AsyncSession, username: str, policy_name: str = None) -> int:
+    """Stop monitoring a username, under one policy or all of them; returns the number of watches removed."""
+    statement = delete(WatchedAccount).where(WatchedAccount.username == username)
+    if policy_name:
+        statement = statement.where(WatchedAccount.policy_name == policy_name)
+    result = await session.execute(statement)
+    await session.commit()
+    return result.rowcount
+
+
+
+
+async def schedule_due_scans(session: AsyncSession, rng=random) -> list:
+    """
+    Turn due watched accounts into queued scan jobs, within this tick's share of the API budgets.
+
+    Every worker process runs the monitor, but the budgets are per deployment: a tick holds an
+    advisory lock until it commits, so a process whose tick overlaps another one skips it, and
+    each tick sees the jobs the previous ones queued. Accounts left out by the budget stay due
+    and compete again next tick.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        if not await session.scalar(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": MONITOR_LOCK_KEY}):
+            return []
+
+    now = utc_now()
+    twitter_budget, openai_budget = tick_budgets()
+
+    # Jobs still waiting or running will spend this tick's budget first
+    outstanding = await session.scalar(
+        select(func.count()).select_from(ScanJob).where(ScanJob.status.in_((JOB_QUEUED, JOB_RUNNING)))
+    )
+    twitter_budget -= outstanding or 0
+    if twitter_budget < 1:
+        return []
+
+    result = await session.execute(
+        select(WatchedAccount)
+        .where(WatchedAccount.next_scan_at <= now)
+        .order_by(WatchedAccount.next_scan_at)
+        .limit(MONITOR_MAX_CANDIDATES)
+        .with_for_update(skip_locked=True)
+    )
+    due = result.scalars().all()
+    if not due:
+        return []
+
+    usernames = {watch.username for watch in due}
+    result = await session.execute(select(ScannedUser).where(ScannedUser.username.in_(usernames)))
+    users = {(user.username, user.policy): user for user in result.scalars().all()}
+    result = await session.execute(
+        select(ScanJob.username, ScanJob.policy_name)
+        .where(ScanJob.status.in_((JOB_QUEUED, JOB_RUNNING)), ScanJob.username.in_(usernames))
+    )
+    open_jobs = set(result.all())
+
+    # An account with a scan already pending just moves on to its next slot
+    schedulable = []
+    for watch in due:
+        if (watch.username, watch.policy_name) in open_jobs:
+            watch.next_scan_at = now + jittered_delay(watch.interval_seconds, rng=rng)
+        else:
+            schedulable.append(watch)
+
+    jobs = []
+    for watch in plan_due_scans(schedulable, users, now, twitter_budget, openai_budget):
+        jobs.append(new_scan_job(watch.username, watch.policy_name, now))
+        watch.last_enqueued_at = now
+        watch.next_scan_at = now + jittered_delay(watch.interval_seconds, rng=rng)
+    session.add_all(jobs)
+    await session.commit()
+
+    if jobs:
+        logger.info("Scheduled monitoring scans", extra={"jobs": len(jobs), "due": len(due)})
+    return jobs
+
+
+
+
+async def run_monitor(stop_event: asyncio.Event):
+    """Schedule due watched accounts every MONITOR_TICK_SECONDS until `stop_event` is set."""
+    logger.info("Monitor started", extra={"tick_seconds": MONITOR_TICK_SECONDS})
+
+    async def tick():
+        async with AsyncSessionLocal() as session:
+            await schedule_due_scans(session)
+
+    await run_periodically(tick, MONITOR_TICK_SECONDS, stop_event, "monitor_tick")
@@ -1,73 +1,355 @@
-from openai import AsyncOpenAI
+from openai import RateLimitError
+import asyncio
 import json
-from app.core.config import OPENAI_API_KEY
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+import logging
+import time
+from app.core.config import BATCH_MAX_TWEETS, BATCH_MAX_TOKENS, LLM_STRUCTURED_OUTPUT, LLM_PARSE_RETRIES, CPU_POOL_PARSE_MIN_BYTES
+from app.services.scan_scheduler import scheduler
+from app.services.llm_backends import llm_router, estimate_tokens, is_transient
+from app.services.policy_registry import CompiledPolicy
+from app.services.cpu_pool import cpu_pool
+from app.core.metrics import LLM_REQUEST_SECONDS, LLM_TOKENS, JSON_PARSE_FAILURES, UNKNOWN_VERDICTS, count_retry
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
+
+
+
+logger = logging.getLogger(__name__)
+
+# Client of the preferred backend
+client = llm_router.backends[0].client
+
+
+
+
+class MalformedResponse(ValueError):
+    """Raised when the model output isn't a valid verdict (bad JSON, wrong shape, refusal, truncation)."""
+
+
+
+
+class MalformedBatchResponse(MalformedResponse):
+    """Raised when the model output for a batch can't be mapped back to its tweets."""
+
+
+
+
+def build_tweet_batches(tweets: list, max_tweets: int = BATCH_MAX_TWEETS, max_tokens: int = BATCH_MAX_TOKENS) -> list:
+    """Pack tweet texts into batches of indexes bounded by tweet count and token budget."""
+    batches = []
+    current = []
+    current_tokens = 0
+    for index, text in enumerate(tweets):
+        tokens = estimate_tokens(text)
+        if current and (len(current) >= max_tweets or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(index)
+        current_tokens += tokens
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+
+
+def parse_model_json(content: str):
+    """Parse a JSON payload from the model, tolerating markdown code fences."""
+    return json.loads(content.replace("```json", "").replace("```", ""))
+
+
+
+
+# Expected completion size, reserved up front from the tokens/min budget
+OUTPUT_TOKENS_PER_TWEET = 80
+
+# Hard completion cap per tweet; a verdict listing several violations fits well within it
+MAX_OUTPUT_TOKENS_PER_TWEET = 250
+
+# Outcome of a tweet whose verdict couldn't be obtained; never cached nor treated as a pass
+VERDICT_UNKNOWN = "UNKNOWN"
+
+
+
+
+def record_token_usage(response):
+    """Record prompt/completion token counts reported by the API, when present."""
+    usage = getattr(response, "usage", None)
+    for token_type in ("prompt_tokens", "completion_tokens"):
+        count = getattr(usage, token_type, None)
+        if isinstance(count, int):
+            LLM_TOKENS.observe(count, type=token_type.removesuffix("_tokens"))
+
+
+
+
+async def create_chat_completion(messages: list, expected_output_tokens: int, kind: str = "single", response_format: dict = None, max_tokens: int = None):
+    """Send a chat completion through the LLM backend router (rate limits, failover and hedging live there)."""
+    options = {}
+    if response_format:
+        options["response_format"] = response_format
+    if max_tokens:
+        options["max_tokens"] = max_tokens
+    start = time.perf_counter()
+    try:
+        response = await llm_router.complete(messages, expected_output_tokens, **options)
+    except RateLimitError as e:
+        retry_after = e.response.headers.get("retry-after") if e.response is not None else None
+        logger.warning("LLM rate limit hit on every backend", extra={"retry_after": retry_after})
+        raise
+    finally:
+        LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, kind=kind)
+
+    record_token_usage(response)
+    return response
+
+
+
+
+def verdict_schema(batch: bool) -> dict:
+    """Strict JSON schema for a verdict, or for a batch of verdicts keyed by tweet ID."""
+    violation = {
+        "type": "object",
+        "properties": {
+            "policy": {"type": "string"},
+            "rule_id": {"type": "string"},
+            "rule_violated": {"type": "string"},
+            "reason": {"type": "string"}
+        },
+        "required": ["policy", "rule_id", "rule_violated", "reason"],
+        "additionalProperties": False
+    }
+    verdict = {
+        "type": "object",
+        "properties": {
+            "violation": {"type": "string", "enum": ["YES", "NO"]},
+            "violations": {"type": "array", "items": violation}
+        },
+        "required": ["violation", "violations"],
+        "additionalProperties": False
+    }
+    if batch:
+        verdict["properties"] = {"id": {"type": "string"}, **verdict["properties"]}
+        verdict["required"] = ["id"] + verdict["required"]
+        return {
+            "type": "object",
+            "properties": {"results": {"type": "array", "items": verdict}},
+            "required": ["results"],
+            "additionalProperties": False
+        }
+    return verdict
+
+
+
+
+def response_format(name: str, batch: bool):
+    if not LLM_STRUCTURED_OUTPUT:
+        return {"type": "json_object"}
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": verdict_schema(batch)}}
+
+
+
+
+SYSTEM_PROMPT = (
+    "You are a compliance officer. Check tweets against every rule of the given policies. "
+    "Report one entry per violated rule, with its rule ID exactly as written in brackets; "
+    "violations is empty when violation is NO. Answer in JSON."
+)
+
+
+
+
+def unknown_verdict(tweet: str, error: str) -> dict:
+    """Verdict for a tweet the model couldn't classify; it is neither a pass nor a violation."""
+    UNKNOWN_VERDICTS.inc()
+    return {"violation": VERDICT_UNKNOWN, "violations": [], "tweet": tweet, "error": error}
+
+
+
+
+async def read_verdict_payload(response):
+    """Return the parsed JSON of a completion, raising MalformedResponse for refusals and truncated output."""
+    choice = response.choices[0]
+    refusal = getattr(choice.message, "refusal", None)
+    if isinstance(refusal, str) and refusal:
+        raise MalformedResponse(f"Model refused: {refusal}")
+    if getattr(choice, "finish_reason", None) == "length":
+        raise MalformedResponse("Output truncated by max_tokens")
+    content = choice.message.content or ""
+    try:
+        # Large batch responses are parsed off the event loop when the CPU pool is enabled
+        if len(content) >= CPU_POOL_PARSE_MIN_BYTES:
+            return await cpu_pool.run(parse_model_json, content)
+        return parse_model_json(content)
+    except json.JSONDecodeError as e:
+        raise MalformedResponse(f"Invalid JSON: {e}")
+
+
+
+
+def validate_verdict(verdict) -> dict:
+    """Check a single verdict has a YES/NO outcome and a list of violations."""
+    if not isinstance(verdict, dict) or verdict.get("violation") not in ("YES", "NO"):
+        raise MalformedResponse("Verdict has no YES/NO 'violation'")
+    violations = verdict.get("violations", [])
+    if not isinstance(violations, list) or not all(isinstance(violation, dict) for violation in violations):
+        raise MalformedResponse("Verdict 'violations' is not a list of objects")
+    return verdict
 
 
 
-# Initialize client
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
 @retry(
       stop=stop_after_attempt(3),                                       # Stop after 3 failed attempts
       wait=wait_exponential(multiplier=1, min=2, max=60),               # Wait 2s, then 4s, then 8s...
-      retry=retry_if_exception_type((ConnectionError, TimeoutError))    # Only retry these errors
+      retry=retry_if_exception(is_transient),                          # Only retry rate limits, 5xx and connection errors, once every backend failed
+      before_sleep=count_retry("openai")
 )
-async def check_tweet_compliance(tweet: str, policy_rules: list):
-    # Format each rule dictionary into a string
-    rule_strings = []
-    for rule in policy_rules:
-        if isinstance(rule, dict):
-            # Format: [RULE-ID] CATEGORY: Description
-            rule_str = f"[{rule.get('rule_id', 'N/A')}] {rule.get('category', 'N/A')}: {rule.get('description', 'N/A')}"
-            rule_strings.append(rule_str)
-        else:
-            # If it's already a string, use it as is
-            rule_strings.append(str(rule))
-
-    # Join the formatted rules with newlines
-    rules_text = "\n".join(rule_strings)
-    
-
-    system_message = {
-        "role": "system",
-        "content": "You are an AI compliance officer. Analyze tweets based on compliance policies."
-    }
-    
+async def check_tweet_compliance(tweet: str, policy: CompiledPolicy):
+    """
+    Classify one tweet. Malformed output gets up to LLM_PARSE_RETRIES repair attempts, after
+    which the tweet's verdict is UNKNOWN rather than a silent pass.
+    """
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Policies:\n{policy.rules_text}\n\nTweet: {json.dumps(tweet)}"}
+    ]
+
+    for attempt in range(LLM_PARSE_RETRIES + 1):
+        response = await create_chat_completion(
+            messages,
+            expected_output_tokens=OUTPUT_TOKENS_PER_TWEET,
+            response_format=response_format("tweet_verdict", batch=False),
+            max_tokens=MAX_OUTPUT_TOKENS_PER_TWEET
+        )
+        try:
+            verdict = validate_verdict(await read_verdict_payload(response))
+            # Fill the tweet text ourselves instead of trusting the model to echo it
+            return {**verdict, "tweet": tweet}
+        except MalformedResponse as e:
+            JSON_PARSE_FAILURES.inc(kind="single")
+            logger.warning("Malformed model response", extra={"error": str(e), "attempt": attempt + 1})
+            error = str(e)
+            # Show the model its own output and ask for a corrected one
+            messages = messages[:2] + [
+                {"role": "assistant", "content": response.choices[0].message.content or ""},
+                {"role": "user", "content": f"That answer was invalid ({error}). Reply again with only the JSON verdict."}
+            ]
+
+    return unknown_verdict(tweet, error)
 
-    user_message = {
-        "role": "user",
-        "content": f"""
-        Analyze the following tweet based on these compliance policies:
-        {rules_text}
 
-        Tweet: "{tweet}"
-        """
-    }
-    
-
-    assistant_message = {
-        "role": "assistant",
-        "content": """
-        Respond in JSON format:
-        {
-        "violation": "YES" or "NO",
-        "tweet": "Tweet text",
-        "policy": "Policy name just if violation is YES",
-        "rule_id": "Rule ID just if violation is YES",
-        "rule_violated": "Rule description just if violation is YES",
-        "reason": "Explain why just if violation is YES",
-        }
-        """
-    }
 
-    response = await client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[system_message, user_message, assistant_message]
+
+@retry(
+      stop=stop_after_attempt(3),
+      wait=wait_exponential(multiplier=1, min=2, max=60),
+      retry=retry_if_exception(is_transient),
+      before_sleep=count_retry("openai")
+)
+async def check_tweets_compliance_batch(tweets: list, policy: CompiledPolicy) -> list:
+    """Classify several tweets in a single request, returning one verdict per tweet (same order)."""
+    # Tweets get short positional IDs so verdicts can be mapped back without echoing the text
+    tweet_ids = [str(i + 1) for i in range(len(tweets))]
+    tweets_text = "\n".join(f"[{tweet_id}] {json.dumps(text)}" for tweet_id, text in zip(tweet_ids, tweets))
+
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Policies:\n{policy.rules_text}\n\nTweets (one per line, prefixed by their ID), one result per ID:\n{tweets_text}"}
+    ]
+    response = await create_chat_completion(
+        messages,
+        expected_output_tokens=OUTPUT_TOKENS_PER_TWEET * len(tweets),
+        kind="batch",
+        response_format=response_format("tweet_verdicts", batch=True),
+        max_tokens=MAX_OUTPUT_TOKENS_PER_TWEET * len(tweets)
     )
 
-    try:    
-        return json.loads(response.choices[0].message.content.replace("```json", "").replace("```", ""))
-    except json.JSONDecodeError as json_err:
-        print(f"❌ JSON parsing error: {json_err}")
-        return {"error": "Invalid response format"}
\ No newline at end of file
+    try:
+        payload = await read_verdict_payload(response)
+    except MalformedResponse as e:
+        JSON_PARSE_FAILURES.inc(kind="batch")
+        raise MalformedBatchResponse(f"Batch of {len(tweets)} tweets: {e}")
+
+    results = payload.get("results") if isinstance(payload, dict) else None
+    if not isinstance(results, list):
+        JSON_PARSE_FAILURES.inc(kind="batch")
+        raise MalformedBatchResponse("Batch response has no 'results' list")
+
+    verdicts = {}
+    for result in results:
+        if isinstance(result, dict) and str(result.get("id")) in tweet_ids:
+            try:
+                verdicts[str(result["id"])] = validate_verdict(result)
+            except MalformedResponse:
+                pass
+
+    missing = [tweet_id for tweet_id in tweet_ids if tweet_id not in verdicts]
+    if missing:
+        JSON_PARSE_FAILURES.inc(kind="batch")
+        raise MalformedBatchResponse(f"Batch response is missing valid verdicts for IDs: {missing}")
+
+    # Fill the tweet text ourselves instead of trusting the model to echo it
+    return [{**verdicts[tweet_id], "tweet": text} for tweet_id, text in zip(tweet_ids, tweets)]
+
+
+
+
+async def classify_batch_with_split(tweets: list, policy: CompiledPolicy) -> list:
+    """Classify a batch, splitting it in halves and retrying whenever the model output is malformed."""
+    if len(tweets) == 1:
+        # A single tweet uses the per-tweet path, which has its own error handling
+        return [await check_tweet_compliance(tweets[0], policy)]
+
+    try:
+        return await check_tweets_compliance_batch(tweets, policy)
+    except MalformedBatchResponse as e:
+        logger.warning("Malformed batch response, splitting batch", extra={"error": str(e), "batch_size": len(tweets)})
+
+    middle = len(tweets) // 2
+    first_half, second_half = await asyncio.gather(
+        classify_batch_with_split(tweets[:middle], policy),
+        classify_batch_with_split(tweets[middle:], policy)
+    )
+    return first_half + second_half
+
+
+
+
+async def classify_tweets(tweets: list, policy: CompiledPolicy, user_scope=None) -> list:
+    """
+    Classify tweet texts in packed batches, returning one verdict per tweet in input order.
+
+    A batch that fails falls back to per-tweet requests on its own; an LLM rate limit propagates.
+    """
+    verdicts = [None] * len(tweets)
+    batches = build_tweet_batches(tweets)
+    user_scope = user_scope or scheduler.user_scope()
+
+    async def classify_one(tweet):
+        try:
+            return await check_tweet_compliance(tweet, policy)
+        except RateLimitError:
+            raise
+        except Exception as e:
+            return unknown_verdict(tweet, str(e))
+
+    async def run_batch(indexes):
+        batch = [tweets[i] for i in indexes]
+        # Each batch holds one in-flight slot per tweet it carries
+        async with scheduler.tweet_slots(user_scope, len(indexes)):
+            try:
+                batch_verdicts = await classify_batch_with_split(batch, policy)
+            except RateLimitError:
+                # Every backend is throttled, per-tweet requests would only add to it
+                raise
+            except Exception as e:
+                # Only this batch falls back to per-tweet requests, the other batches keep their verdicts
+                logger.warning("Batch classification failed, falling back to per-tweet requests", extra={"error": str(e), "batch_size": len(batch)})
+                batch_verdicts = await asyncio.gather(*(classify_one(tweet) for tweet in batch))
+        for index, verdict in zip(indexes, batch_verdicts):
+            verdicts[index] = verdict
+
+    await asyncio.gather(*(run_batch(indexes) for indexes in batches))
+    return verdicts
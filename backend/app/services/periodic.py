@@ -0,0 +1,26 @@
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+
+
+async def run_periodically(fn, interval: float, stop_event: asyncio.Event, name: str):
+    """
+    Await `fn()` every `interval` seconds until `stop_event` is set.
+
+    A failing run is logged and the next one still happens on schedule; setting `stop_event`
+    ends the wait right away instead of after the interval.
+    """
+    while not stop_event.is_set():
+        try:
+            await fn()
+        except Exception:
+            logger.exception("Periodic task failed", extra={"task": name})
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
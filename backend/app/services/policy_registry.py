@@ -0,0 +1,233 @@
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import dataclass, field
+from app.core.config import UPLOAD_DIR
+
+
+
+
+class PolicyNotFound(Exception):
+    """No policy file exists for the requested name."""
+
+
+
+
+class InvalidPolicy(ValueError):
+    """The policy file isn't valid JSON or has no usable rules."""
+
+
+
+
+@dataclass(frozen=True)
+class CompiledPolicy:
+    """A validated policy with everything the predictor needs precomputed."""
+    name: str                   # File name without extension, as used in the API
+    title: str                  # "policy_name" from the file, falls back to `name`
+    rules: list
+    rules_text: str             # Rendered rules block inserted into every prompt
+    content_hash: str           # Hash of the rules, keys the verdict cache
+    mtime: float
+    titles: tuple = ()          # Title of every policy evaluated, several for a combined policy
+    rule_index: dict = field(default_factory=dict, compare=False)    # rule_id -> ((policy title, rule description), ...)
+
+    def attribute(self, violation: dict) -> tuple:
+        """
+        Return the (policy title, rule description) a reported violation belongs to.
+
+        Ownership comes from the rule IDs we sent, not from the policy name the model echoes back;
+        the echoed name only breaks ties between policies sharing a rule ID.
+        """
+        claimed_policy = str(violation.get("policy") or "")
+        candidates = self.rule_index.get(str(violation.get("rule_id") or "").strip("[] "), ())
+        for title, description in candidates:
+            if title == claimed_policy:
+                return title, description
+        if candidates:
+            return candidates[0]
+
+        # Unknown rule ID (or string rules without IDs), keep the model's description
+        if claimed_policy in self.titles:
+            title = claimed_policy
+        else:
+            title = self.titles[0] if len(self.titles) == 1 else ""
+        return title, violation.get("rule_violated", "")
+
+
+
+
+def format_policy_rules(policy_rules: list) -> str:
+    """Render policy rules into the text block sent to the model."""
+    rule_strings = []
+    for rule in policy_rules:
+        if isinstance(rule, dict):
+            # Format: [RULE-ID] CATEGORY: Description
+            rule_str = f"[{rule.get('rule_id', 'N/A')}] {rule.get('category', 'N/A')}: {rule.get('description', 'N/A')}"
+            rule_strings.append(rule_str)
+        else:
+            # If it's already a string, use it as is
+            rule_strings.append(str(rule))
+
+    # Join the formatted rules with newlines
+    return "\n".join(rule_strings)
+
+
+
+
+def hash_policy_rules(policy_rules: list) -> str:
+    """Content hash of the policy rules; any edit to the rules yields a new hash."""
+    return hashlib.sha256(json.dumps(policy_rules, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+
+
+def index_policy_rules(title: str, policy_rules: list) -> dict:
+    """Map each rule ID to its owning policy and description."""
+    index = {}
+    for rule in policy_rules:
+        if isinstance(rule, dict) and rule.get("rule_id"):
+            index[str(rule["rule_id"])] = ((title, rule.get("description", "")),)
+    return index
+
+
+
+
+def compile_policy(name: str, data, mtime: float = 0.0) -> CompiledPolicy:
+    """Validate parsed policy JSON (a dict with "rules" or a bare list of rules) and compile it."""
+    if isinstance(data, dict) and "rules" in data:
+        rules = data["rules"]
+        title = data.get("policy_name") or name
+    elif isinstance(data, list):
+        rules = data
+        title = name
+    else:
+        raise InvalidPolicy("Policy file must contain rules as a list or a 'rules' key with a list")
+
+    if not isinstance(rules, list) or not all(isinstance(rule, (dict, str)) for rule in rules):
+        raise InvalidPolicy("Policy rules must be a list of rule objects or strings")
+
+    return CompiledPolicy(
+        name=name,
+        title=title,
+        rules=rules,
+        rules_text=format_policy_rules(rules),
+        content_hash=hash_policy_rules(rules),
+        mtime=mtime,
+        titles=(title,),
+        rule_index=index_policy_rules(title, rules)
+    )
+
+
+
+
+def combine_policies(policies: list) -> CompiledPolicy:
+    """Merge policies into one evaluated in a single prompt per tweet (or batch)."""
+    if len(policies) == 1:
+        return policies[0]
+
+    rule_index = {}
+    for policy in policies:
+        for rule_id, owners in policy.rule_index.items():
+            rule_index[rule_id] = rule_index.get(rule_id, ()) + owners
+
+    return CompiledPolicy(
+        name=",".join(policy.name for policy in policies),
+        title=" + ".join(policy.title for policy in policies),
+        rules=[rule for policy in policies for rule in policy.rules],
+        rules_text="\n\n".join(f'Policy "{policy.title}":\n{policy.rules_text}' for policy in policies),
+        content_hash=hashlib.sha256("|".join(policy.content_hash for policy in policies).encode("utf-8")).hexdigest(),
+        mtime=max(policy.mtime for policy in policies),
+        titles=tuple(policy.title for policy in policies),
+        rule_index=rule_index
+    )
+
+
+
+
+class PolicyRegistry:
+    """Loads policies from the upload directory once and reloads them only when their file changes."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.policies = {}
+
+    def path_for(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.json")
+
+    def get(self, name: str) -> CompiledPolicy:
+        """Return the compiled policy, re-reading the file only if its mtime changed."""
+        try:
+            mtime = os.stat(self.path_for(name)).st_mtime
+        except FileNotFoundError:
+            self.policies.pop(name, None)
+            raise PolicyNotFound(f"Policy file '{name}' not found")
+
+        policy = self.policies.get(name)
+        if policy is None or policy.mtime != mtime:
+            policy = self.reload(name)
+        return policy
+
+    def get_many(self, names: list) -> CompiledPolicy:
+        """Return the named policies combined into one (a comma-separated string also works)."""
+        if isinstance(names, str):
+            names = names.split(",")
+        return combine_policies([self.get(name.strip()) for name in dict.fromkeys(names)])
+
+    def peek(self, name: str):
+        """Return the currently compiled policy without touching the disk, or None."""
+        return self.policies.get(name)
+
+    def compile_file(self, name: str, path: str) -> CompiledPolicy:
+        """Read, validate and compile a policy file without caching it."""
+        try:
+            mtime = os.stat(path).st_mtime
+            with open(path, "r") as f:
+                data = json.load(f)
+        except json.JSONDecodeError:
+            raise InvalidPolicy("Invalid JSON in policy file")
+        return compile_policy(name, data, mtime)
+
+    def reload(self, name: str) -> CompiledPolicy:
+        """Read, validate and compile the policy file, replacing the cached version."""
+        try:
+            policy = self.compile_file(name, self.path_for(name))
+        except FileNotFoundError:
+            self.policies.pop(name, None)
+            raise PolicyNotFound(f"Policy file '{name}' not found")
+
+        self.policies[name] = policy
+        return policy
+
+    def install(self, name: str, content: bytes) -> CompiledPolicy:
+        """
+        Validate and compile new policy content, then atomically swap it in for the policy's file.
+
+        The content is compiled from a temporary file next to the policy and only moved over it once
+        valid, so an invalid upload leaves both the previous file and its compiled version in place.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        # Not a *.json name, so the temporary file is never listed or loaded as a policy
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=f".{name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            # The rename keeps the file's mtime, the compiled version stays current
+            policy = self.compile_file(name, temp_path)
+            os.replace(temp_path, self.path_for(name))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        self.policies[name] = policy
+        return policy
+
+    def forget(self, name: str):
+        self.policies.pop(name, None)
+
+
+
+
+# Process-wide registry for the uploaded policies
+policy_registry = PolicyRegistry(UPLOAD_DIR)
@@ -0,0 +1,215 @@
+import asyncio
+import json
+import os
+import pickle
+import re
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.models import CachedVerdict
+from app.core.config import PREFILTER_KEYWORD_THRESHOLD, PREFILTER_MODEL_SAFE_PROBABILITY, PREFILTER_MODEL_DIR, PREFILTER_TRAIN_MAX_SAMPLES
+from app.services.policy_registry import CompiledPolicy
+
+try:
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+except ImportError:         # The local model is optional, keyword rules work without it
+    make_pipeline = None
+
+
+PREFILTER_SAFE = "safe"
+PREFILTER_ESCALATE = "escalate"
+
+# Words too common in rule descriptions (or tweets) to say anything about a violation
+STOPWORDS = {
+    "about", "against", "also", "and", "any", "are", "based", "being", "comments", "company", "content",
+    "employee", "employees", "employment", "for", "from", "including", "information", "into", "its", "media", "other",
+    "post", "posts", "posting", "related", "sharing", "social", "that", "the", "their", "them", "this",
+    "reflects", "status", "use", "with", "without", "your"
+}
+
+# Signals that always escalate, whatever the policy wording or the model says
+RISK_PATTERNS = [
+    re.compile(r"[$€£]\s?\d"),                                                          # Money amounts
+    re.compile(r"\b\d+(\.\d+)?\s?(%|percent|million|billion|[mb]n?)\b", re.IGNORECASE),    # Figures
+    re.compile(r"\b(confidential|internal|leak\w*|secret\w*|nda|unreleased|insider|embargo\w*)\b", re.IGNORECASE),
+    re.compile(r"\b(hate|stupid|idiot\w*|incompetent|clueless|lazy|useless|garbage|sucks?|damn|hell|wtf|crap)\b", re.IGNORECASE),
+    re.compile(r"\w\*+\w"),                                                              # Censored profanity (f***, s**t)
+    re.compile(r"\b(wom[ae]n|girls?|guys|females?|males?|gay|lesbian|trans|immigrants?|disabled|muslims?|jews?|jewish|christians?|"
+               r"black|white|asians?|latin[oa]s?|old|elderly|boomers?)\b", re.IGNORECASE),  # Protected characteristics
+    re.compile(r"#\w*(secret|leak|confidential)\w*", re.IGNORECASE)
+]
+
+WORD_PATTERN = re.compile(r"[a-z]+")
+
+
+
+
+def stem(word: str) -> str:
+    """Crude stem so "confidential" and "confidentiality" match."""
+    return word[:6]
+
+
+
+
+def extract_policy_keywords(policy: CompiledPolicy) -> set:
+    """Keyword stems derived from the rule categories and descriptions of a policy."""
+    keywords = set()
+    for rule in policy.rules:
+        text = f"{rule.get('category', '')} {rule.get('description', '')}" if isinstance(rule, dict) else str(rule)
+        for word in WORD_PATTERN.findall(text.lower()):
+            if len(word) >= 4 and word not in STOPWORDS:
+                keywords.add(stem(word))
+    return keywords
+
+
+
+
+class PolicyPrefilter:
+    """Keyword/regex rules for one policy plus an optional TF-IDF + logistic regression model."""
+
+    def __init__(self, policy: CompiledPolicy, model=None):
+        self.keywords = extract_policy_keywords(policy)
+        self.model = model
+
+    def keyword_score(self, text: str) -> int:
+        stems = {stem(word) for word in WORD_PATTERN.findall(text.lower()) if len(word) >= 4}
+        return len(stems & self.keywords)
+
+    def assess(self, texts: list) -> list:
+        """Return PREFILTER_SAFE or PREFILTER_ESCALATE per text."""
+        decisions = [None] * len(texts)
+        undecided = []
+        for index, text in enumerate(texts):
+            if any(pattern.search(text) for pattern in RISK_PATTERNS):
+                decisions[index] = PREFILTER_ESCALATE
+            else:
+                undecided.append(index)
+
+        if self.model is not None and undecided:
+            # Column 1 is the probability of the violation class
+            probabilities = self.model.predict_proba([texts[i] for i in undecided])[:, 1]
+            for index, probability in zip(undecided, probabilities):
+                decisions[index] = PREFILTER_SAFE if probability < PREFILTER_MODEL_SAFE_PROBABILITY else PREFILTER_ESCALATE
+        else:
+            for index in undecided:
+                score = self.keyword_score(texts[index])
+                decisions[index] = PREFILTER_SAFE if score < PREFILTER_KEYWORD_THRESHOLD else PREFILTER_ESCALATE
+        return decisions
+
+
+
+
+def fit_model(texts: list, labels: list):
+    """TF-IDF + logistic regression fitted on tweet texts labelled 1 (violation) or 0."""
+    model = make_pipeline(
+        TfidfVectorizer(ngram_range=(1, 2), min_df=1, sublinear_tf=True),
+        LogisticRegression(class_weight="balanced", max_iter=1000)
+    )
+    model.fit(texts, labels)
+    return model
+
+
+
+
+def fit_and_save_model(texts: list, labels: list, path: str):
+    """Fit a model and persist it to `path`; seconds of CPU work, so callers run it off the event loop."""
+    model = fit_model(texts, labels)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        pickle.dump(model, f)
+    return model
+
+
+
+
+class PrefilterRegistry:
+    """Per-policy pre-filters with escalation counters; trained models are persisted per policy content hash."""
+
+    def __init__(self, model_dir: str):
+        self.model_dir = model_dir
+        self.prefilters = {}
+        self.model_mtimes = {}
+        self.evaluated = 0
+        self.escalated = 0
+
+    def model_path(self, policy: CompiledPolicy) -> str:
+        return os.path.join(self.model_dir, f"{policy.content_hash}.pkl")
+
+    def _model_mtime(self, policy: CompiledPolicy):
+        path = self.model_path(policy)
+        return os.path.getmtime(path) if os.path.exists(path) else None
+
+    def get(self, policy: CompiledPolicy) -> PolicyPrefilter:
+        # A model (re)trained since it was loaded, possibly by another process, replaces the cached one
+        mtime = self._model_mtime(policy)
+        prefilter = self.prefilters.get(policy.content_hash)
+        if prefilter is None or self.model_mtimes.get(policy.content_hash) != mtime:
+            model = None
+            if mtime is not None:
+                # Models are written by train_model from our own cache data
+                with open(self.model_path(policy), "rb") as f:
+                    model = pickle.load(f)
+            prefilter = PolicyPrefilter(policy, model)
+            self.prefilters[policy.content_hash] = prefilter
+            self.model_mtimes[policy.content_hash] = mtime
+        return prefilter
+
+    def record(self, decisions: list):
+        self.evaluated += len(decisions)
+        self.escalated += decisions.count(PREFILTER_ESCALATE)
+
+    def assess(self, policy: CompiledPolicy, texts: list) -> list:
+        decisions = self.get(policy).assess(texts)
+        self.record(decisions)
+        return decisions
+
+
+    async def train_model(self, session: AsyncSession, policy: CompiledPolicy, max_samples: int = PREFILTER_TRAIN_MAX_SAMPLES) -> dict:
+        """Train the local model on the newest `max_samples` LLM verdicts stored in the verdict cache for this policy."""
+        if make_pipeline is None:
+            raise RuntimeError("Training the pre-filter model requires scikit-learn")
+
+        result = await session.execute(
+            select(CachedVerdict.tweet_text, CachedVerdict.verdict).where(
+                CachedVerdict.policy_hash == policy.content_hash,
+                CachedVerdict.tweet_text.is_not(None)
+            )
+            .order_by(CachedVerdict.id.desc())
+            .limit(max_samples)
+        )
+        texts, labels = [], []
+        for tweet_text, verdict_json in result.all():
+            texts.append(tweet_text)
+            labels.append(1 if json.loads(verdict_json).get("violation") == "YES" else 0)
+
+        if len(set(labels)) < 2:
+            raise ValueError("Need stored verdicts of both outcomes to train the pre-filter model")
+
+        # Fitting holds the CPU for seconds, the event loop keeps serving requests meanwhile
+        model = await asyncio.to_thread(fit_and_save_model, texts, labels, self.model_path(policy))
+        self.prefilters[policy.content_hash] = PolicyPrefilter(policy, model)
+        self.model_mtimes[policy.content_hash] = self._model_mtime(policy)
+        return {"samples": len(labels), "violations": sum(labels)}
+
+
+    def stats(self) -> dict:
+        return {
+            "evaluated": self.evaluated,
+            "escalated": self.escalated,
+            "short_circuited": self.evaluated - self.escalated,
+            "escalation_rate": round(self.escalated / self.evaluated, 4) if self.evaluated else 0.0
+        }
+
+
+
+
+def assess_texts(texts: list, policy: CompiledPolicy) -> list:
+    """Pre-filter decisions from this process's registry, without counting them; run by the CPU pool."""
+    return prefilter_registry.get(policy).assess(texts)
+
+
+
+
+# Process-wide pre-filter registry
+prefilter_registry = PrefilterRegistry(PREFILTER_MODEL_DIR)
@@ -0,0 +1,190 @@
+import array
+import datetime
+import fcntl
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+from app.core.config import SAMPLE_DATA_PATH
+
+
+logger = logging.getLogger(__name__)
+
+# Sidecar layout version, bumped whenever the binary format changes
+SIDECAR_VERSION = 1
+
+# One record per tweet: id, created_at (epoch microseconds), text offset and text length in text.bin
+RECORD = struct.Struct("<QqQI4x")
+
+# created_at of tweets that have none
+NO_TIMESTAMP = -(2 ** 63)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+
+
+def parse_created_at(value) -> int:
+    if not value:
+        return NO_TIMESTAMP
+    created_at = datetime.datetime.fromisoformat(value.replace("Z", ""))
+    return (created_at - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+
+
+def iter_corpus_tweets(path: str):
+    """
+    Yield (username, tweet) from the corpus: an NDJSON file of tweets (streamed), or a JSON
+    document {"username": ..., "tweets": [...]} (parsed once, when the sidecar is built).
+
+    Tweets carrying their own "username" belong to that user; the others form the shared
+    slice replayed for every user missing from the corpus.
+    """
+    if path.endswith((".ndjson", ".jsonl")):
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    tweet = json.loads(line)
+                    yield tweet.get("username") or "", tweet
+        return
+
+    with open(path, "r") as f:
+        data = json.load(f)
+    for tweet in data["tweets"]:
+        yield tweet.get("username") or "", tweet
+
+
+
+
+class SampleCorpus:
+    """
+    Read-only, memory-mapped view of the sample tweet corpus.
+
+    The source file is parsed once into a binary sidecar directory next to it (fixed-size
+    records grouped by user, plus a text heap) and mapped from then on, so every scan and
+    every process shares the same pages and only the tweets of the requested page are decoded.
+    The sidecar is rebuilt when the source file changes.
+    """
+
+    def __init__(self, path: str = SAMPLE_DATA_PATH):
+        self.path = path
+        self.sidecar = f"{path}.idx"
+        self.users = None
+        self.records = None
+        self.texts = None
+
+    def _source_stamp(self) -> dict:
+        stat = os.stat(self.path)
+        return {"version": SIDECAR_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _is_fresh(self) -> bool:
+        try:
+            with open(os.path.join(self.sidecar, "meta.json")) as f:
+                return json.load(f)["source"] == self._source_stamp()
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def build(self):
+        """Parse the source corpus into the sidecar, written to a temporary directory and swapped in."""
+        stamp = self._source_stamp()
+        building = f"{self.sidecar}.building"
+        shutil.rmtree(building, ignore_errors=True)
+        os.makedirs(building)
+
+        # Compact columns in source order, text written out as it is read
+        ids, created, offsets, lengths, owners = array.array("Q"), array.array("q"), array.array("Q"), array.array("I"), array.array("I")
+        user_numbers = {}
+        text_offset = 0
+        with open(os.path.join(building, "text.bin"), "wb") as text_file:
+            for username, tweet in iter_corpus_tweets(self.path):
+                text = tweet["text"].encode("utf-8")
+                text_file.write(text)
+                ids.append(int(tweet["id"]))
+                created.append(parse_created_at(tweet.get("created_at")))
+                offsets.append(text_offset)
+                lengths.append(len(text))
+                owners.append(user_numbers.setdefault(username, len(user_numbers)))
+                text_offset += len(text)
+
+        # Group records by user, keeping the source order within a user
+        order = sorted(range(len(ids)), key=owners.__getitem__)
+        usernames = sorted(user_numbers, key=user_numbers.get)
+        users = {}
+        with open(os.path.join(building, "tweets.bin"), "wb") as records_file:
+            for position, index in enumerate(order):
+                username = usernames[owners[index]]
+                users.setdefault(username, [position, 0])[1] += 1
+                records_file.write(RECORD.pack(ids[index], created[index], offsets[index], lengths[index]))
+
+        with open(os.path.join(building, "meta.json"), "w") as f:
+            json.dump({"source": stamp, "tweets": len(ids), "users": users}, f)
+
+        shutil.rmtree(self.sidecar, ignore_errors=True)
+        os.replace(building, self.sidecar)
+        logger.info("Built sample corpus sidecar", extra={"path": self.sidecar, "tweets": len(ids), "users": len(users)})
+
+    def open(self):
+        """Map the sidecar, building it first if missing or stale. Safe to call from several processes."""
+        if self.users is not None:
+            return
+        if not self._is_fresh():
+            with open(f"{self.sidecar}.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Another process may have built it while this one waited for the lock
+                if not self._is_fresh():
+                    self.build()
+
+        with open(os.path.join(self.sidecar, "meta.json")) as f:
+            self.users = json.load(f)["users"]
+        self.records = self._map("tweets.bin")
+        self.texts = self._map("text.bin")
+
+    def _map(self, name: str):
+        with open(os.path.join(self.sidecar, name), "rb") as f:
+            # An empty file can't be mapped, and has nothing to read anyway
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    def user_slice(self, username: str) -> tuple:
+        """(first record, record count) of the user's tweets, or of the shared tweets for unknown users."""
+        start, count = self.users.get(username) or self.users.get("") or (0, 0)
+        return start, count
+
+    def tweet(self, position: int) -> dict:
+        tweet_id, created_at, offset, length = RECORD.unpack_from(self.records, position * RECORD.size)
+        return {
+            "id": str(tweet_id),
+            "text": self.texts[offset:offset + length].decode("utf-8"),
+            "created_at": None if created_at == NO_TIMESTAMP else EPOCH + datetime.timedelta(microseconds=created_at)
+        }
+
+    def pages(self, username: str, since_id: str = None, next_token: str = None, page_size: int = 100):
+        """
+        Yield (tweets, next_token) pages of the user's tweets newer than `since_id`.
+
+        Tokens are record offsets within the user's slice, so resuming with the same `since_id`
+        continues right after the last returned page.
+        """
+        self.open()
+        start, count = self.user_slice(username)
+        since = int(since_id) if since_id else None
+        position = int(next_token or 0)
+        page = []
+        while position < count:
+            tweet_id = RECORD.unpack_from(self.records, (start + position) * RECORD.size)[0]
+            if since is None or tweet_id > since:
+                page.append(self.tweet(start + position))
+            position += 1
+            if len(page) == page_size:
+                yield page, str(position) if position < count else None
+                page = []
+        if page:
+            yield page, None
+
+
+
+
+# Process-wide corpus, mapped on first use
+sample_corpus = SampleCorpus()
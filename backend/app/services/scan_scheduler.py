@@ -0,0 +1,180 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from app.core.config import (
+    MAX_CONCURRENT_USERS,
+    MAX_INFLIGHT_TWEETS,
+    MAX_INFLIGHT_TWEETS_PER_USER,
+    OPENAI_REQUESTS_PER_MINUTE,
+    OPENAI_TOKENS_PER_MINUTE,
+    TWITTER_REQUESTS_PER_MINUTE,
+    SCAN_PROCESSES
+)
+
+
+
+
+def process_share(per_minute: float):
+    """This process's share of an upstream budget shared by SCAN_PROCESSES processes."""
+    return per_minute / SCAN_PROCESSES if per_minute else per_minute
+
+
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate_per_minute`, holding at most one minute of budget."""
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_take(self, amount: float) -> float:
+        """Take `amount` tokens if available; otherwise return the seconds to wait before retrying."""
+        # Oversized requests are clamped so they can still pass once the bucket is full
+        amount = min(amount, self.capacity)
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+
+
+class RateGovernor:
+    """Process-wide requests/min and tokens/min limiter for one upstream API."""
+
+    def __init__(self, name: str, requests_per_minute: int, tokens_per_minute: int = None):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self.waiting = 0
+        self.rate_limit_hits = 0
+        self._lock = None
+
+    async def acquire(self, tokens: int = 0):
+        """Wait until both the request and the token budgets allow one more call."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        self.waiting += 1
+        try:
+            # A single lock keeps callers FIFO so nobody starves behind large requests
+            async with self._lock:
+                while True:
+                    delay = self.paused_until - time.monotonic()
+                    if delay <= 0:
+                        delay = self.requests.try_take(1)
+                        if delay == 0 and self.tokens and tokens:
+                            delay = self.tokens.try_take(tokens)
+                            if delay:
+                                # Give the request slot back until the token budget catches up
+                                self.requests.tokens = min(self.requests.capacity, self.requests.tokens + 1)
+                        if delay == 0:
+                            return
+                    await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+
+    def pause(self, seconds: float):
+        """Stop handing out budget for `seconds`, e.g. after the upstream answered 429."""
+        self.rate_limit_hits += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "rate_limit_hits": self.rate_limit_hits,
+            "paused_for_seconds": round(max(0.0, self.paused_until - time.monotonic()), 2)
+        }
+
+
+
+
+class WeightedSemaphore:
+    """Semaphore whose holders can take several units at once (e.g. a batch of tweets)."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_use = 0
+        self.waiting = 0
+        self._condition = None
+
+    @asynccontextmanager
+    async def hold(self, units: int = 1):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
+        # Oversized holders are clamped so they run alone instead of deadlocking
+        units = min(units, self.capacity)
+        self.waiting += 1
+        try:
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.in_use + units <= self.capacity)
+                self.in_use += units
+        finally:
+            self.waiting -= 1
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_use -= units
+                self._condition.notify_all()
+
+    def stats(self) -> dict:
+        return {"in_use": self.in_use, "capacity": self.capacity, "waiting": self.waiting}
+
+
+
+
+class ScanScheduler:
+    """Bounds concurrent users and in-flight tweets, globally and per user."""
+
+    def __init__(self, max_concurrent_users: int, max_inflight_tweets: int, max_inflight_tweets_per_user: int):
+        self.max_inflight_tweets_per_user = max_inflight_tweets_per_user
+        self.users = WeightedSemaphore(max_concurrent_users)
+        self.tweets = WeightedSemaphore(max_inflight_tweets)
+
+    def user_scope(self) -> WeightedSemaphore:
+        """Create the per-user in-flight tweet limiter for a single user's scan."""
+        return WeightedSemaphore(self.max_inflight_tweets_per_user)
+
+    @asynccontextmanager
+    async def user_slot(self):
+        async with self.users.hold():
+            yield
+
+    @asynccontextmanager
+    async def tweet_slots(self, user_scope: WeightedSemaphore, count: int):
+        """Hold `count` in-flight tweet slots for the user and for the whole process."""
+        async with user_scope.hold(count):
+            async with self.tweets.hold(count):
+                yield
+
+    def stats(self) -> dict:
+        return {
+            "users": self.users.stats(),
+            "tweets": self.tweets.stats(),
+            "queue_depth": self.users.waiting + self.tweets.waiting + openai_governor.waiting + twitter_governor.waiting,
+            "upstreams": {
+                openai_governor.name: openai_governor.stats(),
+                twitter_governor.name: twitter_governor.stats()
+            }
+        }
+
+
+
+
+# Process-wide instances shared by every scan; the budgets are per deployment, split between its scan processes
+openai_governor = RateGovernor("openai", process_share(OPENAI_REQUESTS_PER_MINUTE), process_share(OPENAI_TOKENS_PER_MINUTE))
+twitter_governor = RateGovernor("twitter", process_share(TWITTER_REQUESTS_PER_MINUTE))
+scheduler = ScanScheduler(MAX_CONCURRENT_USERS, MAX_INFLIGHT_TWEETS, MAX_INFLIGHT_TWEETS_PER_USER)
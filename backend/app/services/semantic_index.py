@@ -0,0 +1,216 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+from openai import AsyncOpenAI
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.database import AsyncSessionLocal
+from app.core.models import Violation
+from app.services.periodic import run_periodically
+from app.core.config import (
+    OPENAI_API_KEY, SEMANTIC_SEARCH_ENABLED, SEMANTIC_INDEX_DIR, SEMANTIC_EMBEDDING_MODEL,
+    SEMANTIC_EMBEDDING_DIMENSIONS, SEMANTIC_EMBEDDING_BASE_URL, SEMANTIC_INDEX_CHUNK_SIZE, SEMANTIC_INDEX_INTERVAL_SECONDS
+)
+
+try:
+    import numpy
+except ImportError:         # Semantic search is optional
+    numpy = None
+
+
+logger = logging.getLogger(__name__)
+
+# Violation IDs can commit out of order, so each sync also rechecks this many IDs below the newest indexed one
+SYNC_LOOKBACK_IDS = 1000
+
+_client = None
+
+
+
+
+def embeddings_client() -> AsyncOpenAI:
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(api_key=OPENAI_API_KEY or "none", base_url=SEMANTIC_EMBEDDING_BASE_URL)
+    return _client
+
+
+
+
+def normalize(vectors):
+    """Scale rows to unit length, so a dot product is the cosine similarity."""
+    norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / numpy.maximum(norms, 1e-12)).astype(numpy.float32)
+
+
+
+
+async def embed_texts(texts: list):
+    """Unit-normalized embeddings of `texts`, one row per text."""
+    response = await embeddings_client().embeddings.create(
+        model=SEMANTIC_EMBEDDING_MODEL,
+        input=texts,
+        dimensions=SEMANTIC_EMBEDDING_DIMENSIONS
+    )
+    return normalize(numpy.array([item.embedding for item in response.data], dtype=numpy.float32))
+
+
+
+
+def violation_document(tweet: str, reason: str) -> str:
+    return f"{tweet}\n{reason or ''}"
+
+
+
+
+def rank_vectors(ids, vectors, query_vector, limit: int) -> list:
+    """The `limit` IDs whose vectors score highest against the query, as (ID, score), best first."""
+    scores = numpy.asarray(vectors @ query_vector)
+    limit = min(limit, len(scores))
+    top = numpy.argpartition(-scores, limit - 1)[:limit]
+    top = top[numpy.argsort(-scores[top], kind="stable")]
+    return [(int(ids[i]), float(scores[i])) for i in top]
+
+
+
+
+class SemanticIndex:
+    """
+    Append-only cosine similarity index over stored violations, persisted as raw int64/float32 files.
+
+    Vectors are memory-mapped, so a query is one matrix-vector product over pages the OS keeps
+    cached. One process appends (under a file lock), any number of processes read; readers map
+    the new rows on their next search.
+    """
+
+    def __init__(self, directory: str = SEMANTIC_INDEX_DIR, model: str = SEMANTIC_EMBEDDING_MODEL, dimensions: int = SEMANTIC_EMBEDDING_DIMENSIONS):
+        self.directory = directory
+        self.model = model
+        self.dimensions = dimensions
+        self.ids = None
+        self.vectors = None
+        self.loaded_size = -1
+
+    @property
+    def available(self) -> bool:
+        return SEMANTIC_SEARCH_ENABLED and numpy is not None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _check_meta(self):
+        """Start over when the embedding model or size changed, old vectors aren't comparable."""
+        meta = {"model": self.model, "dimensions": self.dimensions}
+        meta_path = self._path("meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                if json.load(f) == meta:
+                    return
+            logger.warning("Embedding settings changed, rebuilding the semantic index", extra=meta)
+        for name in ("ids.i64", "vectors.f32"):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+        self.loaded_size = -1
+
+    def refresh(self):
+        """Map the rows appended since the last call, by this process or another one."""
+        ids_path = self._path("ids.i64")
+        size = os.path.getsize(ids_path) if os.path.exists(ids_path) else 0
+        if size == self.loaded_size:
+            return
+        # IDs are written after their vectors, so every listed ID has a complete vector
+        count = size // 8
+        self.ids = numpy.fromfile(ids_path, dtype=numpy.int64, count=count) if count else numpy.empty(0, dtype=numpy.int64)
+        if count:
+            self.vectors = numpy.memmap(self._path("vectors.f32"), dtype=numpy.float32, mode="r", shape=(count, self.dimensions))
+        else:
+            self.vectors = numpy.empty((0, self.dimensions), dtype=numpy.float32)
+        self.loaded_size = size
+
+    def append(self, ids: list, vectors):
+        vectors_path = self._path("vectors.f32")
+        # Drop vectors left behind by an append interrupted before its IDs were written
+        expected = len(self.ids) * self.dimensions * 4
+        if os.path.exists(vectors_path) and os.path.getsize(vectors_path) != expected:
+            os.truncate(vectors_path, expected)
+        with open(vectors_path, "ab") as f:
+            f.write(numpy.ascontiguousarray(vectors, dtype=numpy.float32).tobytes())
+        with open(self._path("ids.i64"), "ab") as f:
+            f.write(numpy.array(ids, dtype=numpy.int64).tobytes())
+        self.refresh()
+
+    async def sync(self, session: AsyncSession, embed=embed_texts, chunk_size: int = SEMANTIC_INDEX_CHUNK_SIZE) -> int:
+        """Embed and append the violations not indexed yet; returns how many were added (0 if another process is syncing)."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path("index.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+
+            self._check_meta()
+            self.refresh()
+            cursor = max(0, int(self.ids.max()) - SYNC_LOOKBACK_IDS) if len(self.ids) else 0
+            known = set(self.ids[self.ids > cursor].tolist())
+            added = 0
+            while True:
+                result = await session.execute(
+                    select(Violation.id, Violation.tweet, Violation.reason)
+                    .where(Violation.id > cursor)
+                    .order_by(Violation.id)
+                    .limit(chunk_size)
+                )
+                rows = result.all()
+                if not rows:
+                    break
+                cursor = rows[-1].id
+                new_rows = [row for row in rows if row.id not in known]
+                if new_rows:
+                    vectors = await embed([violation_document(row.tweet, row.reason) for row in new_rows])
+                    self.append([row.id for row in new_rows], vectors)
+                    added += len(new_rows)
+            return added
+
+    async def search(self, query_vector, limit: int) -> list:
+        """The `limit` most similar violations as (violation ID, cosine similarity), best first."""
+        self.refresh()
+        if not len(self.ids):
+            return []
+        # Scanning every vector takes long enough to stall other requests, so it runs off the event loop
+        # on the rows mapped now; a refresh by a concurrent search can't mix old IDs with new vectors
+        return await asyncio.to_thread(rank_vectors, self.ids, self.vectors, query_vector, limit)
+
+    def stats(self) -> dict:
+        if self.available:
+            self.refresh()
+        return {
+            "enabled": self.available,
+            "vectors": len(self.ids) if self.ids is not None else 0,
+            "model": self.model,
+            "dimensions": self.dimensions
+        }
+
+
+
+
+async def run_semantic_indexer(stop_event: asyncio.Event):
+    """Index new violations every SEMANTIC_INDEX_INTERVAL_SECONDS until `stop_event` is set."""
+    logger.info("Semantic indexer started", extra={"interval_seconds": SEMANTIC_INDEX_INTERVAL_SECONDS})
+
+    async def index():
+        async with AsyncSessionLocal() as session:
+            added = await semantic_index.sync(session)
+        if added:
+            logger.info("Indexed violations for semantic search", extra={"added": added})
+
+    await run_periodically(index, SEMANTIC_INDEX_INTERVAL_SECONDS, stop_event, "semantic_indexing")
+
+
+
+
+# Process-wide index, shared by the search endpoint and the indexer
+semantic_index = SemanticIndex()
@@ -1,71 +1,88 @@
-import tweepy
-from tweepy.errors import TooManyRequests, TwitterServerError
+import asyncio
+import httpx
 import datetime
-import json
+import logging
 from app.core.models import ScannedUser
-from app.core.config import TWITTER_BEARER_TOKEN, USE_SAMPLE_DATA
+from app.core.config import TWITTER_BEARER_TOKEN, USE_SAMPLE_DATA, TWITTER_API_BASE_URL, TWITTER_MAX_CONNECTIONS
+from app.services.scan_scheduler import twitter_governor
+from app.services.sample_corpus import sample_corpus
+from app.core.metrics import TWITTER_PAGE_FETCH_SECONDS, RATE_LIMIT_HITS, count_retry
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
-# Twitter API Authentication
-client = tweepy.Client(bearer_token=TWITTER_BEARER_TOKEN)
+logger = logging.getLogger(__name__)
 
+# Tweets per page, the maximum allowed by the recent search endpoint
+PAGE_SIZE = 100
 
+# Twitter API client, a pooled non-blocking HTTP client shared by every scan
+client = httpx.AsyncClient(
+    base_url=TWITTER_API_BASE_URL,
+    headers={"Authorization": f"Bearer {TWITTER_BEARER_TOKEN}"},
+    limits=httpx.Limits(max_connections=TWITTER_MAX_CONNECTIONS, max_keepalive_connections=TWITTER_MAX_CONNECTIONS),
+    timeout=httpx.Timeout(30.0)
+)
+
+
+
+
+class TooManyRequests(Exception):
+    """Twitter answered 429 for a page request; `retry_after` is the seconds until its window resets."""
+
+    def __init__(self, message: str, retry_after: float = 60.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+
+
+class TwitterServerError(Exception):
+    """Twitter answered with a 5xx status for a page request."""
 
 
-async def get_last_scanned_date(username: str, db: AsyncSession):
-    """Retrieve the last scanned date for a user from the database."""
-    # Query by username since it's not the primary key
-    result = await db.execute(select(ScannedUser).where(ScannedUser.username == username))
-    user = result.scalars().first()
-    return user.last_scanned_at if user else None
 
 
+async def close_client():
+    """Close the pooled Twitter HTTP connections on shutdown."""
+    await client.aclose()
 
 
-async def save_last_scanned_date(username: str, db: AsyncSession):
-    """Update the last scanned date for a user in the database."""
-    # Query by username
-    result = await db.execute(select(ScannedUser).where(ScannedUser.username == username))
+
+
+async def load_scan_state(username: str, policy_name: str, db: AsyncSession) -> ScannedUser:
+    """Return the user's scan watermark and checkpoint row for the policy, creating it if missing."""
+    # Query by (username, policy) since it's not the primary key
+    result = await db.execute(select(ScannedUser).where(ScannedUser.username == username, ScannedUser.policy == policy_name))
     user = result.scalars().first()
-    
-    # Create a timezone-naive datetime using modern approach
-    current_time = datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
-    
-    if user:
-        user.last_scanned_at = current_time
-    else:
-        user = ScannedUser(username=username, last_scanned_at=current_time)
+    if not user:
+        # Committed right away, a pending insert would otherwise keep a write transaction open for the whole scan
+        user = ScannedUser(username=username, policy=policy_name)
         db.add(user)
-    await db.commit()
+        await db.commit()
+    return user
 
 
 
 
-async def fetch_sample_tweets(username: str, db: AsyncSession):
-    """Fetch pre-generated sample tweets for testing without Twitter API."""
-    sample_file_path = "./data/pre_generated_tweets.json"
-    
-    print(f"📄 Loading sample tweets from {sample_file_path}")
-    with open(sample_file_path, "r") as f:
-        data = json.load(f)
-    
+def newest_tweet_id(tweets: list, current: str = None):
+    """Return the largest tweet ID among `tweets` and `current` (IDs are numeric strings)."""
+    ids = [int(tweet["id"]) for tweet in tweets if str(tweet.get("id") or "").isdigit()]
+    if current:
+        ids.append(int(current))
+    return str(max(ids)) if ids else None
+
+
 
-    
-    # Convert created_at strings to datetime objects
-    tweets = []
-    for tweet in data["tweets"]:
-        created_at = datetime.datetime.fromisoformat(tweet["created_at"].replace('Z', ''))
-        tweets.append({
-            "text": tweet["text"],
-            "created_at": created_at
-        })
 
-    print(f"✅ Loaded {len(tweets)} sample tweets")
-    # Update last scanned date for this user
-    await save_last_scanned_date(username, db)
-    return tweets
+async def fetch_sample_tweets(username: str, since_id: str = None, next_token: str = None):
+    """Yield pre-generated sample tweets in pages, for testing without Twitter API."""
+    # Parsing happens once per corpus change (and mapping once per process), off the event loop
+    await asyncio.to_thread(sample_corpus.open)
+
+    # Like the API, only tweets newer than the watermark are returned
+    for page in sample_corpus.pages(username, since_id, next_token, PAGE_SIZE):
+        yield page
 
 
 
@@ -74,73 +91,94 @@ async def fetch_sample_tweets(username: str, db: AsyncSession):
       stop=stop_after_attempt(3),
       wait=wait_exponential(multiplier=1, min=2, max=30), 
       retry=retry_if_exception_type((
-          ConnectionError, 
-          TimeoutError,
-          tweepy.errors.TwitterServerError
-      ))
+          httpx.TransportError,
+          TwitterServerError
+      )),
+      before_sleep=count_retry("twitter")
 )
-async def fetch_tweets_page_with_retry(**kwargs):
-    return await client.search_recent_tweets(**kwargs)
+async def fetch_tweets_page_with_retry(params: dict) -> dict:
+    await twitter_governor.acquire()
+    with TWITTER_PAGE_FETCH_SECONDS.time():
+        response = await client.get("/tweets/search/recent", params=params)
+
+    if response.status_code == 429:
+        # Pause every scan until the 15-minute window resets
+        reset_at = response.headers.get("x-rate-limit-reset")
+        pause = max(1.0, float(reset_at) - datetime.datetime.now().timestamp()) if reset_at else 60.0
+        twitter_governor.pause(pause)
+        RATE_LIMIT_HITS.inc(upstream="twitter")
+        raise TooManyRequests(f"Twitter rate limit reached: {response.text}", retry_after=pause)
+    if response.status_code >= 500:
+        raise TwitterServerError(f"Twitter server error {response.status_code}: {response.text}")
+    response.raise_for_status()
+    return response.json()
+
+
+
+
+def parse_tweets_page(payload: dict) -> list:
+    """Convert a recent search response page into tweet dicts."""
+    return [
+        {
+            "id": tweet.get("id"),
+            "text": tweet["text"],
+            "created_at": datetime.datetime.fromisoformat(tweet["created_at"].replace('Z', '')) if tweet.get("created_at") else None
+        }
+        for tweet in payload.get("data") or []
+    ]
+
 
 
 
+async def fetch_all_tweets(username: str, since_id: str = None, start_time: datetime.datetime = None, next_token: str = None):
+    """
+    Yield the user's tweets page by page, as soon as each page arrives.
 
-async def fetch_all_tweets(username: str, db: AsyncSession):
+    Only tweets newer than `since_id` (or, for users scanned before IDs were tracked, posted after
+    `start_time`) are fetched. Each item is a (tweets, next_token) pair; passing a yielded next_token
+    back in, with the same `since_id`/`start_time`, resumes the pagination right after that page.
+    Hitting the rate limit raises TooManyRequests, so the caller can checkpoint and resume later
+    instead of treating a partial fetch as complete.
+    """
     # Check if we should use sample data for testing
     if USE_SAMPLE_DATA:
-        print(f"🔍 Using sample tweets data")
-        return await fetch_sample_tweets(username, db)
-    
-    # Get last scanned date for this user
-    last_scanned = await get_last_scanned_date(username, db)
-    
-    query = f"from:{username} -is:retweet"
-    tweet_list = []
-    next_token = None
-        
-    kwargs = {
-        "query": query,
-        "max_results": 100,  # Fetch up to 100 tweets per request
-        "tweet_fields": ["created_at", "text"]
+        logger.info("Using sample tweets data", extra={"username": username})
+        async for page in fetch_sample_tweets(username, since_id, next_token):
+            yield page
+        return
+
+    params = {
+        "query": f"from:{username} -is:retweet",
+        "max_results": PAGE_SIZE,  # Fetch up to 100 tweets per request
+        "tweet.fields": "created_at,text"
     }
-    if last_scanned:
-        kwargs["start_time"] = last_scanned
+    if since_id:
+        params["since_id"] = since_id
+    elif start_time:
+        params["start_time"] = start_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    if next_token:
+        params["next_token"] = next_token
 
 
-    print(f'🚀 Start fetching tweets for {username} from date: {last_scanned}')
+    logger.info("Start fetching tweets", extra={"username": username, "since_id": since_id, "resuming": bool(next_token)})
+    fetched_count = 0
     # Fetch tweets with pagination
     while True:
         try:
-            print(f'🔍 Fetching tweets for {username} from date: {last_scanned}')
-            tweets = await fetch_tweets_page_with_retry(**kwargs)
-            print(f'🔍 Tweets response for {username}: {tweets}')
-                
-            if tweets.data:
-                tweet_list.extend([
-                    {
-                        "text": tweet.text, 
-                        "created_at": tweet.created_at
-                    } 
-                    for tweet in tweets.data
-                ])
-
-            # Check if there is a next token for pagination
-            if not hasattr(tweets, 'meta') or not tweets.meta.get('next_token'):
-                break  # No more tweets to fetch
-                        
-            next_token = tweets.meta.get('next_token')
-            kwargs["next_token"] = next_token
-
+            payload = await fetch_tweets_page_with_retry(params)
         except TooManyRequests:
-            if tweet_list:
-                print(f"❌ Got Rate limit error, but fetched {len(tweet_list)} tweets from previous page")
-                break
+            logger.warning("Twitter rate limit hit during pagination", extra={"username": username, "fetched": fetched_count})
             raise
 
+        page = parse_tweets_page(payload)
+        next_token = payload.get("meta", {}).get("next_token")
+        if page:
+            fetched_count += len(page)
+            yield page, next_token
+
+        # Check if there is a next token for pagination
+        if not next_token:
+            break  # No more tweets to fetch
+        params["next_token"] = next_token
 
-    # Update the last scanned date after successfully fetching tweets
-    if tweet_list:
-        print(f"✅ Successfully fetched {len(tweet_list)} tweets for {username}")
-        await save_last_scanned_date(username, db)
-    
-    return tweet_list
\ No newline at end of file
+    logger.info("Fetched tweets", extra={"username": username, "fetched": fetched_count})
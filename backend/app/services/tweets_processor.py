@@ -1,47 +1,353 @@
+from openai import RateLimitError
 import asyncio
-from app.services.tweets_fetcher import fetch_all_tweets
-from app.services.openai_predictor import check_tweet_compliance
-from app.core.models import Violation
+import datetime
+import logging
+import time
+from app.services.tweets_fetcher import fetch_all_tweets, load_scan_state, newest_tweet_id, TooManyRequests
+from app.services.openai_predictor import check_tweet_compliance, classify_tweets, unknown_verdict
+from app.services.verdict_cache import verdict_cache, hash_tweet_text
+from app.services.policy_registry import CompiledPolicy
+from app.services.violation_sink import ViolationSink
+from app.services.prefilter import prefilter_registry, assess_texts, PREFILTER_SAFE
+from app.services.dedup import dedup_scope, text_features
+from app.services.cpu_pool import cpu_pool
+from app.core.config import USE_BATCH_CLASSIFICATION, USE_VERDICT_CACHE, TWITTER_PAGE_PREFETCH, PREFILTER_ENABLED
+from app.services.scan_scheduler import scheduler
+from app.core.metrics import SCAN_USER_SECONDS, VIOLATIONS_FOUND, TWEETS_CLASSIFIED
+from app.core.models import UnclassifiedTweet
+from app.core.database import session_scope
 from sqlalchemy.ext.asyncio import AsyncSession
 
 
+logger = logging.getLogger(__name__)
 
 
-async def process_user_tweets(username: str, policy_rules: list, session: AsyncSession):
-    user_violate_tweets = []
-    tweets = await fetch_all_tweets(username, session)
-    print(f'✅ Fetched {len(tweets)} tweets for {username}')
 
-    async def process_single_tweet(tweet_data):
+
+def build_violations(username: str, tweet_data: dict, compliance_result: dict, policy: CompiledPolicy) -> list:
+    """Create one violation row per rule a positive compliance verdict reports, attributed through the policy's rules."""
+    if not compliance_result or compliance_result.get("violation") != "YES":
+        return []
+
+    # Verdicts cached before multi-policy evaluation carry a single violation at the top level
+    reported = compliance_result.get("violations")
+    if not isinstance(reported, list) or not reported:
+        reported = [compliance_result]
+
+    rows = []
+    for violation in reported:
+        if not isinstance(violation, dict):
+            continue
+        policy_title, rule_violated = policy.attribute(violation)
+        rows.append({
+            "username": username,
+            "tweet": tweet_data["text"],
+            "policy": policy_title,
+            "rule_id": str(violation.get("rule_id") or "").strip("[] "),
+            "rule_violated": rule_violated or violation.get("rule_violated", ""),
+            "reason": violation.get("reason", ""),
+            "posted_at": tweet_data.get("created_at")
+        })
+    return rows
+
+
+
+
+async def classify_per_tweet(username: str, texts: list, policy: CompiledPolicy, user_scope=None) -> list:
+    """Fallback path: one compliance request per tweet."""
+    verdicts = [None] * len(texts)
+    user_scope = user_scope or scheduler.user_scope()
+
+    async def process_single_tweet(index, text):
         try:
-            compliance_result = await check_tweet_compliance(tweet_data["text"], policy_rules)
-            if compliance_result.get("violation") == "YES":
-                violation = Violation(
-                    username=username,
-                    tweet=compliance_result.get("tweet", ""),
-                    policy=compliance_result.get("policy", ""),
-                    rule_id=compliance_result.get("rule_id", ""),
-                    rule_violated=compliance_result.get("rule_violated", ""),
-                    reason=compliance_result.get("reason", ""),
-                    posted_at=tweet_data.get("created_at", "")
-                )
-                user_violate_tweets.append(violation)
-                print(f'🚨 Violation found for tweet: {tweet_data["text"]}, by user: {username}')
+            async with scheduler.tweet_slots(user_scope, 1):
+                verdicts[index] = await check_tweet_compliance(text, policy)
 
         except Exception as e:
-            print(f'❌ Error processing a specific tweet from {username}, Error: {str(e)}')
+            logger.error("Error classifying a tweet", extra={"username": username, "error": str(e)})
+            verdicts[index] = unknown_verdict(text, str(e))
 
 
-    tasks = [asyncio.create_task(process_single_tweet(tweet)) for tweet in tweets]
+    tasks = [asyncio.create_task(process_single_tweet(index, text)) for index, text in enumerate(texts)]
     # Wait for all tasks to complete (concurrent execution)
     await asyncio.gather(*tasks)
+    return verdicts
+
+
+
+
+def build_unclassified(username: str, tweet_data: dict, compliance_result: dict, policy: CompiledPolicy, now: datetime.datetime):
+    """Row recording a tweet left without a verdict, or None when it was classified."""
+    if compliance_result and compliance_result.get("violation") in ("YES", "NO"):
+        return None
+    return UnclassifiedTweet(
+        username=username,
+        policy=policy.name,
+        tweet_id=tweet_data.get("id"),
+        tweet=tweet_data["text"],
+        error=(compliance_result or {}).get("error", "No verdict"),
+        posted_at=tweet_data.get("created_at"),
+        created_at=now
+    )
+
+
+
+
+async def classify_batched(username: str, texts: list, policy: CompiledPolicy, user_scope=None) -> list:
+    """Default path: several tweets per compliance request (failed batches fall back to per-tweet requests)."""
+    return await classify_tweets(texts, policy, user_scope)
+
+
+
+
+def page_features(texts: list, near_duplicates: bool) -> list:
+    """(verdict cache hash, dedup text_features) per text: a page's normalization and hashing, run by the CPU pool."""
+    return [(hash_tweet_text(text), text_features(text, near_duplicates)) for text in texts]
+
+
+
+
+async def prefilter_safe_texts(policy: CompiledPolicy, pending: dict) -> dict:
+    """Remove clearly safe texts from `pending` (hash -> text), returning NO verdicts for them."""
+    if not PREFILTER_ENABLED or not pending:
+        return {}
+
+    safe = {}
+    decisions = await cpu_pool.map_chunks(assess_texts, list(pending.values()), policy)
+    prefilter_registry.record(decisions)
+    for tweet_hash, decision in zip(list(pending), decisions):
+        if decision == PREFILTER_SAFE:
+            safe[tweet_hash] = {"violation": "NO", "source": "prefilter"}
+            del pending[tweet_hash]
+    return safe
+
+
+
+
+async def classify_with_cache(username: str, texts: list, policy: CompiledPolicy, session: AsyncSession, use_batching: bool, user_scope) -> list:
+    """
+    Return one verdict per text, only sending texts missing from the verdict cache (and not pre-filtered) to the LLM.
+
+    Duplicates, within this page or across every scan running in the process, are classified once.
+    """
+    classify = classify_batched if use_batching else classify_per_tweet
+
+    async def classify_texts(unique_texts):
+        return await classify(username, unique_texts, policy, user_scope)
+
+    # With the CPU pool, the page is normalized and hashed in the worker processes up front
+    features = await cpu_pool.map_chunks(page_features, texts, dedup_scope.near_duplicates) if cpu_pool.enabled else None
+
+    if not USE_VERDICT_CACHE:
+        pending = dict(enumerate(texts))
+        prefiltered = await prefilter_safe_texts(policy, pending)
+        TWEETS_CLASSIFIED.inc(len(prefiltered), source="prefilter")
+        TWEETS_CLASSIFIED.inc(len(pending), source="llm")
+        dedup_features = {index: feature[1] for index, feature in enumerate(features)} if features else None
+        results = await dedup_scope.classify(pending, policy.content_hash, classify_texts, dedup_features) if pending else {}
+        return [prefiltered.get(index) or results.get(index) for index in range(len(texts))]
+
+    policy_hash = policy.content_hash
+    hashes = [feature[0] for feature in features] if features else [hash_tweet_text(text) for text in texts]
+    # Separate scopes around the LLM round-trips, so no pooled connection sits idle through them
+    async with session_scope(session) as db:
+        cached = await verdict_cache.get_many(db, texts, policy_hash, hashes)
+
+    # Identical texts are classified once
+    pending = {}
+    for tweet_hash, text in zip(hashes, texts):
+        if tweet_hash not in cached and tweet_hash not in pending:
+            pending[tweet_hash] = text
+    # Pre-filter verdicts aren't cached, they'd outlive a retrained model or changed thresholds
+    prefiltered = await prefilter_safe_texts(policy, pending)
+    cache_hits = sum(1 for tweet_hash in hashes if tweet_hash in cached)
+    TWEETS_CLASSIFIED.inc(cache_hits, source="cache")
+    TWEETS_CLASSIFIED.inc(len(prefiltered), source="prefilter")
+    TWEETS_CLASSIFIED.inc(len(texts) - cache_hits - len(prefiltered), source="llm")
+    logger.debug("Verdict cache lookup", extra={"username": username, "tweets": len(texts), "llm_pending": len(pending)})
 
-    
-    # commit the violations to the database
-    if user_violate_tweets:
-        print(f'🔍 Found {len(user_violate_tweets)} violations for {username}')
-        session.add_all(user_violate_tweets)
-        await session.commit()
-        print(f'✅ Committed {len(user_violate_tweets)} violations for {username} to the database')
+    fresh = {}
+    if pending:
+        dedup_features = {tweet_hash: feature[1] for tweet_hash, feature in zip(hashes, features)} if features else None
+        results = await dedup_scope.classify(pending, policy_hash, classify_texts, dedup_features)
+        for tweet_hash, verdict in results.items():
+            # Only definite YES/NO outcomes are worth caching, errors must be retried next scan
+            if verdict and verdict.get("violation") in ("YES", "NO"):
+                fresh[tweet_hash] = {key: value for key, value in verdict.items() if key != "tweet"}
+        async with session_scope(session) as db:
+            await verdict_cache.put_many(db, fresh, policy_hash, pending)
+
+    return [cached.get(tweet_hash) or fresh.get(tweet_hash) or prefiltered.get(tweet_hash) for tweet_hash in hashes]
+
+
+
+
+# Recent search only reaches this far back, so a first scan covers at most this many days of posts
+RECENT_SEARCH_DAYS = 7
+
+# Weight of the latest scan in the smoothed posting rate
+POSTING_RATE_SMOOTHING = 0.5
+
+
+
+
+def update_posting_rate(state, tweets_count: int, now: datetime.datetime):
+    """Fold the tweets found by a completed scan into the user's smoothed tweets/day."""
+    if state.last_scanned_at:
+        days = max((now - state.last_scanned_at).total_seconds() / 86400, 1 / 1440)
+    else:
+        days = RECENT_SEARCH_DAYS
+    rate = tweets_count / days
+    if state.tweets_per_day is None:
+        state.tweets_per_day = rate
     else:
-        print(f'🎉 No violations found for {username}')
+        state.tweets_per_day = POSTING_RATE_SMOOTHING * rate + (1 - POSTING_RATE_SMOOTHING) * state.tweets_per_day
+
+
+
+
+async def prefetch_pages(pages, depth: int = TWITTER_PAGE_PREFETCH):
+    """Iterate an async page generator while a background task fetches up to `depth` pages ahead."""
+    queue = asyncio.Queue(maxsize=depth)
+    end_of_pages = object()
+
+    async def produce():
+        try:
+            async for page in pages:
+                await queue.put(page)
+            await queue.put(end_of_pages)
+        except Exception as e:
+            # Hand the failure to the consumer so it surfaces where the pages are used
+            await queue.put(e)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            page = await queue.get()
+            if page is end_of_pages:
+                break
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        producer.cancel()
+
+
+
+
+async def process_user_tweets(
+    username: str,
+    policy: CompiledPolicy,
+    session: AsyncSession = None,
+    use_batching: bool = USE_BATCH_CLASSIFICATION,
+    on_checkpoint=None,
+    pages=None
+):
+    """
+    Fetch, classify and store the user's tweets newer than their watermark, page by page.
+
+    The scan runs as fetch -> classify -> persist stages, and only borrows a database session
+    (see session_scope) for the watermark read, the verdict cache and each persist, so no
+    connection is held through the Twitter pagination or the LLM round-trips. Pass `session`
+    to run every stage on that session instead.
+
+    Violations are written through a ViolationSink, committed whenever VIOLATION_FLUSH_SIZE rows
+    are buffered at a page boundary. Tweets the model couldn't classify are recorded as
+    UnclassifiedTweet rows in the same commits, never as passing. Each commit also records the pagination checkpoint
+    on the user's ScannedUser row for this policy, so an interrupted scan (crash, rate limit) resumes after
+    its last committed page; the since_id watermark only moves once the whole scan is committed, and
+    only for this policy, a scan under another policy still sees every tweet.
+    `on_checkpoint(next_token, pages, tweets_count, violations_count, session)` is awaited right before
+    each commit with what it covers and the session committing it, so a caller can record its own
+    progress in the same transaction, or raise to stop the scan without that commit.
+    `pages` replaces the live fetch with another async source of (tweets, next_token) pages, e.g. an
+    archive replay; such a scan leaves the user's watermark and checkpoint untouched.
+    """
+    # In-flight tweets of this user are bounded on top of the process-wide limit
+    user_scope = scheduler.user_scope()
+    started = time.perf_counter()
+    sink = ViolationSink(session)
+    async with session_scope(session) as db:
+        state = await load_scan_state(username, policy.name, db)
+
+    # A leftover checkpoint means the previous scan was interrupted, resume it with the same bounds
+    replay = pages is not None
+    resume_token = None if replay else state.next_token
+    newest_id = state.pending_since_id if resume_token else None
+    if resume_token:
+        logger.info("Resuming interrupted scan", extra={"username": username, "since_id": state.since_id})
+    if not replay:
+        pages = fetch_all_tweets(username, state.since_id, None if state.since_id else state.last_scanned_at, resume_token)
+
+    fetched_count = 0
+    pending_pages = 0
+    pending_tweets = 0
+    classified_token = resume_token
+    unclassified = []
+
+    def record_progress():
+        # Lifetime counters used to prioritize monitored accounts
+        state.tweets_seen = (state.tweets_seen or 0) + pending_tweets
+        state.violations_seen = (state.violations_seen or 0) + len(sink.pending)
+
+    async def persist(next_token, complete: bool = False):
+        """Commit the buffered violations, unclassified tweets and scan state in one short transaction."""
+        async with session_scope(session) as db:
+            # The state row was loaded in an earlier scope, adding it back keeps its changes
+            db.add(state)
+            # Added right before the commit, so autoflush can't open a write transaction early
+            db.add_all(list(unclassified))
+            unclassified.clear()
+            if on_checkpoint and pending_pages:
+                await on_checkpoint(next_token, pending_pages, pending_tweets, len(sink.pending), db)
+            record_progress()
+            if complete and not replay:
+                now = datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+                update_posting_rate(state, fetched_count, now)
+                state.since_id = newest_id or state.since_id
+                state.pending_since_id = None
+                state.next_token = None
+                state.last_scanned_at = now
+            elif not replay:
+                state.next_token = next_token
+                state.pending_since_id = newest_id
+            await sink.flush(db)
+
+    try:
+        # The fetcher doesn't use the database, so page N+1 is fetched while page N is being classified
+        async for tweets, next_token in prefetch_pages(pages):
+            fetched_count += len(tweets)
+            texts = [tweet["text"] for tweet in tweets]
+            verdicts = await classify_with_cache(username, texts, policy, session, use_batching, user_scope)
+
+            now = datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+            for tweet_data, compliance_result in zip(tweets, verdicts):
+                row = build_unclassified(username, tweet_data, compliance_result, policy, now)
+                if row is not None:
+                    unclassified.append(row)
+                violations = build_violations(username, tweet_data, compliance_result, policy)
+                if violations:
+                    sink.add(violations)
+                    VIOLATIONS_FOUND.inc(len(violations))
+                    logger.info("Violation found", extra={"username": username, "tweet_id": tweet_data.get("id"), "rule_ids": [v["rule_id"] for v in violations]})
+
+            newest_id = newest_tweet_id(tweets, newest_id)
+            classified_token = next_token
+            pending_pages += 1
+            pending_tweets += len(tweets)
+            # Flush full chunks; with nothing buffered a checkpoint-only commit is cheap, so take it
+            if sink.is_full or not sink.pending:
+                await persist(next_token)
+                pending_pages = pending_tweets = 0
+    except (TooManyRequests, RateLimitError):
+        # Keep what was classified, the next scan resumes right after it
+        if pending_pages:
+            await persist(classified_token)
+        raise
+
+    # The scan is complete: advance the watermark and clear the checkpoint in the same commit
+    # as the remaining violations
+    await persist(None, complete=True)
+
+    logger.info("Scanned user", extra={"username": username, "tweets": fetched_count, "violations": sink.written})
+    SCAN_USER_SECONDS.observe(time.perf_counter() - started)
@@ -0,0 +1,172 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.models import CachedVerdict
+from app.core.database import AsyncSessionLocal, dialect_insert
+from app.services.periodic import run_periodically
+from app.core.config import VERDICT_CACHE_MAX_SIZE, VERDICT_CACHE_TTL_SECONDS, VERDICT_CACHE_PURGE_INTERVAL_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+
+
+
+def normalize_tweet_text(text: str) -> str:
+    """Normalize tweet text so trivial whitespace/case differences share a cache entry."""
+    return " ".join(text.split()).casefold()
+
+
+
+
+def hash_tweet_text(text: str) -> str:
+    return hashlib.sha256(normalize_tweet_text(text).encode("utf-8")).hexdigest()
+
+
+
+
+def utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+
+
+
+
+class VerdictCache:
+    """Two-level verdict cache: in-memory LRU in front of the `verdict_cache` table."""
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl = datetime.timedelta(seconds=ttl_seconds)
+        self.entries = OrderedDict()            # (tweet_hash, policy_hash) -> (verdict, stored_at)
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def _remember(self, key: tuple, verdict: dict, stored_at: datetime.datetime):
+        self.entries[key] = (verdict, stored_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def _lookup_memory(self, key: tuple, now: datetime.datetime):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        verdict, stored_at = entry
+        if now - stored_at > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return verdict
+
+
+    async def get_many(self, session: AsyncSession, texts: list, policy_hash: str, hashes: list = None) -> dict:
+        """Return cached verdicts keyed by tweet hash, checking memory first and Postgres for the rest."""
+        now = utc_now()
+        found = {}
+        missing = set()
+        for tweet_hash in hashes or [hash_tweet_text(text) for text in texts]:
+            if tweet_hash in found or tweet_hash in missing:
+                continue
+            verdict = self._lookup_memory((tweet_hash, policy_hash), now)
+            if verdict is not None:
+                found[tweet_hash] = verdict
+                self.memory_hits += 1
+            else:
+                missing.add(tweet_hash)
+
+        if missing:
+            result = await session.execute(
+                select(CachedVerdict.tweet_hash, CachedVerdict.verdict, CachedVerdict.created_at).where(
+                    CachedVerdict.policy_hash == policy_hash,
+                    CachedVerdict.tweet_hash.in_(missing),
+                    CachedVerdict.created_at >= now - self.ttl
+                )
+            )
+            for tweet_hash, verdict_json, created_at in result.all():
+                verdict = json.loads(verdict_json)
+                found[tweet_hash] = verdict
+                missing.discard(tweet_hash)
+                self._remember((tweet_hash, policy_hash), verdict, created_at)
+                self.db_hits += 1
+
+        self.misses += len(missing)
+        return found
+
+
+    async def put_many(self, session: AsyncSession, verdicts: dict, policy_hash: str, texts: dict = None):
+        """Store verdicts (tweet hash -> verdict) in memory and Postgres, with the tweet texts (hash -> text) if given."""
+        if not verdicts:
+            return
+
+        now = utc_now()
+        rows = []
+        for tweet_hash, verdict in verdicts.items():
+            self._remember((tweet_hash, policy_hash), verdict, now)
+            rows.append({
+                "tweet_hash": tweet_hash,
+                "policy_hash": policy_hash,
+                "verdict": json.dumps(verdict),
+                "tweet_text": (texts or {}).get(tweet_hash),
+                "created_at": now
+            })
+
+        # Concurrent scans may classify the same tweet; refresh the row instead of failing
+        statement = dialect_insert(session, CachedVerdict).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=["tweet_hash", "policy_hash"],
+            set_={"verdict": statement.excluded.verdict, "created_at": statement.excluded.created_at}
+        )
+        await session.execute(statement)
+        await session.commit()
+
+
+    async def invalidate_policy(self, session: AsyncSession, policy_hash: str):
+        """Drop every cached verdict computed against the given policy content."""
+        for key in [key for key in self.entries if key[1] == policy_hash]:
+            del self.entries[key]
+        await session.execute(delete(CachedVerdict).where(CachedVerdict.policy_hash == policy_hash))
+        await session.commit()
+
+
+    async def purge_expired(self, session: AsyncSession) -> int:
+        """Delete rows older than the TTL from Postgres, returning how many were deleted."""
+        result = await session.execute(delete(CachedVerdict).where(CachedVerdict.created_at < utc_now() - self.ttl))
+        await session.commit()
+        return result.rowcount or 0
+
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.db_hits) / lookups, 4) if lookups else 0.0
+        }
+
+
+
+
+# Process-wide cache instance
+verdict_cache = VerdictCache(VERDICT_CACHE_MAX_SIZE, VERDICT_CACHE_TTL_SECONDS)
+
+
+
+
+async def run_verdict_cache_purger(stop_event: asyncio.Event):
+    """Delete expired verdict cache rows every VERDICT_CACHE_PURGE_INTERVAL_SECONDS until `stop_event` is set."""
+    async def purge():
+        async with AsyncSessionLocal() as session:
+            purged = await verdict_cache.purge_expired(session)
+        if purged:
+            logger.info("Purged expired cached verdicts", extra={"rows": purged})
+
+    await run_periodically(purge, VERDICT_CACHE_PURGE_INTERVAL_SECONDS, stop_event, "verdict_cache_purge")
@@ -0,0 +1,129 @@
+import datetime
+from collections import Counter
+from sqlalchemy import select, func, and_, true
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.database import dialect_insert
+from app.core.models import Violation, ViolationRollup
+
+
+# Columns each stats grouping is keyed by
+ROLLUP_GROUPS = {
+    "user": (ViolationRollup.username,),
+    "policy": (ViolationRollup.policy,),
+    "rule": (ViolationRollup.policy, ViolationRollup.rule_id),
+    "day": (ViolationRollup.day,)
+}
+
+
+
+
+def rollup_counts(rows: list) -> list:
+    """Collapse violation rows into one rollup increment per (day, username, policy, rule_id)."""
+    counts = Counter()
+    for row in rows:
+        posted_at = row["posted_at"]
+        day = posted_at.date() if isinstance(posted_at, datetime.datetime) else posted_at
+        counts[(day, row["username"] or "", row["policy"], row["rule_id"])] += 1
+    return [
+        {"day": day, "username": username, "policy": policy, "rule_id": rule_id, "violations": count}
+        for (day, username, policy, rule_id), count in counts.items()
+    ]
+
+
+
+
+async def add_to_rollups(session: AsyncSession, rows: list):
+    """Add violation rows to the rollup counts, in the caller's transaction (no commit)."""
+    increments = rollup_counts(rows)
+    if not increments:
+        return
+    statement = dialect_insert(session, ViolationRollup).values(increments)
+    statement = statement.on_conflict_do_update(
+        index_elements=["day", "username", "policy", "rule_id"],
+        set_={"violations": ViolationRollup.violations + statement.excluded.violations}
+    )
+    await session.execute(statement)
+
+
+
+
+def backfill_rollups(sync_conn):
+    """
+    Build the rollups from the stored violations when the rollup table is still empty.
+
+    The API and the workers may start together and all find the table empty; rows another
+    process already inserted are skipped instead of failing startup on the unique key.
+    """
+    if sync_conn.execute(select(ViolationRollup.id).limit(1)).first() is not None:
+        return
+    day = func.date(Violation.posted_at)
+    username = func.coalesce(Violation.username, "")
+    insert_rollups = sqlite.insert(ViolationRollup) if sync_conn.dialect.name == "sqlite" else postgresql.insert(ViolationRollup)
+    sync_conn.execute(
+        insert_rollups.from_select(
+            ["day", "username", "policy", "rule_id", "violations"],
+            # WHERE keeps SQLite from parsing the ON CONFLICT as a join constraint
+            select(day, username, Violation.policy, Violation.rule_id, func.count())
+            .where(true())
+            .group_by(day, username, Violation.policy, Violation.rule_id)
+        ).on_conflict_do_nothing(index_elements=["day", "username", "policy", "rule_id"])
+    )
+
+
+
+
+def build_rollup_conditions(start_date, end_date, username, policy, rule_id) -> list:
+    conditions = []
+    if start_date:
+        conditions.append(ViolationRollup.day >= start_date)
+    if end_date:
+        conditions.append(ViolationRollup.day <= end_date)
+    if username:
+        conditions.append(ViolationRollup.username == username)
+    if policy:
+        conditions.append(ViolationRollup.policy == policy)
+    if rule_id:
+        conditions.append(ViolationRollup.rule_id == rule_id)
+    return conditions
+
+
+
+
+async def violation_stats(session: AsyncSession, group_by: str, conditions: list, limit: int) -> dict:
+    """Violation counts grouped by user, policy, rule or day (largest first, days newest first), plus the total."""
+    columns = ROLLUP_GROUPS[group_by]
+    count = func.sum(ViolationRollup.violations).label("violations")
+    query = select(*columns, count).group_by(*columns).limit(limit)
+    query = query.order_by(ViolationRollup.day.desc()) if group_by == "day" else query.order_by(count.desc(), *columns)
+    total_query = select(func.coalesce(func.sum(ViolationRollup.violations), 0))
+    if conditions:
+        query = query.where(and_(*conditions))
+        total_query = total_query.where(and_(*conditions))
+
+    result = await session.execute(query)
+    groups = [dict(row) for row in result.mappings().all()]
+    total = await session.scalar(total_query)
+    return {"group_by": group_by, "total": total or 0, "groups": groups}
+
+
+
+
+async def top_offenders(session: AsyncSession, conditions: list, limit: int) -> list:
+    """Users with the most violations, with how many distinct rules they broke and their latest violation day."""
+    count = func.sum(ViolationRollup.violations).label("violations")
+    query = (
+        select(
+            ViolationRollup.username,
+            count,
+            func.count(func.distinct(ViolationRollup.rule_id)).label("rules"),
+            func.max(ViolationRollup.day).label("last_violation_day")
+        )
+        .group_by(ViolationRollup.username)
+        .order_by(count.desc(), ViolationRollup.username)
+        .limit(limit)
+    )
+    if conditions:
+        query = query.where(and_(*conditions))
+    result = await session.execute(query)
+    return [dict(row) for row in result.mappings().all()]
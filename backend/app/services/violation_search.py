@@ -0,0 +1,73 @@
+from sqlalchemy import select, func, literal_column, literal, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.models import Violation, VIOLATION_SEARCH_DOCUMENT
+from app.services.semantic_index import semantic_index, embed_texts
+
+
+# Filters apply after similarity ranking, so filtered semantic searches rank this many times the page
+SEMANTIC_FILTER_OVERFETCH = 4
+
+# IDs looked up per query, below the bind parameter limit of asyncpg
+ID_LOOKUP_CHUNK = 5000
+
+
+
+
+def like_pattern(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+
+
+async def keyword_search(session: AsyncSession, query: str, columns: tuple, conditions: list, limit: int, offset: int) -> list:
+    """
+    Violations whose tweet or reason match the query, best first.
+
+    On Postgres this is a full-text search (web search syntax: quotes, OR, -term) ranked by
+    ts_rank_cd over the GIN index. Elsewhere every term must appear, newest first.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        tsquery = func.websearch_to_tsquery(literal_column("'english'"), query)
+        score = func.ts_rank_cd(VIOLATION_SEARCH_DOCUMENT, tsquery).label("score")
+        statement = (
+            select(*columns, score)
+            .where(VIOLATION_SEARCH_DOCUMENT.op("@@")(tsquery))
+            .order_by(score.desc(), Violation.id.desc())
+        )
+    else:
+        terms = [
+            or_(Violation.tweet.ilike(like_pattern(term), escape="\\"), Violation.reason.ilike(like_pattern(term), escape="\\"))
+            for term in query.split()
+        ]
+        statement = (
+            select(*columns, literal(None).label("score"))
+            .where(*terms)
+            .order_by(Violation.posted_at.desc(), Violation.id.desc())
+        )
+
+    if conditions:
+        statement = statement.where(and_(*conditions))
+    result = await session.execute(statement.limit(limit).offset(offset))
+    return [dict(row) for row in result.mappings().all()]
+
+
+
+
+async def semantic_search(session: AsyncSession, query: str, columns: tuple, conditions: list, limit: int, offset: int) -> list:
+    """Violations most similar in meaning to the query, from the embedding index, best first."""
+    query_vector = (await embed_texts([query]))[0]
+    ranked = await semantic_index.search(query_vector, (offset + limit) * (SEMANTIC_FILTER_OVERFETCH if conditions else 1))
+    if not conditions:
+        ranked = ranked[offset:]
+    scores = dict(ranked)
+
+    rows = {}
+    ids = list(scores)
+    for start in range(0, len(ids), ID_LOOKUP_CHUNK):
+        statement = select(*columns).where(Violation.id.in_(ids[start:start + ID_LOOKUP_CHUNK]), *conditions)
+        result = await session.execute(statement)
+        rows.update((row["id"], dict(row)) for row in result.mappings().all())
+
+    matches = [{**rows[violation_id], "score": round(score, 4)} for violation_id, score in ranked if violation_id in rows]
+    return matches[offset:offset + limit] if conditions else matches[:limit]
@@ -0,0 +1,66 @@
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.models import Violation
+from app.core.config import VIOLATION_FLUSH_SIZE, VIOLATION_SINK_USE_COPY
+from app.services.violation_rollups import add_to_rollups
+
+
+VIOLATION_FIELDS = ["username", "tweet", "policy", "rule_id", "rule_violated", "reason", "posted_at"]
+
+
+
+
+class ViolationSink:
+    """
+    Buffers violation rows and writes them in bulk, on its own session or the one given to each flush.
+
+    On Postgres (asyncpg) rows go through COPY on the session's own connection, elsewhere
+    through multi-row INSERT statements. Both run inside the session transaction, together
+    with the matching violation_rollups increments, so whatever else the caller changed in
+    the session is committed atomically with them.
+    """
+
+    def __init__(self, session: AsyncSession = None, flush_size: int = VIOLATION_FLUSH_SIZE, use_copy: bool = VIOLATION_SINK_USE_COPY):
+        self.session = session
+        self.flush_size = flush_size
+        self.use_copy = use_copy
+        self.pending = []
+        self.written = 0
+
+    def add(self, rows: list):
+        """Buffer violation rows (dicts keyed by VIOLATION_FIELDS)."""
+        self.pending.extend(rows)
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.pending) >= self.flush_size
+
+
+    async def _copy_rows(self, session: AsyncSession, rows: list):
+        connection = await session.connection()
+        raw_connection = await connection.get_raw_connection()
+        await raw_connection.driver_connection.copy_records_to_table(
+            Violation.__tablename__,
+            records=[tuple(row[field] for field in VIOLATION_FIELDS) for row in rows],
+            columns=VIOLATION_FIELDS
+        )
+
+
+    async def flush(self, session: AsyncSession = None):
+        """Write every buffered row in chunks of `flush_size` and commit, on `session` if given."""
+        session = session or self.session
+        rows, self.pending = self.pending, []
+        copy_supported = self.use_copy and session.get_bind().dialect.driver == "asyncpg"
+
+        # First, as a SQLAlchemy statement: the asyncpg adapter only begins its transaction on the
+        # first statement it executes, a COPY issued before that on the raw connection would autocommit
+        await add_to_rollups(session, rows)
+        for start in range(0, len(rows), self.flush_size):
+            chunk = rows[start:start + self.flush_size]
+            if copy_supported:
+                await self._copy_rows(session, chunk)
+            else:
+                await session.execute(insert(Violation).values(chunk))
+
+        await session.commit()
+        self.written += len(rows)
@@ -0,0 +1,114 @@
+import csv
+import io
+import json
+from sqlalchemy import Select
+from app.core.database import AsyncSessionLocal
+from app.core.config import EXPORT_CHUNK_SIZE
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:         # Parquet export is optional
+    pyarrow = None
+
+
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet"
+}
+
+
+
+
+async def stream_violation_chunks(query: Select, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Yield lists of row dicts from a server-side cursor, `chunk_size` rows at a time.
+
+    A dedicated session is opened because the response body is streamed after the
+    request's own dependencies have been closed.
+    """
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(query.execution_options(yield_per=chunk_size))
+        async for partition in result.mappings().partitions(chunk_size):
+            yield [dict(row) for row in partition]
+
+
+
+
+async def export_ndjson(chunks):
+    async for rows in chunks:
+        yield "".join(json.dumps(row, default=str) + "\n" for row in rows)
+
+
+
+
+async def export_csv(chunks, columns: list):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns)
+    writer.writeheader()
+    async for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    # Header only when there are no rows
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands back whatever was written since the last drain."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+
+
+async def export_parquet(chunks, schema):
+    """Stream a Parquet file, one row group per chunk."""
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    try:
+        async for rows in chunks:
+            writer.write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+
+
+def violations_parquet_schema():
+    return pyarrow.schema([
+        ("id", pyarrow.int64()),
+        ("username", pyarrow.string()),
+        ("tweet", pyarrow.string()),
+        ("policy", pyarrow.string()),
+        ("rule_id", pyarrow.string()),
+        ("rule_violated", pyarrow.string()),
+        ("reason", pyarrow.string()),
+        ("posted_at", pyarrow.timestamp("us"))
+    ])
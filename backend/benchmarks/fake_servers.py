@@ -0,0 +1,194 @@
+"""
+Local stand-ins for the OpenAI chat completions API and the Twitter v2 recent search API.
+
+Both answer deterministically, with configurable latency, error rate and 429 behavior, so
+benchmark runs can be compared without touching (or paying for) the real services.
+
+    python -m benchmarks.fake_servers --service openai --port 8101 --latency-ms 300
+    python -m benchmarks.fake_servers --service twitter --port 8102 --tweets-per-user 10000
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import re
+import time
+import zlib
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+# Tweets containing this word are classified as violations by the fake model
+VIOLATION_MARKER = "confidential"
+
+# Generated tweets carry the marker once every VIOLATION_EVERY tweets
+VIOLATION_EVERY = 20
+
+BATCH_LINE = re.compile(r'^\s*\[(\d+)\] (".*")\s*$', re.MULTILINE)
+SINGLE_TWEET = re.compile(r'Tweet: (".*")\s*$', re.MULTILINE)
+
+
+
+
+class FaultInjector:
+    """Shared latency, error and rate-limit behavior of a fake server."""
+
+    def __init__(self, latency_ms: float, jitter_ms: float, error_rate: float, rate_limit_rate: float, seed: int):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    async def delay(self):
+        latency = self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+
+    def fault(self):
+        """Return "rate_limit", "error" or None for the current request."""
+        self.requests += 1
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.rate_limited += 1
+            return "rate_limit"
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.errors += 1
+            return "error"
+        return None
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "errors": self.errors, "rate_limited": self.rate_limited}
+
+
+
+
+def classify_text(text: str) -> dict:
+    """The fake model's verdict for one tweet."""
+    if VIOLATION_MARKER in text.lower():
+        return {
+            "violation": "YES",
+            "violations": [{
+                "policy": "Benchmark Policy",
+                "rule_id": "CONFID-001",
+                "rule_violated": "Do not share confidential information",
+                "reason": "The tweet mentions confidential information"
+            }]
+        }
+    return {"violation": "NO", "violations": []}
+
+
+
+
+def completion_response(content: str, prompt_chars: int) -> dict:
+    completion_tokens = len(content) // 4 + 1
+    prompt_tokens = prompt_chars // 4 + 1
+    return {
+        "id": f"chatcmpl-bench-{time.monotonic_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": "gpt-4o-mini",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+    }
+
+
+
+
+def create_openai_app(faults: FaultInjector) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        await faults.delay()
+        fault = faults.fault()
+        if fault == "rate_limit":
+            return JSONResponse({"error": {"message": "Rate limit reached", "type": "requests"}}, status_code=429, headers={"retry-after": "1"})
+        if fault == "error":
+            return JSONResponse({"error": {"message": "Internal server error", "type": "server_error"}}, status_code=500)
+
+        prompt = "\n".join(message["content"] for message in body["messages"] if message["role"] == "user")
+        batch = BATCH_LINE.findall(prompt)
+        if batch:
+            content = {"results": [{"id": tweet_id, **classify_text(json.loads(text))} for tweet_id, text in batch]}
+        else:
+            match = SINGLE_TWEET.search(prompt)
+            content = classify_text(json.loads(match.group(1)) if match else "")
+        return completion_response(json.dumps(content), len(prompt))
+
+    @app.get("/stats")
+    async def stats():
+        return faults.stats()
+
+    return app
+
+
+
+
+def generate_tweet(username: str, index: int, start: datetime.datetime) -> dict:
+    """Deterministic tweet number `index` of a user, newest first."""
+    text = f"Update #{index} from {username}: shipping the next release of our product this week"
+    if index % VIOLATION_EVERY == 0:
+        text = f"Update #{index} from {username}: leaking the confidential roadmap before launch"
+    created_at = start - datetime.timedelta(minutes=index)
+    return {"id": f"{zlib.crc32(username.encode())}{index:07d}", "text": text, "created_at": created_at.strftime("%Y-%m-%dT%H:%M:%S.000Z")}
+
+
+
+
+def create_twitter_app(faults: FaultInjector, tweets_per_user: int) -> FastAPI:
+    app = FastAPI()
+    start = datetime.datetime(2025, 1, 1)
+
+    @app.get("/tweets/search/recent")
+    async def search_recent(query: str, max_results: int = 10, next_token: str = None):
+        await faults.delay()
+        fault = faults.fault()
+        if fault == "rate_limit":
+            return JSONResponse({"title": "Too Many Requests"}, status_code=429, headers={"x-rate-limit-reset": str(int(time.time()) + 1)})
+        if fault == "error":
+            return JSONResponse({"title": "Service Unavailable"}, status_code=503)
+
+        username = re.search(r"from:(\S+)", query).group(1)
+        offset = int(next_token or 0)
+        end = min(offset + max_results, tweets_per_user)
+        payload = {"data": [generate_tweet(username, index, start) for index in range(offset, end)], "meta": {"result_count": end - offset}}
+        if end < tweets_per_user:
+            payload["meta"]["next_token"] = str(end)
+        return payload
+
+    @app.get("/stats")
+    async def stats():
+        return faults.stats()
+
+    return app
+
+
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run a fake upstream API for benchmarks")
+    parser.add_argument("--service", choices=("openai", "twitter"), required=True)
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Mean response latency")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Uniform jitter around the mean latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 5xx")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument("--tweets-per-user", type=int, default=100, help="Tweets returned for every user (twitter only)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    faults = FaultInjector(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate, args.seed)
+    if args.service == "openai":
+        app = create_openai_app(faults)
+    else:
+        app = create_twitter_app(faults, args.tweets_per_user)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
@@ -0,0 +1,41 @@
+import argparse
+import asyncio
+import logging
+from app.core.database import create_tables
+from app.core.config import ARCHIVE_PARSE_WORKERS, ARCHIVE_PARTITIONS
+from app.routes.policy_routes import get_compiled_policies
+from app.services.archive_ingest import ArchiveIngest, INGEST_COMPLETED
+from app.core.logging_config import configure_logging
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between progress log lines
+PROGRESS_INTERVAL_SECONDS = 10
+
+
+
+
+async def main(paths: list, policy_names: list, workers: int, partitions: int) -> bool:
+    await create_tables()
+    ingest = ArchiveIngest(paths, get_compiled_policies(policy_names), workers=workers, partitions=partitions)
+
+    task = asyncio.create_task(ingest.run())
+    while not task.done():
+        await asyncio.wait([task], timeout=PROGRESS_INTERVAL_SECONDS)
+        if not task.done():
+            logger.info("Archive ingest progress", extra=ingest.stats())
+    return ingest.status == INGEST_COMPLETED
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan archived tweet dumps (NDJSON, optionally gzip) through the classification pipeline")
+    parser.add_argument("paths", nargs="+", help="Archive files")
+    parser.add_argument("--policy", dest="policies", action="append", required=True, help="Policy name, repeat to evaluate several together")
+    parser.add_argument("--workers", type=int, default=ARCHIVE_PARSE_WORKERS, help="Processes parsing archive files")
+    parser.add_argument("--partitions", type=int, default=ARCHIVE_PARTITIONS, help="Author partitions of the parsed tweets")
+    args = parser.parse_args()
+    configure_logging()
+    raise SystemExit(0 if asyncio.run(main(args.paths, args.policies, args.workers, args.partitions)) else 1)
@@ -1,23 +1,43 @@
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
+import asyncio
 import os
+import logging
 from app.routes import policy_router, tweet_router, system_router
 from app.core.database import create_tables
-from app.core.config import UPLOAD_DIR
+from app.core.config import UPLOAD_DIR, USE_JOB_QUEUE, SEMANTIC_SEARCH_ENABLED, USE_VERDICT_CACHE
+from app.services.tweets_fetcher import close_client
+from app.services.cpu_pool import cpu_pool
+from app.core.logging_config import configure_logging
+from app.services.semantic_index import run_semantic_indexer
+from app.services.verdict_cache import run_verdict_cache_purger
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: initialize database and create directories
+    # Startup: set up logging, initialize database and create directories
+    configure_logging()
     await create_tables()
+    await cpu_pool.start()
     
     os.makedirs(UPLOAD_DIR, exist_ok=True)
-    print("✅ Application initialized successfully")
+
+    # Without workers the API process keeps the semantic index up to date itself
+    stop_event = asyncio.Event()
+    indexer = asyncio.create_task(run_semantic_indexer(stop_event)) if SEMANTIC_SEARCH_ENABLED and not USE_JOB_QUEUE else None
+    purger = asyncio.create_task(run_verdict_cache_purger(stop_event)) if USE_VERDICT_CACHE else None
+    logging.getLogger(__name__).info("Application initialized successfully")
     
     yield  # Application runs here
     
     # Shutdown: cleanup 
-    pass
+    stop_event.set()
+    if indexer:
+        await indexer
+    if purger:
+        await purger
+    await close_client()
+    cpu_pool.shutdown()
 
 
 
@@ -1,5 +1,5 @@
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 import json
 from io import BytesIO
 
@@ -10,6 +10,22 @@ def test_health_check(client):
     assert "status" in response.json()
     assert response.json()["status"] == "healthy"
 
+def test_scheduler_status(client):
+    """Test scheduler status endpoint."""
+    response = client.get("/system/scheduler")
+    assert response.status_code == 200
+    assert "queue_depth" in response.json()
+    assert set(response.json()["upstreams"]) == {"openai", "twitter"}
+
+def test_metrics_exposition(client):
+    """Test metrics endpoint renders the Prometheus text format."""
+    response = client.get("/system/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE llm_request_seconds histogram" in response.text
+    assert "scheduler_queue_depth " in response.text
+    assert "# TYPE db_pool_checkout_seconds histogram" in response.text
+
 def test_list_policies(client):
     """Test listing available policies."""
     # Mock the route handler to avoid network issues
@@ -32,7 +48,8 @@ def test_process_tweets(client):
     with patch("app.routes.policy_routes.load_policy_rules", 
               return_value=[{"rule_id": "TEST-001", "description": "Test rule"}]):
         with patch("app.routes.tweet_routes.process_user_tweets", 
-                  return_value=None) as mock_process:
+                  return_value=None) as mock_process, \
+             patch("app.routes.tweet_routes.USE_JOB_QUEUE", False):
             
             response = client.post("/tweets/process", json=request_data)
             assert response.status_code == 202
@@ -41,4 +58,181 @@ def test_process_tweets(client):
                 "usernames": ["test_user"],
                 "policy": "employee_social_media_policy",
                 "status": "started"
-            }
\ No newline at end of file
+            }
+
+def test_process_tweets_enqueues_jobs(client, db_session):
+    """Test that processing tweets persists one scan job per username."""
+    def assign_ids(jobs):
+        for job_id, job in enumerate(jobs, start=1):
+            job.id = job_id
+    db_session.add_all.side_effect = assign_ids
+
+    request_data = {"usernames": ["user_a", "user_b"], "policy_name": "employee_social_media_policy"}
+    response = client.post("/tweets/process", json=request_data)
+
+    assert response.status_code == 202
+    assert response.json()["status"] == "queued"
+    assert response.json()["job_ids"] == [1, 2]
+    jobs = db_session.add_all.call_args[0][0]
+    assert [job.username for job in jobs] == ["user_a", "user_b"]
+    assert all(job.status == "queued" for job in jobs)
+
+def test_process_tweets_multiple_policies_single_job(client, db_session):
+    """Test that several policies become one scan job per username, not one per policy."""
+    request_data = {"usernames": ["user_a"], "policy_names": ["employee_social_media_policy", "employee_social_media_policy"]}
+    response = client.post("/tweets/process", json=request_data)
+    assert response.status_code == 202
+    jobs = db_session.add_all.call_args[0][0]
+    assert [job.policy_name for job in jobs] == ["employee_social_media_policy"]
+
+    response = client.post("/tweets/process", json={"usernames": ["user_a"]})
+    assert response.status_code == 422
+
+def test_watch_and_unwatch_users(client, db_session):
+    """Test that watched accounts get their first scan spread over the interval."""
+    request_data = {"usernames": ["user_a", "user_b", "user_a"], "policy_name": "employee_social_media_policy", "interval_minutes": 30}
+    response = client.post("/tweets/watch", json=request_data)
+
+    assert response.status_code == 201
+    watched = response.json()["watched"]
+    assert [watch["username"] for watch in watched] == ["user_a", "user_b"]
+    assert all(watch["interval_minutes"] == 30 for watch in watched)
+    assert db_session.add.call_count == 2
+
+    db_session.execute.return_value.rowcount = 0
+    response = client.delete("/tweets/watch/user_c")
+    assert response.status_code == 404
+
+def test_get_job_not_found(client, db_session):
+    """Test job status endpoint for an unknown job."""
+    db_session.get = AsyncMock(return_value=None)
+    response = client.get("/tweets/jobs/42")
+    assert response.status_code == 404
+
+def test_get_violations_cursor_pagination(client, db_session):
+    """Test keyset pagination returns a cursor pointing at the last row."""
+    import datetime
+    from app.routes.tweet_routes import decode_cursor
+
+    posted_at = datetime.datetime(2025, 3, 1, 9, 45, 23)
+    rows = [{"id": 7, "username": "test_user", "tweet": "Test tweet", "policy": "Test Policy",
+             "rule_id": "TEST-001", "rule_violated": "Test rule", "reason": "Test reason", "posted_at": posted_at}]
+    db_session.execute.return_value.mappings.return_value.all.return_value = rows
+
+    response = client.get("/tweets/violations", params={"pagination": "cursor", "limit": 1})
+    assert response.status_code == 200
+    assert response.json()["violations"][0]["id"] == 7
+    assert decode_cursor(response.json()["next_cursor"]) == (posted_at, 7)
+
+    response = client.get("/tweets/violations", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+def test_ingest_archives(client, db_session, tmp_path):
+    """Test archive ingests only read files under ARCHIVE_DIR, are queued for the workers and report their progress."""
+    from app.core.models import ArchiveIngestRun
+
+    (tmp_path / "dump.ndjson.gz").write_bytes(b"")
+    with patch("app.routes.tweet_routes.ARCHIVE_DIR", str(tmp_path)), \
+         patch("app.routes.tweet_routes.run_next_ingest", AsyncMock()) as run:
+        request_data = {"paths": ["../etc/passwd"], "policy_name": "employee_social_media_policy"}
+        assert client.post("/tweets/ingest", json=request_data).status_code == 400
+        request_data["paths"] = ["missing.ndjson"]
+        assert client.post("/tweets/ingest", json=request_data).status_code == 404
+        db_session.add.assert_not_called()
+
+        request_data["paths"] = ["dump.ndjson.gz"]
+        response = client.post("/tweets/ingest", json=request_data)
+        assert response.status_code == 202
+        assert response.json()["status"] == "queued"
+        queued = db_session.add.call_args.args[0]
+        assert isinstance(queued, ArchiveIngestRun) and json.loads(queued.paths) == [str(tmp_path / "dump.ndjson.gz")]
+        # Left to the worker processes
+        run.assert_not_called()
+
+        queued.status, queued.progress = "running", json.dumps({"files_parsed": 1, "tweets_classified": 40})
+        db_session.get = AsyncMock(return_value=queued)
+        response = client.get(f"/tweets/ingest/{response.json()['ingest_id']}")
+        assert (response.json()["status"], response.json()["files"], response.json()["tweets_classified"]) == ("running", 1, 40)
+        db_session.get.return_value = None
+        assert client.get("/tweets/ingest/unknown").status_code == 404
+
+def test_violation_stats_from_rollups(client, db_session):
+    """Test grouped counts are read from the rollup table, not the raw violations."""
+    db_session.execute.return_value.mappings.return_value.all.return_value = [
+        {"policy": "Test Policy", "rule_id": "TEST-001", "violations": 12}
+    ]
+    db_session.scalar = AsyncMock(return_value=12)
+
+    response = client.get("/tweets/violations/stats", params={"group_by": "rule", "start_date": "2025-03-01"})
+    assert response.status_code == 200
+    assert response.json() == {"group_by": "rule", "total": 12, "groups": [{"policy": "Test Policy", "rule_id": "TEST-001", "violations": 12}]}
+    query = str(db_session.execute.call_args.args[0])
+    assert "violation_rollups" in query and "FROM violations" not in query
+
+    response = client.get("/tweets/violations/stats", params={"group_by": "tweet"})
+    assert response.status_code == 422
+
+def test_search_violations(client, db_session):
+    """Test keyword search returns ranked rows with the next offset, and semantic mode needs its index."""
+    db_session.execute.return_value.mappings.return_value.all.return_value = [
+        {"id": 3, "username": "test_user", "tweet": "Q3 earnings are great", "policy": "Test Policy", "rule_id": "TEST-001",
+         "rule_violated": "Test rule", "reason": "Discloses results", "posted_at": "2025-03-01T09:45:23", "score": None}
+    ]
+
+    response = client.get("/tweets/violations/search", params={"q": "Q3 earnings", "limit": 1})
+    assert response.status_code == 200
+    assert response.json()["results"][0]["id"] == 3
+    assert response.json()["next_offset"] == 1
+    query = str(db_session.execute.call_args.args[0])
+    assert "lower(violations.tweet) LIKE lower(" in query
+
+    response = client.get("/tweets/violations/search", params={"q": "Q3 earnings", "mode": "semantic"})
+    assert response.status_code == 400
+
+def test_export_violations_ndjson_and_csv(client):
+    """Test streaming export writes every chunk in the requested format."""
+    async def chunks(query):
+        yield [{"id": 1, "username": "a", "tweet": "x", "policy": "p", "rule_id": "r",
+                "rule_violated": "v", "reason": "why", "posted_at": "2025-03-01T00:00:00"}]
+        yield [{"id": 2, "username": "b", "tweet": "y", "policy": "p", "rule_id": "r",
+                "rule_violated": "v", "reason": "why", "posted_at": "2025-03-02T00:00:00"}]
+
+    with patch("app.services.violations_export.stream_violation_chunks", chunks):
+        response = client.get("/tweets/violations/export", params={"format": "ndjson", "policy": "p"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        assert [json.loads(line)["id"] for line in response.text.splitlines()] == [1, 2]
+
+        response = client.get("/tweets/violations/export", params={"format": "csv"})
+        assert response.text.splitlines()[0].startswith("id,username,tweet")
+        assert len(response.text.splitlines()) == 3
+
+def test_export_violations_parquet_requires_pyarrow(client):
+    """Test Parquet export is refused when pyarrow isn't installed."""
+    with patch("app.services.violations_export.pyarrow", None):
+        response = client.get("/tweets/violations/export", params={"format": "parquet"})
+        assert response.status_code == 400
+
+def test_upload_policy_reloads_registry(client, tmp_path):
+    """Test that uploading a policy compiles it and that invalid uploads are rejected."""
+    from app.services.policy_registry import policy_registry
+
+    with patch("app.routes.policy_routes.UPLOAD_DIR", str(tmp_path)), \
+         patch.object(policy_registry, "directory", str(tmp_path)):
+        policy = {"policy_name": "Upload Policy", "rules": [{"rule_id": "UP-001", "description": "Rule"}]}
+        response = client.post("/policies/upload", files={"file": ("upload_policy.json", json.dumps(policy))})
+        assert response.status_code == 200
+        assert response.json()["rules_count"] == 1
+        assert policy_registry.peek("upload_policy").title == "Upload Policy"
+
+        response = client.post("/policies/upload", files={"file": ("broken_policy.json", "{not json")})
+        assert response.status_code == 400
+        assert not (tmp_path / "broken_policy.json").exists()
+
+        # A broken replacement of an existing policy keeps the previous file and compiled version
+        response = client.post("/policies/upload", files={"file": ("upload_policy.json", json.dumps({"rules": "not a list"}))})
+        assert response.status_code == 400
+        assert json.loads((tmp_path / "upload_policy.json").read_text()) == policy
+        assert policy_registry.peek("upload_policy").title == "Upload Policy"
+        assert policy_registry.get("upload_policy").title == "Upload Policy"
+        assert sorted(path.name for path in tmp_path.iterdir()) == ["upload_policy.json"]
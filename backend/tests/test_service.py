@@ -1,7 +1,30 @@
 import pytest
+import asyncio
+import os
 from unittest.mock import patch, MagicMock, AsyncMock
 import json
 import datetime
+from app.services.policy_registry import compile_policy
+
+def mock_tweet_pages(*pages):
+    """Build a stand-in for the fetch_all_tweets async page generator."""
+    async def fetch(username, since_id=None, start_time=None, next_token=None):
+        for page in pages:
+            yield page, None
+    return fetch
+
+def inserted_violations(db_session, keys=("username", "tweet", "rule_id")):
+    """Collect the violation rows written through bulk INSERT statements on the mocked session."""
+    from sqlalchemy.sql.dml import Insert
+
+    rows = []
+    for call in db_session.execute.call_args_list:
+        statement = call.args[0]
+        if isinstance(statement, Insert) and statement.table.name == "violations":
+            params = statement.compile().params
+            rows.extend({key: params[f"{key}_m{i}"] for key in keys}
+                        for i in range(len([k for k in params if k.startswith("tweet_m")])))
+    return rows
 
 @pytest.mark.asyncio
 async def test_openai_predictor():
@@ -32,7 +55,7 @@ async def test_openai_predictor():
                side_effect=mock_create):
         
         # Test the function
-        result = await check_tweet_compliance("Test tweet", [])
+        result = await check_tweet_compliance("Test tweet", compile_policy("test_policy", []))
         
         # Verify result
         assert result["violation"] == "NO"
@@ -60,14 +83,1163 @@ async def test_tweet_processor(db_session):
     
     # Mock tweet fetching
     with patch("app.services.tweets_processor.fetch_all_tweets", 
-               AsyncMock(return_value=tweets)):
+               mock_tweet_pages(tweets)):
         
         # Mock compliance checking - now returning a violation
         with patch("app.services.tweets_processor.check_tweet_compliance", 
                   AsyncMock(return_value=mock_compliance_result)):
             
             # Call the function
-            await process_user_tweets("test_user", policy_rules, db_session)
+            await process_user_tweets("test_user", compile_policy("test_policy", policy_rules), db_session, use_batching=False)
             
-            # With a violation, at least one of these should be called
-            assert db_session.add.called or db_session.add_all.called
\ No newline at end of file
+            # With a violation, it should be written with a bulk insert
+            assert inserted_violations(db_session) == [
+                {"username": "test_user", "tweet": "Test tweet", "rule_id": "TEST-001"}
+            ]
+
+@pytest.mark.asyncio
+async def test_tweet_processor_batched(db_session):
+    """Test tweet processor with the batched classifier."""
+    from app.services.tweets_processor import process_user_tweets
+
+    tweets = [
+        {"text": "Safe tweet", "created_at": datetime.datetime.now()},
+        {"text": "Leaky tweet", "created_at": datetime.datetime.now()}
+    ]
+    verdicts = [
+        {"violation": "NO", "tweet": "Safe tweet"},
+        {"violation": "YES", "tweet": "Leaky tweet", "policy": "Test Policy", "rule_id": "TEST-001",
+         "rule_violated": "Test rule", "reason": "Test reason"}
+    ]
+
+    with patch("app.services.tweets_processor.fetch_all_tweets",
+               mock_tweet_pages(tweets)):
+        with patch("app.services.tweets_processor.classify_tweets",
+                   AsyncMock(return_value=verdicts)) as mock_classify:
+
+            await process_user_tweets("test_user", compile_policy("test_policy", []), db_session)
+
+            mock_classify.assert_awaited_once()
+            assert [v["tweet"] for v in inserted_violations(db_session)] == ["Leaky tweet"]
+
+@pytest.mark.asyncio
+async def test_tweet_processor_multiple_policies(db_session):
+    """Test one pass over several policies, attributing each violation by rule ID rather than the echoed policy."""
+    from app.services.tweets_processor import process_user_tweets
+    from app.services.policy_registry import combine_policies
+
+    policy = combine_policies([
+        compile_policy("conduct", {"policy_name": "Conduct", "rules": [{"rule_id": "COND-001", "description": "Be civil"}]}),
+        compile_policy("secrets", {"policy_name": "Secrets", "rules": [{"rule_id": "SEC-001", "description": "No leaks"}]})
+    ])
+    verdict = {"violation": "YES", "violations": [
+        {"policy": "Conduct", "rule_id": "COND-001", "reason": "Rude"},
+        {"policy": "Conduct", "rule_id": "[SEC-001]", "reason": "Leak"}
+    ]}
+
+    with patch("app.services.tweets_processor.fetch_all_tweets", mock_tweet_pages([{"text": "Rude multi-policy leak"}])), \
+         patch("app.services.tweets_processor.classify_tweets", AsyncMock(return_value=[verdict])) as mock_classify:
+        await process_user_tweets("test_user", policy, db_session)
+
+    mock_classify.assert_awaited_once()
+    assert 'Policy "Conduct":' in policy.rules_text and 'Policy "Secrets":' in policy.rules_text
+    assert inserted_violations(db_session, keys=("policy", "rule_id", "rule_violated")) == [
+        {"policy": "Conduct", "rule_id": "COND-001", "rule_violated": "Be civil"},
+        {"policy": "Secrets", "rule_id": "SEC-001", "rule_violated": "No leaks"}
+    ]
+
+def test_build_tweet_batches():
+    """Test batch packing by tweet count and token budget."""
+    from app.services.openai_predictor import build_tweet_batches
+
+    assert build_tweet_batches(["a"] * 5, max_tweets=2, max_tokens=1000) == [[0, 1], [2, 3], [4]]
+    assert build_tweet_batches(["x" * 40, "x" * 40, "x"], max_tweets=10, max_tokens=15) == [[0], [1, 2]]
+
+@pytest.mark.asyncio
+async def test_batch_split_on_malformed_response():
+    """Test that a malformed batch response is split and retried as halves."""
+    from app.services.openai_predictor import classify_tweets
+
+    def make_response(content):
+        return MagicMock(choices=[MagicMock(message=MagicMock(content=content))])
+
+    async def mock_create(*args, **kwargs):
+        prompt = kwargs["messages"][1]["content"]
+        if "Tweets (one per line" in prompt:
+            return make_response("not json")
+        tweet = "first" if "first" in prompt else "second"
+        return make_response(json.dumps({"violation": "NO", "tweet": tweet}))
+
+    with patch("app.services.openai_predictor.client.chat.completions.create",
+               side_effect=mock_create):
+        verdicts = await classify_tweets(["first", "second"], compile_policy("test_policy", []))
+
+    assert [v["tweet"] for v in verdicts] == ["first", "second"]
+    assert all(v["violation"] == "NO" for v in verdicts)
+
+@pytest.mark.asyncio
+async def test_failed_batch_falls_back_alone():
+    """Test that only a failed batch is re-sent per tweet, and that an LLM rate limit propagates."""
+    from openai import RateLimitError
+    from app.services.openai_predictor import classify_tweets
+
+    async def classify_batch(tweets, policy):
+        if "bad" in tweets:
+            raise RuntimeError("backend error")
+        return [{"violation": "NO", "tweet": tweet} for tweet in tweets]
+
+    single = AsyncMock(side_effect=lambda tweet, policy: {"violation": "NO", "tweet": tweet})
+    with patch("app.services.openai_predictor.build_tweet_batches", return_value=[[0, 1], [2, 3]]), \
+         patch("app.services.openai_predictor.check_tweets_compliance_batch", side_effect=classify_batch), \
+         patch("app.services.openai_predictor.check_tweet_compliance", single):
+        verdicts = await classify_tweets(["a", "b", "c", "bad"], compile_policy("test_policy", []))
+
+    assert [v["tweet"] for v in verdicts] == ["a", "b", "c", "bad"]
+    assert sorted(call.args[0] for call in single.await_args_list) == ["bad", "c"]
+
+    rate_limited = RateLimitError("rate limited", response=MagicMock(headers={}), body=None)
+    with patch("app.services.openai_predictor.check_tweets_compliance_batch", AsyncMock(side_effect=rate_limited)), \
+         patch("app.services.openai_predictor.check_tweet_compliance", single):
+        with pytest.raises(RateLimitError):
+            await classify_tweets(["a", "b"], compile_policy("test_policy", []))
+
+def test_retry_after_seconds_parses_http_dates():
+    """Test Retry-After is read as seconds or as an HTTP-date, falling back to the default otherwise."""
+    import email.utils
+    from openai import RateLimitError
+    from app.services.llm_backends import retry_after_seconds
+
+    def rate_limited(retry_after):
+        return RateLimitError("rate limited", response=MagicMock(headers={"retry-after": retry_after} if retry_after else {}), body=None)
+
+    in_a_minute = email.utils.format_datetime(datetime.datetime.now(datetime.UTC) + datetime.timedelta(seconds=60), usegmt=True)
+    assert retry_after_seconds(rate_limited("12")) == 12.0
+    assert 55 <= retry_after_seconds(rate_limited(in_a_minute)) <= 60
+    assert retry_after_seconds(rate_limited("Wed, 21 Oct 2015 07:28:00 GMT")) == 0.0
+    assert retry_after_seconds(rate_limited("soon")) == 5.0
+    assert retry_after_seconds(rate_limited(None), default=7.0) == 7.0
+
+@pytest.mark.asyncio
+async def test_malformed_verdict_is_repaired_or_unknown(db_session):
+    """Test a malformed verdict gets one repair attempt, then the tweet is recorded as unclassified."""
+    from app.services.openai_predictor import check_tweet_compliance, VERDICT_UNKNOWN
+    from app.services.tweets_processor import process_user_tweets
+    from app.core.models import UnclassifiedTweet
+
+    responses = ["not json", json.dumps({"violation": "NO", "violations": []})]
+    mock_create = AsyncMock(side_effect=lambda **kwargs: MagicMock(
+        choices=[MagicMock(message=MagicMock(content=responses.pop(0)), finish_reason="stop")]
+    ))
+    with patch("app.services.openai_predictor.client.chat.completions.create", mock_create):
+        result = await check_tweet_compliance("Test tweet", compile_policy("test_policy", []))
+
+    assert result == {"violation": "NO", "violations": [], "tweet": "Test tweet"}
+    # The repair request shows the model its invalid answer
+    repair_messages = mock_create.call_args_list[1].kwargs["messages"]
+    assert repair_messages[2] == {"role": "assistant", "content": "not json"}
+    assert mock_create.call_args_list[0].kwargs["response_format"]["json_schema"]["strict"] is True
+
+    tweets = [{"id": "7", "text": "Test tweet", "created_at": datetime.datetime.now()}]
+    with patch("app.services.tweets_processor.fetch_all_tweets", mock_tweet_pages(tweets)), \
+         patch("app.services.openai_predictor.client.chat.completions.create",
+               AsyncMock(return_value=MagicMock(choices=[MagicMock(message=MagicMock(content="not json"), finish_reason="stop")]))):
+        await process_user_tweets("test_user", compile_policy("test_policy", []), db_session, use_batching=False)
+
+    # Neither a violation nor a silent pass
+    assert inserted_violations(db_session) == []
+    staged = [row for call in db_session.add_all.call_args_list for row in call.args[0]]
+    assert [(row.tweet_id, row.tweet) for row in staged if isinstance(row, UnclassifiedTweet)] == [("7", "Test tweet")]
+    assert VERDICT_UNKNOWN == "UNKNOWN"
+
+@pytest.mark.asyncio
+async def test_llm_router_failover_and_hedging():
+    """Test a 5xx fails over to the next backend and a slow backend is hedged."""
+    import asyncio
+    import httpx
+    from openai import InternalServerError
+    from app.services.llm_backends import LLMBackend, LLMRouter
+
+    def make_backend(name, create):
+        client = MagicMock()
+        client.chat.completions.create = create
+        return LLMBackend(name, client, "test-model")
+
+    server_error = InternalServerError("boom", response=httpx.Response(500, request=httpx.Request("POST", "http://llm")), body=None)
+    failing = make_backend("primary", AsyncMock(side_effect=server_error))
+    fallback = make_backend("fallback", AsyncMock(return_value="fallback answer"))
+    router = LLMRouter([failing, fallback], hedge=False)
+
+    assert await router.complete([{"role": "user", "content": "hi"}], 10) == "fallback answer"
+    assert failing.errors == 1 and fallback.requests == 1
+
+    async def slow_create(**kwargs):
+        await asyncio.sleep(5)
+        return "slow answer"
+
+    slow = make_backend("slow", slow_create)
+    fast = make_backend("fast", AsyncMock(return_value="fast answer"))
+    router = LLMRouter([slow, fast], hedge=True, hedge_min_delay=0.01)
+
+    assert await asyncio.wait_for(router.complete([{"role": "user", "content": "hi"}], 10), timeout=1) == "fast answer"
+    assert slow.requests == 1 and fast.requests == 1
+
+@pytest.mark.asyncio
+async def test_semantic_index_sync_and_search(db_session, tmp_path):
+    """Test new violations are embedded once, persisted, and ranked by cosine similarity."""
+    numpy = pytest.importorskip("numpy")
+    from app.services.semantic_index import SemanticIndex, normalize
+
+    rows = [MagicMock(id=1, tweet="Q3 earnings beat", reason="Financial results"),
+            MagicMock(id=2, tweet="Team lunch", reason="Off topic")]
+    pages = [rows, []]
+    db_session.execute.side_effect = lambda statement: MagicMock(all=MagicMock(return_value=pages.pop(0) if pages else []))
+
+    async def embed(texts):
+        return normalize(numpy.array([[1.0, 0.1] if "earnings" in text else [0.1, 1.0] for text in texts]))
+
+    index = SemanticIndex(str(tmp_path), model="test", dimensions=2)
+    assert await index.sync(db_session, embed=embed) == 2
+    # Everything is indexed already
+    pages = [rows, []]
+    assert await index.sync(db_session, embed=embed) == 0
+
+    # Another process maps the same files
+    reader = SemanticIndex(str(tmp_path), model="test", dimensions=2)
+    # Scored in a worker thread, off the event loop
+    with patch("app.services.semantic_index.asyncio.to_thread", wraps=asyncio.to_thread) as to_thread:
+        ranked = await reader.search(numpy.array([1.0, 0.0], dtype=numpy.float32), 2)
+    to_thread.assert_called_once()
+    assert [violation_id for violation_id, _ in ranked] == [1, 2]
+    assert ranked[0][1] > ranked[1][1]
+
+def test_sample_corpus_sidecar_slices(tmp_path):
+    """Test the sample corpus is served per user from its sidecar, with since_id and resumable page tokens."""
+    from app.services.sample_corpus import SampleCorpus
+
+    source = tmp_path / "tweets.json"
+    tweets = [{"id": str(100 + i), "text": f"shared {i}", "created_at": "2025-03-01T09:45:23Z"} for i in range(5)]
+    tweets.append({"id": "200", "text": "own tweet é", "created_at": "2025-03-02T10:00:00Z", "username": "alice"})
+    source.write_text(json.dumps({"username": "sample", "tweets": tweets}))
+
+    corpus = SampleCorpus(str(source))
+    pages = list(corpus.pages("bob", since_id="100", page_size=2))
+    assert [[tweet["id"] for tweet in page] for page, _ in pages] == [["101", "102"], ["103", "104"]]
+    assert [token for _, token in pages] == ["3", None]
+    assert [tweet["id"] for tweet in next(corpus.pages("bob", since_id="100", next_token="3", page_size=2))[0]] == ["103", "104"]
+    assert list(corpus.pages("alice")) == [([{"id": "200", "text": "own tweet é", "created_at": datetime.datetime(2025, 3, 2, 10)}], None)]
+
+    # A second reader maps the existing sidecar, a changed source is rebuilt
+    with patch.object(SampleCorpus, "build") as build:
+        SampleCorpus(str(source)).open()
+        build.assert_not_called()
+    source.write_text(json.dumps({"tweets": tweets[:1]}))
+    assert [tweet["id"] for page, _ in SampleCorpus(str(source)).pages("bob") for tweet in page] == ["100"]
+
+@pytest.mark.asyncio
+async def test_archive_ingest_replays_dumps(db_session, tmp_path):
+    """Test archived dumps (gzip and plain NDJSON, several formats) are parsed in parallel and scanned per author."""
+    import gzip
+    from app.services.archive_ingest import ArchiveIngest, INGEST_COMPLETED
+
+    with gzip.open(tmp_path / "part1.ndjson.gz", "wt") as f:
+        for i in range(3):
+            f.write(json.dumps({"id_str": str(i), "full_text": f"alice tweet {i}", "created_at": "Wed Oct 10 20:19:24 +0000 2018", "user": {"screen_name": "alice"}}) + "\n")
+        f.write("not json\n")
+    (tmp_path / "part2.ndjson").write_text("\n".join([
+        json.dumps({"tweet": {"id": "10", "text": "bob leak", "created_at": "2025-03-01T09:45:23.000Z", "username": "bob"}}),
+        json.dumps({"id": "11", "text": "no author", "created_at": "2025-03-01T09:45:23Z"})
+    ]))
+
+    async def classify(texts, policy, user_scope=None):
+        return [{"violation": "YES", "policy": "Test Policy", "rule_id": "TEST-001", "rule_violated": "Test rule", "reason": "Leak"}
+                if "leak" in text else {"violation": "NO"} for text in texts]
+
+    session_factory = MagicMock()
+    session_factory.return_value.__aenter__ = AsyncMock(return_value=db_session)
+    session_factory.return_value.__aexit__ = AsyncMock(return_value=False)
+    ingest = ArchiveIngest([str(tmp_path / "part1.ndjson.gz"), str(tmp_path / "part2.ndjson")],
+                           compile_policy("archive_policy", ["No leaks"]), workers=2, partitions=4, work_dir=str(tmp_path / "spool"))
+
+    with patch("app.core.database.AsyncSessionLocal", session_factory), \
+         patch("app.services.tweets_processor.fetch_all_tweets") as fetch, \
+         patch("app.services.tweets_processor.classify_tweets", side_effect=classify):
+        await ingest.run()
+
+    fetch.assert_not_called()
+    stats = ingest.stats()
+    assert stats["status"] == INGEST_COMPLETED
+    assert (stats["tweets_parsed"], stats["tweets_skipped"], stats["users_done"]) == (4, 2, 2)
+    assert (stats["tweets_classified"], stats["violations_found"]) == (4, 1)
+    assert inserted_violations(db_session) == [{"username": "bob", "tweet": "bob leak", "rule_id": "TEST-001"}]
+    assert not (tmp_path / "spool" / ingest.id).exists()
+
+def test_partition_archive_file_skips_malformed_lines(tmp_path):
+    """Test that lines which aren't usable tweets are counted as skipped instead of failing the file."""
+    from app.services.archive_ingest import partition_archive_file
+
+    tweet = {"id": "1", "text": "fine", "created_at": "Wed Oct 10 20:19:24 +0000 2018", "username": "alice"}
+    (tmp_path / "dump.ndjson").write_text("\n".join([
+        json.dumps(tweet),
+        "{truncated",
+        json.dumps([tweet]),
+        json.dumps({**tweet, "created_at": "Wed Foo 10 20:19:24 +0000 2018"}),
+        json.dumps({**tweet, "created_at": "yesterday"}),
+        json.dumps({**tweet, "created_at": 1539202764}),
+        json.dumps({**tweet, "username": None, "user": "alice"})
+    ]))
+    spool = tmp_path / "spool"
+    spool.mkdir()
+
+    result = partition_archive_file(str(tmp_path / "dump.ndjson"), str(spool), "00000", 2)
+
+    assert (result["tweets"], result["skipped"]) == (1, 6)
+    assert [line.split("\t")[0] for path in spool.iterdir() for line in path.read_text().splitlines()] == ["alice"]
+
+@pytest.mark.asyncio
+async def test_archive_ingests_run_from_the_queue(tmp_path):
+    """Test workers lease queued ingests and save their progress, ingests of a vanished worker fail and old ones expire."""
+    from sqlalchemy import update
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from app.core.database import Base
+    from app.core.models import ArchiveIngestRun
+    from app.services.archive_ingest import (
+        ArchiveIngest, enqueue_ingest, lease_next_ingest, run_next_ingest, ingest_to_dict, utc_now,
+        INGEST_QUEUED, INGEST_RUNNING, INGEST_COMPLETED, INGEST_FAILED
+    )
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/ingests.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+    progress_seen = []
+
+    async def ingest_run(self):
+        self.files_parsed, self.tweets_classified = 1, 40
+        await asyncio.sleep(0.05)
+        async with sessions() as session:
+            progress_seen.append(ingest_to_dict(await session.get(ArchiveIngestRun, self.id)))
+        self.status = INGEST_COMPLETED
+        self.finished_at = 1.0
+
+    with patch("app.services.archive_ingest.AsyncSessionLocal", sessions), \
+         patch("app.services.archive_ingest.ARCHIVE_INGEST_PROGRESS_SECONDS", 0.01), \
+         patch("app.services.archive_ingest.ARCHIVE_INGEST_RETENTION_SECONDS", 100), \
+         patch("app.services.archive_ingest.policy_registry.get_many", return_value=compile_policy("archive_policy", [])), \
+         patch.object(ArchiveIngest, "run", ingest_run):
+        async with sessions() as session:
+            first = await enqueue_ingest(session, ["/archives/a.ndjson"], "archive_policy")
+            second = await enqueue_ingest(session, ["/archives/b.ndjson"], "archive_policy")
+        assert first.status == INGEST_QUEUED
+
+        # Another process reads the progress from the database while the ingest runs
+        assert await run_next_ingest("worker-a")
+        assert (progress_seen[0]["status"], progress_seen[0]["tweets_classified"]) == (INGEST_RUNNING, 40)
+        async with sessions() as session:
+            done = ingest_to_dict(await session.get(ArchiveIngestRun, first.id))
+        assert (done["status"], done["files_parsed"]) == (INGEST_COMPLETED, 1)
+
+        # The worker running the second ingest died: it isn't run twice
+        async with sessions() as session:
+            assert (await lease_next_ingest(session, "worker-b")).id == second.id
+            await session.execute(update(ArchiveIngestRun).where(ArchiveIngestRun.id == second.id)
+                                  .values(leased_until=utc_now() - datetime.timedelta(seconds=1)))
+            await session.commit()
+        assert not await run_next_ingest("worker-a")
+        async with sessions() as session:
+            stale = await session.get(ArchiveIngestRun, second.id)
+        assert (stale.status, stale.error) == (INGEST_FAILED, "Worker worker-b stopped while ingesting")
+
+        # Finished ingests are dropped once past the retention time
+        async with sessions() as session:
+            await session.execute(update(ArchiveIngestRun).values(updated_at=utc_now() - datetime.timedelta(seconds=200)))
+            await session.commit()
+            await enqueue_ingest(session, ["/archives/c.ndjson"], "archive_policy")
+            assert await session.get(ArchiveIngestRun, first.id) is None
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_tweet_processor_borrows_short_lived_sessions(db_session):
+    """Test a scan without a session opens one per stage, none of them spanning the classification."""
+    from app.services.tweets_processor import process_user_tweets
+
+    opened = []
+    def open_session():
+        scope = MagicMock()
+        scope.__aenter__ = AsyncMock(side_effect=lambda: opened.append("open") or db_session)
+        scope.__aexit__ = AsyncMock(side_effect=lambda *exc: opened.append("close"))
+        return scope
+
+    async def classify(texts, policy, user_scope=None):
+        # Every borrowed session is back in the pool while the LLM is called
+        assert opened.count("open") == opened.count("close")
+        opened.append("llm")
+        return [{"violation": "YES", "policy": "Test Policy", "rule_id": "TEST-001", "rule_violated": "Test rule", "reason": "Leak"}]
+
+    with patch("app.core.database.AsyncSessionLocal", side_effect=open_session), \
+         patch("app.services.tweets_processor.USE_VERDICT_CACHE", False), \
+         patch("app.services.tweets_processor.fetch_all_tweets", mock_tweet_pages([{"text": "leak", "created_at": datetime.datetime.now()}])), \
+         patch("app.services.tweets_processor.classify_tweets", side_effect=classify):
+        await process_user_tweets("test_user", compile_policy("test_policy", ["No leaks"]))
+
+    # Watermark read, classification, then one persist with the violation and the new watermark
+    assert opened == ["open", "close", "llm", "open", "close"]
+    assert inserted_violations(db_session) == [{"username": "test_user", "tweet": "leak", "rule_id": "TEST-001"}]
+
+@pytest.mark.asyncio
+async def test_database_pool_settings_and_checkout_metrics(tmp_path):
+    """Test the engine options follow the DB_* settings and pool checkouts are timed."""
+    from sqlalchemy import text
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from app.core.database import engine_options, TimedQueuePool
+    from app.core.metrics import DB_POOL_CHECKOUT_SECONDS
+
+    options = engine_options("postgresql+asyncpg://user:secret@db/violations")
+    assert options["echo"] is False and options["poolclass"] is TimedQueuePool
+    assert options["connect_args"] == {"prepared_statement_cache_size": 500}
+    assert "poolclass" not in engine_options("sqlite+aiosqlite:///bench.db")
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/pool.db", poolclass=TimedQueuePool, pool_size=1, max_overflow=0)
+    checkouts = DB_POOL_CHECKOUT_SECONDS.count()
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+        assert engine.pool.checkedout() == 1
+    await engine.dispose()
+    assert DB_POOL_CHECKOUT_SECONDS.count() == checkouts + 1
+
+@pytest.mark.asyncio
+async def test_worker_serves_the_metrics_of_its_jobs(tmp_path):
+    """Test a job run by a worker process shows up on that worker's own metrics endpoint."""
+    from fastapi.testclient import TestClient
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from app.core.database import Base
+    from app.core.metrics import SCAN_JOBS
+    from app.services.job_queue import run_job, new_scan_job, utc_now, JOB_RUNNING
+    from worker import metrics_app
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/jobs.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+    async with sessions() as session:
+        job = new_scan_job("test_user", "test_policy", utc_now())
+        job.status, job.worker_id, job.attempts, job.leased_until = JOB_RUNNING, "worker-a", 1, utc_now()
+        session.add(job)
+        await session.commit()
+
+    completed = SCAN_JOBS.value(outcome="completed")
+    with patch("app.services.job_queue.AsyncSessionLocal", sessions), \
+         patch("app.services.job_queue.policy_registry.get_many", return_value=compile_policy("test_policy", [])), \
+         patch("app.services.job_queue.process_user_tweets", AsyncMock()):
+        await run_job(job.id, "worker-a")
+
+    response = TestClient(metrics_app).get("/system/metrics")
+    assert response.status_code == 200
+    assert f'scan_jobs_total{{outcome="completed"}} {completed + 1}' in response.text
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_job_lease_heartbeat_and_ownership(tmp_path):
+    """Test a running job keeps its lease alive, and stops without writing once another worker leased it."""
+    from sqlalchemy import update
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from app.core.database import Base
+    from app.core.models import ScanJob
+    from app.services.job_queue import run_job, new_scan_job, utc_now, JOB_RUNNING, JOB_COMPLETED
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/jobs.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+
+    async def lease_job(worker_id):
+        async with sessions() as session:
+            job = new_scan_job("test_user", "test_policy", utc_now())
+            job.status, job.worker_id, job.attempts, job.leased_until = JOB_RUNNING, worker_id, 1, utc_now()
+            session.add(job)
+            await session.commit()
+            return job.id
+
+    async def load(job_id):
+        async with sessions() as session:
+            return await session.get(ScanJob, job_id)
+
+    async def steal(job_id):
+        async with sessions() as session:
+            await session.execute(update(ScanJob).where(ScanJob.id == job_id).values(worker_id="worker-b"))
+            await session.commit()
+
+    async def scan(username, policy, on_checkpoint):
+        # Outlives a few heartbeats, then checkpoints a page
+        leased_until = (await load(job_id)).leased_until
+        await asyncio.sleep(0.1)
+        assert (await load(job_id)).leased_until > leased_until
+        if steal_first:
+            await steal(job_id)
+        async with sessions() as session:
+            await on_checkpoint("token", 1, 10, 2, session)
+            await session.commit()
+
+    with patch("app.services.job_queue.AsyncSessionLocal", sessions), \
+         patch("app.services.job_queue.JOB_HEARTBEAT_SECONDS", 0.01), \
+         patch("app.services.job_queue.policy_registry.get_many", return_value=compile_policy("test_policy", [])), \
+         patch("app.services.job_queue.process_user_tweets", side_effect=scan):
+        steal_first = False
+        job_id = await lease_job("worker-a")
+        await run_job(job_id, "worker-a")
+        job = await load(job_id)
+        assert (job.status, job.pages_done, job.tweets_processed, job.leased_until) == (JOB_COMPLETED, 1, 10, None)
+
+        # Lost before the checkpoint commit: nothing is written, the job stays with its new worker
+        steal_first = True
+        job_id = await lease_job("worker-a")
+        await run_job(job_id, "worker-a")
+        job = await load(job_id)
+        assert (job.status, job.worker_id, job.pages_done, job.attempts) == (JOB_RUNNING, "worker-b", 0, 1)
+
+        # Lost while the scan is waiting: the heartbeat notices and the scan is cancelled
+        cancelled = asyncio.Event()
+        async def stalled_scan(username, policy, on_checkpoint):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        job_id = await lease_job("worker-a")
+        with patch("app.services.job_queue.process_user_tweets", side_effect=stalled_scan):
+            asyncio.get_running_loop().call_later(0.05, lambda: asyncio.ensure_future(steal(job_id)))
+            await asyncio.wait_for(run_job(job_id, "worker-a"), timeout=5)
+        assert cancelled.is_set()
+        assert (await load(job_id)).status == JOB_RUNNING
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_rate_limited_job_is_requeued_after_the_window(tmp_path):
+    """Test a rate-limited job goes back to the queue until the window resets, without using up an attempt."""
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from app.core.database import Base
+    from app.core.models import ScanJob
+    from app.services.tweets_fetcher import TooManyRequests
+    from app.services.job_queue import run_job, lease_next_job, new_scan_job, utc_now, JOB_QUEUED
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/jobs.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+    async with sessions() as session:
+        session.add(new_scan_job("test_user", "test_policy", utc_now()))
+        await session.commit()
+
+    with patch("app.services.job_queue.AsyncSessionLocal", sessions), \
+         patch("app.services.job_queue.policy_registry.get_many", return_value=compile_policy("test_policy", [])), \
+         patch("app.services.job_queue.process_user_tweets", AsyncMock(side_effect=TooManyRequests("rate limited", retry_after=120))):
+        for _ in range(3):
+            async with sessions() as session:
+                job = await lease_next_job(session, "worker-a")
+            await run_job(job.id, "worker-a")
+
+            async with sessions() as session:
+                job = await session.get(ScanJob, job.id)
+                assert (job.status, job.attempts) == (JOB_QUEUED, 0)
+                assert datetime.timedelta(seconds=110) < job.not_before - utc_now() <= datetime.timedelta(seconds=120)
+                # Not handed out again before the window resets
+                assert await lease_next_job(session, "worker-b") is None
+                job.not_before = utc_now()
+                await session.commit()
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_cpu_pool_runs_scan_stages_in_worker_processes(db_session):
+    """Test page hashing and pre-filtering give the same results in the worker processes as inline."""
+    from app.services.cpu_pool import CpuPool
+    from app.services.tweets_processor import page_features, process_user_tweets
+    from app.services.prefilter import assess_texts
+    from app.core.metrics import CPU_POOL_TASKS
+
+    texts = [f"Quarter {i} numbers leaked early from the internal finance dashboard today" for i in range(5)] + ["Lovely sunny weekend hike"]
+    policy = compile_policy("cpu_policy", ["No leaks"])
+    pool = CpuPool(workers=2, chunk_size=2, min_items=2)
+    try:
+        assert await pool.map_chunks(page_features, texts, True) == page_features(texts, True)
+        assert await pool.map_chunks(assess_texts, texts, policy) == assess_texts(texts, policy)
+        assert CPU_POOL_TASKS.value(stage="page_features") == 3
+
+        with patch("app.services.tweets_processor.cpu_pool", pool), \
+             patch("app.services.tweets_processor.PREFILTER_ENABLED", True), \
+             patch("app.services.tweets_processor.fetch_all_tweets", mock_tweet_pages([{"text": text, "created_at": datetime.datetime.now()} for text in texts])), \
+             patch("app.services.tweets_processor.classify_tweets", AsyncMock(side_effect=lambda texts, *args: [{"violation": "NO"}] * len(texts))) as mock_classify:
+            await process_user_tweets("test_user", policy, db_session)
+
+        # The safe tweet never reaches the LLM
+        assert "Lovely sunny weekend hike" not in mock_classify.await_args[0][0]
+    finally:
+        pool.shutdown()
+
+def test_metrics_render():
+    """Test histogram buckets are cumulative and label values are escaped."""
+    from app.core.metrics import MetricsRegistry
+
+    registry = MetricsRegistry()
+    latency = registry.histogram("latency_seconds", "Latency", ("kind",), buckets=(0.1, 1.0))
+    latency.observe(0.05, kind="batch")
+    latency.observe(0.5, kind="batch")
+    registry.counter("errors_total", "Errors", ("reason",)).inc(reason='bad "json"')
+
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{kind="batch",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{kind="batch",le="+Inf"} 2' in lines
+    assert 'latency_seconds_count{kind="batch"} 2' in lines
+    assert 'errors_total{reason="bad \\"json\\""} 1' in lines
+
+@pytest.mark.asyncio
+async def test_scheduler_bounds_inflight_tweets():
+    """Test that the scheduler never exceeds the per-user in-flight tweet limit."""
+    import asyncio
+    from app.services.scan_scheduler import ScanScheduler
+
+    test_scheduler = ScanScheduler(max_concurrent_users=1, max_inflight_tweets=10, max_inflight_tweets_per_user=3)
+    user_scope = test_scheduler.user_scope()
+    peak = 0
+
+    async def work():
+        nonlocal peak
+        async with test_scheduler.tweet_slots(user_scope, 2):
+            peak = max(peak, user_scope.in_use)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*(work() for _ in range(5)))
+    assert peak <= 3
+    assert test_scheduler.tweets.in_use == 0
+
+def test_token_bucket_wait_time():
+    """Test token bucket hands out budget and reports the wait when exhausted."""
+    from app.services.scan_scheduler import TokenBucket
+
+    bucket = TokenBucket(rate_per_minute=60)
+    assert bucket.try_take(60) == 0.0
+    assert bucket.try_take(1) > 0
+
+def test_upstream_budgets_are_split_between_scan_processes():
+    """Test each of SCAN_PROCESSES processes limits itself to its share of the deployment's budgets."""
+    from app.services.scan_scheduler import process_share
+    from app.services.llm_backends import build_backend
+
+    with patch("app.services.scan_scheduler.SCAN_PROCESSES", 4):
+        assert process_share(500) == 125
+        assert process_share(None) is None
+        backend = build_backend({"name": "local", "base_url": "http://localhost:8000/v1", "model": "m", "requests_per_minute": 60}, max_retries=0)
+    assert backend.governor.requests.capacity == 15
+
+@pytest.mark.asyncio
+async def test_verdict_cache_memory_hit(db_session):
+    """Test that stored verdicts are served from memory for normalized-equal texts."""
+    from app.services.verdict_cache import VerdictCache, hash_tweet_text
+
+    cache = VerdictCache(max_size=10, ttl_seconds=3600)
+    await cache.put_many(db_session, {hash_tweet_text("Hello World"): {"violation": "NO"}}, "policy-hash")
+    found = await cache.get_many(db_session, ["  hello   world "], "policy-hash")
+
+    assert found == {hash_tweet_text("Hello World"): {"violation": "NO"}}
+    assert cache.stats()["memory_hits"] == 1
+    assert await cache.get_many(db_session, ["Hello World"], "other-policy-hash") == {}
+
+@pytest.mark.asyncio
+async def test_verdict_cache_purger_deletes_expired_rows(db_session):
+    """Test that the purger task deletes cache rows older than the TTL on every tick until stopped."""
+    from app.services.verdict_cache import run_verdict_cache_purger
+
+    stop_event = asyncio.Event()
+    statements = []
+    async def execute(statement, *args, **kwargs):
+        statements.append(str(statement))
+        if len(statements) == 2:
+            stop_event.set()
+        return MagicMock(rowcount=3)
+
+    db_session.execute = AsyncMock(side_effect=execute)
+    session_factory = MagicMock()
+    session_factory.return_value.__aenter__ = AsyncMock(return_value=db_session)
+    session_factory.return_value.__aexit__ = AsyncMock(return_value=False)
+    with patch("app.services.verdict_cache.AsyncSessionLocal", session_factory), \
+         patch("app.services.verdict_cache.VERDICT_CACHE_PURGE_INTERVAL_SECONDS", 0.01):
+        await asyncio.wait_for(run_verdict_cache_purger(stop_event), timeout=5)
+
+    assert len(statements) == 2
+    assert all(statement.startswith("DELETE FROM verdict_cache WHERE verdict_cache.created_at <") for statement in statements)
+    assert db_session.commit.await_count == 2
+
+@pytest.mark.asyncio
+async def test_run_periodically_survives_failures():
+    """Test a periodic task keeps running after a failed run and stops once the stop event is set."""
+    from app.services.periodic import run_periodically
+
+    stop_event = asyncio.Event()
+    runs = []
+    async def task():
+        runs.append(len(runs))
+        if len(runs) == 1:
+            raise RuntimeError("transient")
+        if len(runs) == 3:
+            stop_event.set()
+
+    await asyncio.wait_for(run_periodically(task, 0.01, stop_event, "test_task"), timeout=5)
+    assert runs == [0, 1, 2]
+
+@pytest.mark.asyncio
+async def test_tweet_processor_rescan_hits_cache(db_session):
+    """Test that rescanning unchanged tweets makes no LLM calls."""
+    from app.services.tweets_processor import process_user_tweets
+
+    tweets = [{"text": "Cache me if you can", "created_at": datetime.datetime.now()}]
+    policy_rules = [{"rule_id": "CACHE-001", "description": "Cache rule"}]
+
+    with patch("app.services.tweets_processor.fetch_all_tweets",
+               mock_tweet_pages(tweets)):
+        with patch("app.services.tweets_processor.classify_tweets",
+                   AsyncMock(return_value=[{"violation": "NO"}])) as mock_classify:
+
+            await process_user_tweets("test_user", compile_policy("test_policy", policy_rules), db_session)
+            await process_user_tweets("test_user", compile_policy("test_policy", policy_rules), db_session)
+
+            assert mock_classify.await_count == 1
+
+@pytest.mark.asyncio
+async def test_fetch_all_tweets_streams_pages(db_session):
+    """Test that live fetching yields each page and follows next_token."""
+    from app.services import tweets_fetcher
+
+    payloads = [
+        {"data": [{"id": "1", "text": "first", "created_at": "2025-03-01T09:45:23.000Z"}], "meta": {"next_token": "abc"}},
+        {"data": [{"id": "2", "text": "second", "created_at": "2025-03-02T09:45:23.000Z"}], "meta": {}}
+    ]
+    fetch_page = AsyncMock(side_effect=payloads)
+
+    with patch.object(tweets_fetcher, "USE_SAMPLE_DATA", False):
+        with patch.object(tweets_fetcher, "fetch_tweets_page_with_retry", fetch_page):
+            pages = [page async for page in tweets_fetcher.fetch_all_tweets("test_user", since_id="100")]
+
+    assert [[tweet["text"] for tweet in page] for page, _ in pages] == [["first"], ["second"]]
+    assert [next_token for _, next_token in pages] == ["abc", None]
+    assert fetch_page.call_args_list[1][0][0]["next_token"] == "abc"
+    assert fetch_page.call_args_list[0][0][0]["since_id"] == "100"
+    assert pages[0][0][0]["created_at"] == datetime.datetime(2025, 3, 1, 9, 45, 23)
+
+@pytest.mark.asyncio
+async def test_tweet_processor_resumes_after_rate_limit(db_session):
+    """Test a rate-limited scan keeps its watermark and resumes from the committed page checkpoint."""
+    from app.core.models import ScannedUser
+    from app.services.tweets_fetcher import TooManyRequests
+    from app.services.tweets_processor import process_user_tweets
+
+    state = ScannedUser(username="test_user", since_id="10")
+    db_session.execute.return_value.scalars.return_value.first.return_value = state
+    calls = []
+
+    async def fetch(username, since_id=None, start_time=None, next_token=None):
+        calls.append((since_id, next_token))
+        if next_token is None:
+            yield [{"id": "12", "text": "watermark newest"}, {"id": "11", "text": "watermark older"}], "page2"
+            raise TooManyRequests("rate limited")
+        yield [{"id": "8", "text": "watermark oldest"}], None
+
+    async def classify(texts, policy, user_scope=None):
+        return [{"violation": "NO"} for _ in texts]
+
+    with patch("app.services.tweets_processor.fetch_all_tweets", fetch), \
+         patch("app.services.tweets_processor.classify_tweets", AsyncMock(side_effect=classify)):
+        with pytest.raises(TooManyRequests):
+            await process_user_tweets("test_user", compile_policy("test_policy", []), db_session)
+        assert (state.since_id, state.next_token, state.pending_since_id) == ("10", "page2", "12")
+
+        await process_user_tweets("test_user", compile_policy("test_policy", []), db_session)
+
+    assert calls == [("10", None), ("10", "page2")]
+    assert (state.since_id, state.next_token, state.pending_since_id) == ("12", None, None)
+    assert state.last_scanned_at is not None
+
+@pytest.mark.asyncio
+async def test_scan_state_is_kept_per_policy(tmp_path):
+    """Test a scan under one policy doesn't move the watermark another policy's scans start from."""
+    from sqlalchemy import select
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from app.core.database import Base
+    from app.core.models import ScannedUser
+    from app.services.tweets_processor import process_user_tweets
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/state.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+
+    fetched = []
+    async def fetch(username, since_id=None, start_time=None, next_token=None):
+        fetched.append(since_id)
+        tweets = [{"id": "12", "text": "leak newest"}, {"id": "11", "text": "leak older"}]
+        yield [tweet for tweet in tweets if since_id is None or int(tweet["id"]) > int(since_id)], None
+
+    classified = []
+    async def classify(texts, policy, user_scope=None):
+        classified.append((policy.name, list(texts)))
+        return [{"violation": "NO"} for _ in texts]
+
+    with patch("app.core.database.AsyncSessionLocal", sessions), \
+         patch("app.services.tweets_processor.USE_VERDICT_CACHE", False), \
+         patch("app.services.tweets_processor.fetch_all_tweets", fetch), \
+         patch("app.services.tweets_processor.classify_tweets", side_effect=classify):
+        await process_user_tweets("test_user", compile_policy("conduct", ["Be civil"]))
+        await process_user_tweets("test_user", compile_policy("secrets", ["No leaks"]))
+        await process_user_tweets("test_user", compile_policy("conduct", ["Be civil"]))
+
+    assert fetched == [None, None, "12"]
+    assert classified == [("conduct", ["leak newest", "leak older"]), ("secrets", ["leak newest", "leak older"])]
+    async with sessions() as session:
+        states = (await session.execute(select(ScannedUser).order_by(ScannedUser.policy))).scalars().all()
+    assert [(state.username, state.policy, state.since_id) for state in states] == [("test_user", "conduct", "12"), ("test_user", "secrets", "12")]
+    await engine.dispose()
+
+def test_monitor_plans_due_scans_within_budget():
+    """Test due accounts are picked by priority, skipping those that no longer fit the request budgets."""
+    from app.core.models import ScannedUser, WatchedAccount
+    from app.services.monitor import plan_due_scans
+
+    now = datetime.datetime(2025, 3, 1, 12, 0)
+    due = [WatchedAccount(username=name, policy_name="p", interval_seconds=3600, next_scan_at=now) for name in ("quiet", "risky", "new", "busy")]
+    last_scan = now - datetime.timedelta(days=1)
+    users = {
+        ("quiet", "p"): ScannedUser(username="quiet", policy="p", last_scanned_at=last_scan, tweets_seen=200, violations_seen=0, tweets_per_day=1),
+        ("risky", "p"): ScannedUser(username="risky", policy="p", last_scanned_at=last_scan, tweets_seen=200, violations_seen=50, tweets_per_day=5),
+        ("busy", "p"): ScannedUser(username="busy", policy="p", last_scanned_at=last_scan, tweets_seen=200, violations_seen=10, tweets_per_day=1000),
+        # Another policy's state of the account doesn't make it a known account here
+        ("new", "other"): ScannedUser(username="new", policy="other", last_scanned_at=last_scan, tweets_seen=200, violations_seen=0, tweets_per_day=1)
+    }
+
+    picked = plan_due_scans(due, users, now, twitter_budget=5, openai_budget=100)
+    assert [watch.username for watch in picked] == ["new", "risky", "quiet"]
+
+    # An account too big for a whole tick still runs when it's the first pick
+    picked = plan_due_scans([due[3]], users, now, twitter_budget=1, openai_budget=1)
+    assert [watch.username for watch in picked] == ["busy"]
+
+@pytest.mark.asyncio
+async def test_monitor_ticks_share_one_budget_between_processes(tmp_path):
+    """Test a tick counts queued and running jobs against the budget, and skips while another process ticks."""
+    from sqlalchemy import select, update, func
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from app.core.database import Base
+    from app.core.models import ScanJob, WatchedAccount
+    from app.services.monitor import schedule_due_scans
+    from app.services.job_queue import utc_now, JOB_RUNNING
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/monitor.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+    async with sessions() as session:
+        due_at = utc_now() - datetime.timedelta(minutes=1)
+        session.add_all(WatchedAccount(username=f"user{i}", policy_name="p", interval_seconds=3600, next_scan_at=due_at,
+                                       created_at=due_at) for i in range(6))
+        await session.commit()
+
+    with patch("app.services.monitor.tick_budgets", return_value=(4, 100)):
+        async with sessions() as session:
+            assert len(await schedule_due_scans(session)) == 4
+        # The scans started meanwhile, in another worker process: they still hold the budget
+        async with sessions() as session:
+            await session.execute(update(ScanJob).values(status=JOB_RUNNING))
+            await session.execute(update(WatchedAccount).values(next_scan_at=due_at))
+            await session.commit()
+        async with sessions() as session:
+            assert await schedule_due_scans(session) == []
+            assert await session.scalar(select(func.count()).select_from(ScanJob)) == 4
+
+    # On Postgres, a process whose tick overlaps another one's does nothing
+    session = AsyncMock()
+    session.get_bind = MagicMock()
+    session.get_bind.return_value.dialect.name = "postgresql"
+    session.scalar.return_value = False
+    assert await schedule_due_scans(session) == []
+    assert "pg_try_advisory_xact_lock" in str(session.scalar.await_args.args[0])
+    session.execute.assert_not_awaited()
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_violation_sink_flushes_in_chunks(db_session):
+    """Test the sink writes multi-row inserts of at most flush_size rows and commits once per flush."""
+    from app.services.violation_sink import ViolationSink
+
+    sink = ViolationSink(db_session, flush_size=2)
+    sink.add([{"username": "u", "tweet": f"t{i}", "policy": "p", "rule_id": "r", "rule_violated": "v",
+               "reason": "why", "posted_at": datetime.datetime.now()} for i in range(5)])
+    assert sink.is_full
+
+    await sink.flush()
+
+    assert len(inserted_violations(db_session)) == 5
+    # Three chunks plus one rollup upsert
+    assert db_session.execute.await_count == 4
+    assert db_session.commit.await_count == 1
+    assert sink.written == 5 and not sink.pending
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not os.getenv("TEST_DATABASE_URL", "").startswith("postgresql+asyncpg"), reason="needs TEST_DATABASE_URL=postgresql+asyncpg://...")
+async def test_violation_sink_copy_is_rolled_back_with_its_transaction():
+    """Test COPYed violations on Postgres belong to the session transaction, a failed commit writes none of them."""
+    from sqlalchemy import delete, func, select
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from app.core.database import Base
+    from app.core.models import Violation, ViolationRollup
+    from app.services.violation_sink import ViolationSink
+
+    engine = create_async_engine(os.environ["TEST_DATABASE_URL"])
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+    rows = [{"username": "copy_user", "tweet": f"t{i}", "policy": "p", "rule_id": "r", "rule_violated": "v",
+             "reason": "why", "posted_at": datetime.datetime(2025, 3, 1)} for i in range(3)]
+
+    try:
+        async with sessions() as session:
+            sink = ViolationSink(session, use_copy=True)
+            sink.add(rows)
+            # Fails after the COPY and the rollup upsert ran, as a crash before the commit would
+            with patch.object(session, "commit", AsyncMock(side_effect=RuntimeError("crash"))):
+                with pytest.raises(RuntimeError):
+                    await sink.flush()
+            await session.rollback()
+
+        async with sessions() as session:
+            assert await session.scalar(select(func.count()).select_from(Violation).where(Violation.username == "copy_user")) == 0
+    finally:
+        async with sessions() as session:
+            await session.execute(delete(Violation).where(Violation.username == "copy_user"))
+            await session.execute(delete(ViolationRollup).where(ViolationRollup.username == "copy_user"))
+            await session.commit()
+        await engine.dispose()
+
+def test_policy_registry_reloads_on_change(tmp_path):
+    """Test the registry compiles once and recompiles when the file changes."""
+    import os
+    from app.services.policy_registry import PolicyRegistry, PolicyNotFound, InvalidPolicy
+
+    registry = PolicyRegistry(str(tmp_path))
+    policy_file = tmp_path / "test_policy.json"
+    policy_file.write_text(json.dumps({"policy_name": "Test Policy", "rules": [
+        {"rule_id": "TEST-001", "category": "Test Category", "description": "Test rule description"}
+    ]}))
+
+    policy = registry.get("test_policy")
+    assert policy.title == "Test Policy"
+    assert policy.rules_text == "[TEST-001] Test Category: Test rule description"
+    assert registry.get("test_policy") is policy
+
+    policy_file.write_text(json.dumps([{"rule_id": "TEST-002", "description": "Other rule"}]))
+    os.utime(policy_file, (policy.mtime + 10, policy.mtime + 10))
+    reloaded = registry.get("test_policy")
+    assert reloaded.content_hash != policy.content_hash
+    assert reloaded.rules[0]["rule_id"] == "TEST-002"
+
+    with pytest.raises(PolicyNotFound):
+        registry.get("missing_policy")
+    with pytest.raises(InvalidPolicy):
+        compile_policy("bad", {"no_rules": True})
+
+def test_prefilter_keyword_rules():
+    """Test the keyword pre-filter escalates risky tweets and clears unrelated ones."""
+    from app.services.prefilter import PolicyPrefilter, PREFILTER_SAFE, PREFILTER_ESCALATE
+
+    policy = compile_policy("test_policy", [
+        {"rule_id": "CONFID-001", "category": "Confidentiality", "description": "Sharing financial data"}
+    ])
+    prefilter = PolicyPrefilter(policy)
+
+    assert prefilter.assess([
+        "Beautiful day for a coffee break!",
+        "Our financial results look great",
+        "Revenue hit $50M this quarter"
+    ]) == [PREFILTER_SAFE, PREFILTER_ESCALATE, PREFILTER_ESCALATE]
+
+@pytest.mark.asyncio
+async def test_tweet_processor_prefilter_short_circuits(db_session):
+    """Test that pre-filtered tweets never reach the LLM."""
+    from app.services.tweets_processor import process_user_tweets
+
+    tweets = [
+        {"text": "Lovely sunny weekend hike", "created_at": datetime.datetime.now()},
+        {"text": "This is a confidential roadmap leak", "created_at": datetime.datetime.now()}
+    ]
+
+    with patch("app.services.tweets_processor.PREFILTER_ENABLED", True), \
+         patch("app.services.tweets_processor.fetch_all_tweets", mock_tweet_pages(tweets)), \
+         patch("app.services.tweets_processor.classify_tweets",
+               AsyncMock(return_value=[{"violation": "NO"}])) as mock_classify:
+
+        await process_user_tweets("test_user", compile_policy("prefilter_policy", ["No leaks"]), db_session)
+
+        assert mock_classify.await_args[0][0] == ["This is a confidential roadmap leak"]
+
+@pytest.mark.asyncio
+async def test_prefilter_model_training(db_session, tmp_path):
+    """Test training the optional local model from stored verdicts."""
+    pytest.importorskip("sklearn")
+    from app.services.prefilter import PrefilterRegistry
+
+    rows = [(f"leaking our numbers {i}", '{"violation": "YES"}') for i in range(5)] + \
+           [(f"nice walk in the park {i}", '{"violation": "NO"}') for i in range(5)]
+    db_session.execute.return_value.all.return_value = rows
+
+    policy = compile_policy("model_policy", [])
+    registry = PrefilterRegistry(str(tmp_path))
+    summary = await registry.train_model(db_session, policy)
+
+    assert summary == {"samples": 10, "violations": 5}
+    # A fresh registry (e.g. a worker process) picks up the persisted model
+    assert PrefilterRegistry(str(tmp_path)).get(policy).model is not None
+
+@pytest.mark.asyncio
+async def test_prefilter_training_is_capped_and_runs_off_the_event_loop(db_session, tmp_path):
+    """Test training reads only the newest verdicts and fits the model in a worker thread."""
+    import threading
+    from app.services.prefilter import PrefilterRegistry
+
+    rows = [("leak", '{"violation": "YES"}'), ("walk", '{"violation": "NO"}')]
+    db_session.execute.return_value.all.return_value = rows
+    fitted_in = []
+
+    def fit_model(texts, labels):
+        fitted_in.append(threading.current_thread())
+        return {"texts": texts, "labels": labels}
+
+    policy = compile_policy("capped_policy", [])
+    registry = PrefilterRegistry(str(tmp_path / "models"))
+    with patch("app.services.prefilter.make_pipeline", MagicMock()), \
+         patch("app.services.prefilter.fit_model", side_effect=fit_model):
+        assert await registry.train_model(db_session, policy, max_samples=2) == {"samples": 2, "violations": 1}
+
+    assert fitted_in and fitted_in[0] is not threading.main_thread()
+    statement = db_session.execute.call_args.args[0]
+    assert statement._limit == 2 and "ORDER BY verdict_cache.id DESC" in str(statement)
+    assert PrefilterRegistry(str(tmp_path / "models")).get(policy).model == {"texts": ["leak", "walk"], "labels": [1, 0]}
+
+def test_dedup_normalization_and_near_duplicates():
+    """Test that URLs, mentions and whitespace don't split duplicates, and near-duplicates collapse."""
+    from app.services.dedup import DedupScope, normalize_for_dedup
+
+    assert normalize_for_dedup("RT @bob:  Big NEWS https://t.co/x1") == normalize_for_dedup("big news http://t.co/y2 @alice")
+
+    scope = DedupScope(near_duplicates=True, max_distance=3, max_entries=100)
+    base = "our team is shipping the new billing dashboard to every customer next week #launch #saas"
+    assert scope.canonical_key(base) == scope.canonical_key(base + "!")
+    assert scope.canonical_key(base) == scope.canonical_key(base.replace("dashboard", "dashbord"))
+    assert scope.canonical_key(base) != scope.canonical_key(base.replace("shipping", "pulling"))
+    assert scope.canonical_key(base) != scope.canonical_key("beautiful sunny day for a long coffee break outside")
+
+@pytest.mark.asyncio
+async def test_dedup_scope_shares_verdicts_across_scans():
+    """Test that concurrent scans of the same text trigger a single classification."""
+    import asyncio
+    from app.services.dedup import DedupScope
+
+    scope = DedupScope(near_duplicates=False, max_distance=3, max_entries=100)
+    calls = []
+
+    async def classify_texts(texts):
+        calls.append(texts)
+        await asyncio.sleep(0.01)
+        return [{"violation": "NO"} for _ in texts]
+
+    first, second = await asyncio.gather(
+        scope.classify({"a1": "Same tweet @alice", "a2": "same   tweet"}, "policy-hash", classify_texts),
+        scope.classify({"b1": "Same tweet @bob"}, "policy-hash", classify_texts)
+    )
+
+    assert len(calls) == 1 and len(calls[0]) == 1
+    assert first == {"a1": {"violation": "NO"}, "a2": {"violation": "NO"}}
+    assert second == {"b1": {"violation": "NO"}}
+
+@pytest.mark.asyncio
+async def test_dedup_scope_raises_owner_failure_to_sharers():
+    """Test that a scan waiting on another scan's rate-limited classification is rate limited too."""
+    from openai import RateLimitError
+    from app.services.dedup import DedupScope
+
+    scope = DedupScope(near_duplicates=False, max_distance=3, max_entries=100)
+
+    async def rate_limited(texts):
+        await asyncio.sleep(0.01)
+        raise RateLimitError("rate limited", response=MagicMock(headers={}), body=None)
+
+    async def classify_texts(texts):
+        return [{"violation": "NO"} for _ in texts]
+
+    owner, sharer = await asyncio.gather(
+        scope.classify({"a1": "Shared tweet"}, "policy-hash", rate_limited),
+        scope.classify({"b1": "Shared tweet", "b2": "Own tweet"}, "policy-hash", classify_texts),
+        return_exceptions=True
+    )
+
+    assert isinstance(owner, RateLimitError) and isinstance(sharer, RateLimitError)
+    # Nothing is remembered for the failed text, the next scan classifies it again
+    assert await scope.classify({"c1": "Shared tweet"}, "policy-hash", classify_texts) == {"c1": {"violation": "NO"}}
+
+@pytest.mark.asyncio
+async def test_dedup_scope_expires_finished_results():
+    """Test finished verdicts are reused for result_ttl only, and not at all without keep_results."""
+    from app.services.dedup import DedupScope
+
+    calls = []
+    async def classify_texts(texts):
+        calls.append(texts)
+        return [{"violation": "NO"} for _ in texts]
+
+    scope = DedupScope(near_duplicates=False, max_distance=3, max_entries=100, result_ttl=60)
+    with patch("app.services.dedup.time.monotonic", side_effect=[0, 0, 30, 100, 100]):
+        for _ in range(3):
+            await scope.classify({"t": "Repeated tweet"}, "policy-hash", classify_texts)
+    assert len(calls) == 2
+
+    calls.clear()
+    scope = DedupScope(near_duplicates=False, max_distance=3, max_entries=100, keep_results=False)
+    for _ in range(2):
+        await scope.classify({"t": "Repeated tweet"}, "policy-hash", classify_texts)
+    assert len(calls) == 2 and not scope.results
+
+
+
+
+@pytest.mark.asyncio
+async def test_backfill_rollups_skips_rows_another_process_inserted(tmp_path):
+    """Test two processes that both found the rollup table empty at startup don't fail on the unique key."""
+    from sqlalchemy import select
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from app.core.database import Base
+    from app.core.models import Violation, ViolationRollup
+    from app.services.violation_rollups import backfill_rollups
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/rollups.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(Violation.__table__.insert(), [
+            {"username": "alice", "tweet": f"t{i}", "policy": "p", "rule_id": "r1", "rule_violated": "Rule",
+             "reason": "why", "posted_at": datetime.datetime(2024, 5, 1, 12)}
+            for i in range(3)
+        ])
+
+    class LateConnection:
+        """Sees the rollup table still empty, as a process that checked before the other one inserted."""
+
+        def __init__(self, conn):
+            self.conn = conn
+            self.dialect = conn.dialect
+            self.checked = False
+
+        def execute(self, statement):
+            if not self.checked:
+                self.checked = True
+                return MagicMock(first=MagicMock(return_value=None))
+            return self.conn.execute(statement)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(backfill_rollups)
+        await conn.run_sync(lambda sync_conn: backfill_rollups(LateConnection(sync_conn)))
+        rows = (await conn.execute(select(ViolationRollup.username, ViolationRollup.violations))).all()
+    assert rows == [("alice", 3)]
+    await engine.dispose()
@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+import signal
+import uvicorn
+from fastapi import FastAPI
+from app.core.database import create_tables
+from app.core.config import WORKER_CONCURRENCY, WORKER_METRICS_PORT, MONITOR_ENABLED, SEMANTIC_SEARCH_ENABLED, USE_VERDICT_CACHE
+from app.services.job_queue import run_worker
+from app.services.archive_ingest import run_ingest_worker
+from app.services.monitor import run_monitor
+from app.services.semantic_index import run_semantic_indexer
+from app.services.verdict_cache import run_verdict_cache_purger
+from app.services.tweets_fetcher import close_client
+from app.services.cpu_pool import cpu_pool
+from app.core.logging_config import configure_logging
+from app.routes.system_routes import system_router
+
+
+# Metrics are kept per process, so every worker serves its own /system endpoints for Prometheus to scrape
+metrics_app = FastAPI(title="Scan Worker")
+metrics_app.include_router(system_router)
+
+
+
+
+async def serve_metrics(port: int, stop_event: asyncio.Event):
+    """Serve this worker's /system endpoints (metrics, scheduler, pool stats) on `port` until `stop_event` is set."""
+    server = uvicorn.Server(uvicorn.Config(metrics_app, host="0.0.0.0", port=port, log_level="warning"))
+    # uvicorn takes over SIGTERM/SIGINT while serving, and raises them again for our handlers once it stopped
+    serving = asyncio.create_task(server.serve())
+    stopping = asyncio.create_task(stop_event.wait())
+    await asyncio.wait((serving, stopping), return_when=asyncio.FIRST_COMPLETED)
+    server.should_exit = True
+    stopping.cancel()
+    await serving
+
+
+
+
+async def main(concurrency: int):
+    await create_tables()
+    await cpu_pool.start()
+
+    # Finish the jobs in hand and exit on SIGTERM/SIGINT
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    try:
+        # Every worker also schedules due watched accounts, one tick at a time within the deployment budget
+        tasks = [run_worker(concurrency, stop_event)]
+        if MONITOR_ENABLED:
+            tasks.append(run_monitor(stop_event))
+        # Workers sharing SEMANTIC_INDEX_DIR take turns through its file lock
+        if SEMANTIC_SEARCH_ENABLED:
+            tasks.append(run_semantic_indexer(stop_event))
+        # Purging is an idempotent DELETE, every worker can run it
+        if USE_VERDICT_CACHE:
+            tasks.append(run_verdict_cache_purger(stop_event))
+        # Archive ingests queued by POST /tweets/ingest, one at a time per worker process
+        tasks.append(run_ingest_worker(stop_event))
+        if WORKER_METRICS_PORT:
+            tasks.append(serve_metrics(WORKER_METRICS_PORT, stop_event))
+        await asyncio.gather(*tasks)
+    finally:
+        await close_client()
+        cpu_pool.shutdown()
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan job worker, run as many processes as needed")
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY, help="Jobs processed at once by this process")
+    args = parser.parse_args()
+    configure_logging()
+    asyncio.run(main(args.concurrency))